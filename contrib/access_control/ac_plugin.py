@@ -1,4 +1,6 @@
 
+import os
+import re
 import shlex
 import string
 from textwrap import dedent
@@ -6,11 +8,13 @@ from txcasproxy.interfaces import (
     IRProxyPluginFactory, 
     IAccessControl)
 from txcasproxy import proxyutils
+from txcasproxy.cache import LRUCache
 from jinja2 import Environment, FileSystemLoader
 from jinja2.exceptions import TemplateNotFound
-from twisted.internet import defer
+from twisted.internet import defer, task
 from twisted.plugin import IPlugin
-from yaml import load
+from twisted.python import log
+from yaml import safe_load
 from zope.interface import implementer
 
 @implementer(IPlugin, IRProxyPluginFactory)
@@ -23,6 +27,9 @@ class AccessControlPluginFactory(object):
         Options are supplied as a colon-separated key=value list.
         Valid options are:
         - config: Path to an access control config file.
+        - reload_interval: Seconds between checks for changes to the config
+          file (0 disables reloading).  Default 10.
+        - cache_size: Number of access decisions to cache.  Default 10000.
         ''')
 
     def generatePlugin(self, argstring=""):
@@ -38,26 +45,142 @@ class AccessControlPluginFactory(object):
             settings.update(argdict)
         plugin = AccessControlPlugin()
         plugin.config = settings.get('config', None)
+        if 'reload_interval' in settings:
+            plugin.reload_interval = float(settings['reload_interval'])
+        if 'cache_size' in settings:
+            plugin.cache_size = int(settings['cache_size'])
+        plugin.load()
         return plugin
 
+class CompiledRule(object):
+    """
+    An attribute test compiled from one entry of the rules file.
+    """
+
+    def __init__(self, attrib, info):
+        self.attrib = attrib
+        if info is None:
+            info = {}
+        self.allowed_values = _frozenset_or_none(info.get('allowed_values', None))
+        self.allowed_pattern = _compile_patterns(info.get('allowed_patterns', None))
+        self.denied_values = _frozenset_or_none(info.get('denied_values', None))
+        self.denied_pattern = _compile_patterns(info.get('denied_patterns', None))
+        self.has_allowed = (self.allowed_values is not None) or (self.allowed_pattern is not None)
+
+    def check(self, attrib_values):
+        """
+        Returns a reason if the attribute values fail this rule, else None.
+        """
+        attrib = self.attrib
+        denied_values = self.denied_values
+        denied_pattern = self.denied_pattern
+        if denied_values is not None or denied_pattern is not None:
+            for attrib_value in attrib_values:
+                if denied_values is not None and attrib_value in denied_values:
+                    return "Attribute '{0}' value '{1}' is denied.".format(attrib, attrib_value)
+                if denied_pattern is not None and attrib_value is not None and \
+                        denied_pattern.match(attrib_value) is not None:
+                    return "Attribute '{0}' value '{1}' is denied.".format(attrib, attrib_value)
+        if not self.has_allowed:
+            return None
+        allowed_values = self.allowed_values
+        if allowed_values is not None and not allowed_values.isdisjoint(attrib_values):
+            return None
+        allowed_pattern = self.allowed_pattern
+        attrib_value = None
+        for attrib_value in attrib_values:
+            if allowed_pattern is not None and attrib_value is not None and \
+                    allowed_pattern.match(attrib_value) is not None:
+                return None
+        return "Attribute '{0}' value '{1}' not in allowed values.".format(
+            attrib,
+            attrib_value)
+
+
+def _frozenset_or_none(values):
+    if values is None:
+        return None
+    return frozenset(values)
+
+def _compile_patterns(patterns):
+    """
+    Compile a list of regular expressions into a single alternation that
+    must match an entire value.
+    """
+    if patterns is None or len(patterns) == 0:
+        return None
+    return re.compile("(?:{0})\\Z".format("|".join(
+        "(?:{0})".format(pattern) for pattern in patterns)))
+
+def compile_rules(rules):
+    if rules is None:
+        return None
+    return tuple(CompiledRule(attrib, info) for attrib, info in rules.items())
+
+
 @implementer(IAccessControl)
 class AccessControlPlugin(object):
     tagname = "access_control" 
     ac_sequence = 1
     config = None
+    reload_interval = 10
+    cache_size = 10000
+    clock = None
+    _loaded = False
     _rules = None
+    _compiled = None
+    _mtime = None
+    _reloader = None
+    _decisions = None
+
+    def load(self):
+        """
+        Load the rules file and start checking it for changes.
+        """
+        config = self.config
+        if not config is None:
+            self._load()
+            if self._reloader is None and self.reload_interval > 0:
+                clock = self.clock
+                if clock is None:
+                    from twisted.internet import reactor as clock
+                self._reloader = task.LoopingCall(self._checkForChanges)
+                self._reloader.clock = clock
+                self._reloader.start(self.reload_interval, now=False)
+        self._loaded = True
 
     def _lazyLoadConfig(self):
-        if self._rules is None:
-            config = self.config
-            if not config is None:
-                with open(config, "r") as f:
-                    self._rules = load(f)
-        return self._rules
+        # An empty rules file compiles to None, so `_compiled` cannot tell
+        # whether the file has been loaded.
+        if not self._loaded:
+            self.load()
+        return self._compiled
+
+    def _load(self):
+        config = self.config
+        mtime = os.stat(config).st_mtime
+        with open(config, "r") as f:
+            rules = safe_load(f)
+        compiled = compile_rules(rules)
+        self._rules = rules
+        self._compiled = compiled
+        self._mtime = mtime
+        self._decisions = LRUCache(self.cache_size)
+
+    def _checkForChanges(self):
+        try:
+            mtime = os.stat(self.config).st_mtime
+            if mtime != self._mtime:
+                self._load()
+                log.msg("[INFO] Reloaded access control rules from '{0}'.".format(self.config))
+        except Exception as ex:
+            log.msg("[INFO] Could not reload access control rules from '{0}': {1}".format(
+                self.config, ex))
 
     @property
     def rules(self):
-        return self._lazyLoadConfig()
+        self._lazyLoadConfig()
+        return self._rules
 
     def isAllowed(self, username, attrib_map):
         """
@@ -65,26 +188,30 @@ class AccessControlPlugin(object):
         If `is_allowed` is True, `reason` should be None.
         `reason` should be suitable for display to an end user
         """
-        rules = self.rules
-        if rules is None:
-            return True
-        for attrib, info in rules.iteritems():
+        compiled = self._lazyLoadConfig()
+        if compiled is None:
+            return True, None
+        key = tuple(_freeze(attrib_map.get(rule.attrib, None)) for rule in compiled)
+        decisions = self._decisions
+        decision = decisions.get(key, None)
+        if decision is None:
+            decision = self._decide(compiled, attrib_map)
+            decisions.set(key, decision)
+        return decision
+
+    def _decide(self, compiled, attrib_map):
+        for rule in compiled:
+            attrib = rule.attrib
             if not attrib in attrib_map:
                 msg = "Missing attribute `{0}`.".format(attrib)
                 return False, msg        
-            if info is None:
-                continue
-            if 'allowed_values' in info:
-                allowed_values = set(info['allowed_values'])
-                attrib_values = attrib_map[attrib]
-                match_found = False
-                for attrib_value in attrib_values:
-                    if attrib_value in allowed_values:
-                        match_found = True
-                        break
-                if not match_found:
-                    msg = "Attribute '{0}' value '{1}' not in allowed values.".format(
-                        attrib,
-                        attrib_value)
-                    return False, msg
+            reason = rule.check(attrib_map[attrib])
+            if reason is not None:
+                return False, reason
         return True, None
+
+
+def _freeze(values):
+    if values is None:
+        return None
+    return frozenset(values)
@@ -13,9 +13,9 @@ from txcasproxy.interfaces import IRProxyPluginFactory, IRProxyInfoAcceptor, \
                             IResponseContentModifier, ICASRedirectHandler, \
                             IResourceInterceptor, IStaticResourceProvider
 from txcasproxy import proxyutils
+from txcasproxy.templates import TemplateRenderer
 
 # External modules
-from jinja2 import Environment, FileSystemLoader
 from jinja2.exceptions import TemplateNotFound
 from twisted.internet import defer
 from twisted.plugin import IPlugin
@@ -70,6 +70,7 @@ class GrouperPlugin(object):
     expire_session = lambda self, uid: None
     
     mod_sequence = 7
+    mod_cacheable = True
     cas_redirect_sequence = 7
     interceptor_sequence = 7
     
@@ -83,19 +84,20 @@ class GrouperPlugin(object):
     
     def __init__(self, **kwds):
         self.cas_logout_url = kwds.get('cas_logout_url', None)
-        self._loader = FileSystemLoader(self.template_dir)
-        self._env = Environment()
+        self._templates = TemplateRenderer(
+            self.template_dir,
+            context=dict(
+                cas_logout_url=self.cas_logout_url,
+                static_path=self.static_resource_base))
+        self._templates.prerender(["logout.jinja2"])
         
     def _renderTemplate(self, template_name, **kwds):
         """
         """
-        env = self._env
-        loader = self._loader
         try:
-            templ = loader.load(env, template_name)
+            return self._templates.render(template_name, **kwds)
         except TemplateNotFound:
             raise ViewNotImplementedError("The template '%s' was not found." % template_name)
-        return templ.render(**kwds).encode('utf-8')
         
     def handle_rproxy_info_set(self):
         proxied_netloc = self.proxied_netloc
@@ -0,0 +1,407 @@
+
+import fnmatch
+import os
+import re
+import shlex
+import string
+import threading
+from textwrap import dedent
+from txcasproxy.interfaces import (
+    IRProxyPluginFactory,
+    IRProxyInfoAcceptor,
+    IResponseContentModifier)
+from txcasproxy.urls import does_url_match_pattern, parse_url_pattern
+from twisted.plugin import IPlugin
+from yaml import safe_load
+from zope.interface import implementer
+
+@implementer(IPlugin, IRProxyPluginFactory)
+class RewritePluginFactory(object):
+    tag = "rewrite"
+    opt_help = dedent('''\
+        Rewrite response content with literal and regular expression rules.
+        ''')
+    opt_usage = dedent('''\
+        Options are supplied as a colon-separated key=value list.
+        Valid options are:
+        - config: Path to a YAML rewrite rules file (required).
+        - sequence: Order among content modifiers.  Default 5.
+        ''')
+
+    def generatePlugin(self, argstring=""):
+        settings = {}
+        if argstring.strip() != "":
+            parser = shlex.shlex(argstring, posix=True)
+            parser.wordchars = string.printable
+            parser.whitespace = ':'
+            parser.commenters = ''
+            parser.quotes = ''
+            parser.escapedquotes = ''
+            argdict = dict(tuple(token.split('=')) for token in parser)
+            settings.update(argdict)
+        if 'config' not in settings:
+            raise Exception("The rewrite plugin requires the `config` option.")
+        plugin = RewritePlugin(settings['config'])
+        if 'sequence' in settings:
+            plugin.mod_sequence = int(settings['sequence'])
+        return plugin
+
+
+def _iterbytes(value):
+    """
+    Yields each byte of `value` as a length 1 bytes object.
+    """
+    for n in range(len(value)):
+        yield value[n:n + 1]
+
+
+def _to_bytes(value):
+    if isinstance(value, bytes):
+        return value
+    return str(value).encode('utf-8')
+
+
+class RewriteRule(object):
+    """
+    One entry of the rules file.  Exactly one of these keys gives the
+    rule's kind:
+
+    * `literal`: Text replaced by `replacement`.
+    * `regex`: A regular expression replaced by `replacement`, which may
+      refer to groups as `\\1` or `\\g<name>`.  Matches are assumed to be
+      at most `max_length` bytes (default 256).
+    * `backend_urls`: If true, absolute URLs for the proxied site are
+      replaced by URLs for the proxy.
+
+    `paths` (URL patterns, as for the `logout` option) and `content_types`
+    (glob patterns, e.g. 'text/*') limit the responses a rule applies to.
+    """
+    kinds = ('literal', 'regex', 'backend_urls')
+
+    def __init__(self, info):
+        kinds = [kind for kind in self.kinds if kind in info]
+        if len(kinds) != 1:
+            raise ValueError(
+                "A rewrite rule needs exactly one of: {0}.".format(', '.join(self.kinds)))
+        kind = kinds[0]
+        self.kind = kind
+        self.replacement = _to_bytes(info.get('replacement', ''))
+        self.max_length = int(info.get('max_length', 256))
+        # Literal rules match any of `literals` followed by `suffix`;
+        # regex rules match `source`.
+        self.literals = None
+        self.suffix = b''
+        self.source = None
+        if kind == 'literal':
+            literal = _to_bytes(info['literal'])
+            if len(literal) == 0:
+                raise ValueError("A literal rewrite rule may not be empty.")
+            self.literals = [literal]
+            self.max_length = len(literal)
+        elif kind == 'regex':
+            self.source = _to_bytes(info['regex'])
+            re.compile(self.source)
+        elif not info['backend_urls']:
+            raise ValueError("`backend_urls` must be true.")
+        self.paths = [parse_url_pattern(path) for path in info.get('paths', [])]
+        self.content_types = [ct.lower() for ct in info.get('content_types', [])]
+
+    def set_backend(self, netloc, path):
+        """
+        Match absolute and protocol relative URLs for the proxied site.
+        """
+        self.set_backends([(netloc, path)])
+
+    def set_backends(self, backends):
+        """
+        Match absolute and protocol relative URLs for each (netloc, path)
+        of the proxied site's upstreams.
+        """
+        if self.kind != 'backend_urls':
+            return
+        literals = []
+        for netloc, path in backends:
+            prefix = b'//' + _to_bytes(netloc) + _to_bytes(path.rstrip('/'))
+            literals.extend([b'https:' + prefix, b'http:' + prefix, prefix])
+        self.literals = literals
+        self.suffix = b'(?![\\w.:-])'
+        self.max_length = max(len(literal) for literal in literals)
+
+    def applies_to(self, uri, content_type):
+        if self.literals is None and self.source is None:
+            return False
+        paths = self.paths
+        if len(paths) > 0 and not any(does_url_match_pattern(uri, p) for p in paths):
+            return False
+        content_types = self.content_types
+        if len(content_types) > 0:
+            if content_type is None:
+                return False
+            if not any(fnmatch.fnmatchcase(content_type, ct) for ct in content_types):
+                return False
+        return True
+
+
+_group_ref = re.compile(br'\\\\|\\(?:(\d+)|g<(\d+)>)')
+
+def _renumber(template, offset):
+    """
+    Shift the numbered group references in a replacement template by
+    `offset`.
+    """
+
+    def _shift(m):
+        number = m.group(1) or m.group(2)
+        if number is None:
+            return m.group()
+        return b'\\g<' + str(int(number) + offset).encode('ascii') + b'>'
+
+    return _group_ref.sub(_shift, template)
+
+
+def _trie_pattern(terminals):
+    """
+    Returns a regular expression matching any of the `terminals`, which are
+    (literal, suffix, group name) tuples, as a trie.  Each terminal ends
+    with an empty group, so the group that matched last names the
+    terminal.  Longer literals win over their prefixes, and of equal
+    literals, the first wins.
+    """
+    trie = {}
+    for literal, suffix, name in terminals:
+        node = trie
+        for byte in _iterbytes(literal):
+            node = node.setdefault(byte, {})
+        node.setdefault(None, suffix + b'(?P<' + name.encode('ascii') + b'>)')
+    return _node_pattern(trie)
+
+
+def _node_pattern(node):
+    prefix = []
+    while len(node) == 1 and None not in node:
+        byte, node = list(node.items())[0]
+        prefix.append(byte)
+    branches = [
+        re.escape(byte) + _node_pattern(node[byte])
+        for byte in sorted(key for key in node if key is not None)]
+    if None in node:
+        branches.append(node[None])
+    if len(branches) == 1:
+        tail = branches[0]
+    else:
+        tail = b'(?:' + b'|'.join(branches) + b')'
+    return re.escape(b''.join(prefix)) + tail
+
+
+class Rewriter(object):
+    """
+    Applies `rules` in one pass, using a single regular expression that
+    matches any of them.  Literal rules (including `backend_urls`) are
+    combined into a trie, so when there are no regex rules, positions
+    that cannot start a match are skipped quickly.
+
+    Where matches overlap, the leftmost wins.  Of matches at the same
+    position, literal rules win over regex rules, longer literals win over
+    shorter ones, and otherwise the earliest rule wins.  Rewritten text is
+    not matched again.
+
+    Patterns of `regex` rules should not use numbered backreferences,
+    since the rules' groups are renumbered when they are combined.
+    """
+
+    def __init__(self, rules):
+        self.rules = rules
+        names = {}
+        terminals = []
+        for rule in rules:
+            for literal in rule.literals or []:
+                name = '_t{0}'.format(len(terminals))
+                terminals.append((literal, rule.suffix, name))
+                names[name] = rule
+        parts = []
+        if len(terminals) > 0:
+            parts.append(_trie_pattern(terminals))
+        for n, rule in enumerate(rules):
+            if rule.source is not None:
+                name = '_r{0}'.format(n)
+                parts.append(
+                    b'(?P<' + name.encode('ascii') + b'>' + rule.source + b')')
+                names[name] = rule
+        self.pattern = re.compile(b'|'.join(parts))
+        # Group number => (kind, replacement).
+        actions = {}
+        for name, group in self.pattern.groupindex.items():
+            rule = names.get(name, None)
+            if rule is None:
+                continue
+            replacement = rule.replacement
+            if rule.kind == 'regex':
+                replacement = _renumber(replacement, group)
+            actions[group] = (rule.kind, replacement)
+        self._actions = actions
+        self.max_length = max(rule.max_length for rule in rules)
+
+    def _replacer(self, proxy_base):
+        actions = self._actions
+
+        def _replace(m):
+            kind, replacement = actions[m.lastindex]
+            if kind == 'literal':
+                return replacement
+            if kind == 'backend_urls':
+                return proxy_base
+            return m.expand(replacement)
+
+        return _replace
+
+    def rewrite(self, content, proxy_base=b''):
+        return self.pattern.sub(self._replacer(proxy_base), content)
+
+    def stream(self, proxy_base=b''):
+        return RewriteStream(self, proxy_base)
+
+
+class RewriteStream(object):
+    """
+    Rewrites content delivered in chunks.  The last `max_length` bytes
+    of the content seen so far are held back, so matches that span
+    chunks are found, and as many bytes before them are kept for
+    lookbehind assertions.  The output is the same as `Rewriter.rewrite()`
+    for the whole content.
+    """
+
+    def __init__(self, rewriter, proxy_base=b''):
+        self.rewriter = rewriter
+        self.proxy_base = proxy_base
+        self._replace = rewriter._replacer(proxy_base)
+        # Bytes already rewritten, then bytes not yet rewritten.
+        self._context = b''
+        self._pending = b''
+
+    def feed(self, chunk):
+        """
+        Returns the rewritten content that is now complete.
+        """
+        max_length = self.rewriter.max_length
+        context = self._context
+        data = context + self._pending + chunk
+        start = len(context)
+        safe = len(data) - max_length
+        if safe <= start:
+            self._pending = data[start:]
+            return b''
+        replace = self._replace
+        parts = []
+        pos = start
+        for m in self.rewriter.pattern.finditer(data, start):
+            if m.start() >= safe:
+                break
+            parts.append(data[pos:m.start()])
+            parts.append(replace(m))
+            pos = m.end()
+        end = max(pos, safe)
+        parts.append(data[pos:end])
+        self._context = data[max(0, end - max_length):end]
+        self._pending = data[end:]
+        return b''.join(parts)
+
+    def close(self):
+        """
+        Returns the rest of the rewritten content.
+        """
+        context = self._context
+        data = context + self._pending
+        self._context = b''
+        self._pending = b''
+        parts = []
+        pos = len(context)
+        for m in self.rewriter.pattern.finditer(data, pos):
+            parts.append(data[pos:m.start()])
+            parts.append(self._replace(m))
+            pos = m.end()
+        parts.append(data[pos:])
+        return b''.join(parts)
+
+
+def load_rules(config):
+    with open(config, "r") as f:
+        doc = safe_load(f)
+    if not isinstance(doc, dict) or not isinstance(doc.get('rules', None), list):
+        raise ValueError("Rewrite rules file '{0}' must contain a `rules` list.".format(config))
+    return [RewriteRule(info) for info in doc['rules']]
+
+
+@implementer(IRProxyInfoAcceptor, IResponseContentModifier)
+class RewritePlugin(object):
+    proxy_fqdn = None
+    proxy_port = 443
+    proxied_scheme = 'http'
+    proxied_netloc = '127.0.0.1:8443'
+    proxied_path = '/'
+    proxied_upstreams = ()
+    expire_session = lambda self, uid: None
+
+    mod_sequence = 5
+    mod_cacheable = True
+    mod_thread_safe = True
+
+    def __init__(self, config):
+        self.config = config
+        self.rules = load_rules(config)
+        self.mod_cache_key = (config, os.stat(config).st_mtime)
+        # Rewriters are built on demand, possibly in offload threads.
+        self._rewriters = {}
+        self._rewriters_lock = threading.Lock()
+
+    def handle_rproxy_info_set(self):
+        backends = self.proxied_upstreams
+        if len(backends) == 0:
+            backends = [(self.proxied_netloc, self.proxied_path)]
+        with self._rewriters_lock:
+            for rule in self.rules:
+                rule.set_backends(backends)
+            self._rewriters = {}
+
+    def rewriter_for(self, uri, content_type):
+        """
+        Returns the rewriter for the rules that apply to a response, or
+        None if no rules apply.
+        """
+        applicable = tuple(
+            n for n, rule in enumerate(self.rules) if rule.applies_to(uri, content_type))
+        if len(applicable) == 0:
+            return None
+        rewriter = self._rewriters.get(applicable, None)
+        if rewriter is None:
+            with self._rewriters_lock:
+                rewriters = self._rewriters
+                rewriter = rewriters.get(applicable, None)
+                if rewriter is None:
+                    rewriter = Rewriter([self.rules[n] for n in applicable])
+                    rewriters[applicable] = rewriter
+        return rewriter
+
+    def proxy_base(self, request):
+        if request.isSecure():
+            scheme = 'https'
+        else:
+            scheme = 'http'
+        port = self.proxy_port
+        if (scheme, port) in (('https', 443), ('http', 80)):
+            netloc = self.proxy_fqdn
+        else:
+            netloc = "{0}:{1}".format(self.proxy_fqdn, port)
+        return "{0}://{1}".format(scheme, netloc).encode('utf-8')
+
+    def transform_content(self, content, request):
+        """
+        Transform `content`
+        """
+        content_type = None
+        values = request.responseHeaders.getRawHeaders(b'Content-Type')
+        if values is not None:
+            content_type = values[0].split(b';', 1)[0].strip().lower().decode('latin-1')
+        rewriter = self.rewriter_for(request.uri.decode(), content_type)
+        if rewriter is None:
+            return content
+        return rewriter.rewrite(content, self.proxy_base(request))
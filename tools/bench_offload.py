@@ -0,0 +1,103 @@
+#! /usr/bin/env python
+
+# Standard library
+import argparse
+import os.path
+import re
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# External modules
+from twisted.internet import defer, reactor, task
+
+# Application modules
+from txcasproxy.lag import LagMonitor
+from txcasproxy.offload import ContentOffloader
+from txcasproxy.stats import Stats
+
+URL_RE = re.compile(br'https?://backend\.example\.org(:\d+)?/')
+
+
+def rewrite(content, proxy_host):
+    """
+    A CPU bound transformation, similar to rewriting proxied URLs in a
+    large script.
+    """
+    content = content.replace(b'/grouper/', b'/')
+    content = URL_RE.sub(b'https://' + proxy_host + b'/', content)
+    content = content.replace(b'backend.example.org', proxy_host)
+    return content
+
+
+class RewritePlugin(object):
+    mod_sequence = 1
+
+    def __init__(self, mode):
+        self.mod_offload = mode
+
+    def transform_content(self, content, request):
+        return rewrite(content, b'proxy.example.org')
+
+    def transform_task(self, content, request):
+        return (rewrite, (b'proxy.example.org',))
+
+
+def make_body(size):
+    line = b'var u = "https://backend.example.org:8443/grouper/app/x.js"; // padding\n'
+    return line * (size // len(line) + 1)
+
+
+@defer.inlineCallbacks
+def run_mode(mode, body, count, concurrency, offloader):
+    stats = Stats()
+    monitor = LagMonitor(reactor, interval=0.005, stats=stats)
+    monitor.start()
+    plugin = RewritePlugin(mode)
+    started = reactor.seconds()
+    sem = defer.DeferredSemaphore(concurrency)
+    yield defer.gatherResults([
+        sem.run(defer.maybeDeferred, offloader.transform, body, plugin, None)
+        for n in range(count)])
+    elapsed = reactor.seconds() - started
+    # Let the monitor record the last delay.
+    yield task.deferLater(reactor, 0.02, lambda: None)
+    monitor.stop()
+    lag = stats.snapshot()['timings']['reactor.lag']
+    print("{0:<8} {1:8.2f} s total {2:8.1f} {3:8.1f} {4:8.1f} ms lag p50/p99/max".format(
+        mode, elapsed, lag['p50'] * 1000, lag['p99'] * 1000, lag['max'] * 1000))
+
+
+@defer.inlineCallbacks
+def main(args):
+    body = make_body(args.size)
+    offloader = ContentOffloader(
+        reactor, threads=args.threads, processes=args.processes, threshold=0)
+    print("body_bytes={0} transforms={1} concurrency={2}".format(
+        len(body), args.count, args.concurrency))
+    if args.processes > 0:
+        # Start the worker processes before timing.
+        yield offloader.in_process(rewrite, b'', b'')
+    for mode in ('reactor', 'thread', 'process'):
+        yield run_mode(mode, body, args.count, args.concurrency, offloader)
+    reactor.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=(
+            "Measure reactor lag while content modifiers run in the reactor "
+            "thread, a thread pool, or a process pool."))
+    parser.add_argument(
+        "-s", "--size", type=int, default=4 * 1024 * 1024, help="Response body bytes.")
+    parser.add_argument(
+        "-n", "--count", type=int, default=20, help="Transformations per mode.")
+    parser.add_argument(
+        "-c", "--concurrency", type=int, default=4, help="Transformations at once.")
+    parser.add_argument(
+        "-t", "--threads", type=int, default=4, help="Offload threads.")
+    parser.add_argument(
+        "-p", "--processes", type=int, default=4, help="Offload processes.")
+    args = parser.parse_args()
+    reactor.callWhenRunning(main, args)
+    reactor.run()
@@ -0,0 +1,117 @@
+#! /usr/bin/env python
+
+# Standard library
+import argparse
+import os.path
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# Application modules
+from contrib.rewrite.rewrite_plugin import Rewriter, RewriteRule
+
+BACKEND = b'backend.example.org:8443'
+PROXY_BASE = b'https://proxy.example.org:443'
+SERVLET = b'/grouper/grouperExternal/public/OwaspJavaScriptServlet'
+
+
+def extra_literals(count):
+    """
+    Literals that do not occur in the body, as for other proxied apps.
+    """
+    return [
+        (b'/app' + str(n).encode('ascii') + b'/static/', b'/static/')
+        for n in range(count)]
+
+
+def replace_chain(content, extra):
+    """
+    The sequential replacements made by `GrouperPlugin.csrf_js_hack()`,
+    followed by one more for each `extra` literal.
+    """
+    content = content.replace(b'https://' + BACKEND, PROXY_BASE)
+    content = content.replace(b'part = "/grouper/" + url;', b'part = "/" + url;')
+    content = content.replace(SERVLET, SERVLET[len(b'/grouper'):])
+    for literal, replacement in extra:
+        content = content.replace(literal, replacement)
+    return content
+
+
+def make_rewriter(extra):
+    backend_urls = RewriteRule({'backend_urls': True})
+    backend_urls.set_backend(BACKEND.decode('ascii'), '/')
+    rules = [
+        backend_urls,
+        RewriteRule({
+            'literal': 'part = "/grouper/" + url;',
+            'replacement': 'part = "/" + url;'}),
+        RewriteRule({
+            'literal': SERVLET,
+            'replacement': SERVLET[len(b'/grouper'):]}),
+    ]
+    for literal, replacement in extra:
+        rules.append(RewriteRule({'literal': literal, 'replacement': replacement}))
+    return Rewriter(rules)
+
+
+def make_body(size):
+    lines = [
+        b'var u = "https://' + BACKEND + b'/grouper/app/x.js";\n',
+        b'    part = "/grouper/" + url;\n',
+        b'    xhr.open("POST", "' + SERVLET + b'");\n',
+        b'    for (var i = 0; i < n; i++) { total += values[i] * weights[i]; }\n',
+        b'    // Nothing to rewrite on this line or the next two.\n',
+        b'    if (typeof window.console !== "undefined") { log(total); }\n',
+        b'    return total;\n',
+    ]
+    block = b''.join(lines)
+    return block * (size // len(block) + 1)
+
+
+def rewrite_stream(rewriter, content, chunk_size):
+    stream = rewriter.stream(PROXY_BASE)
+    parts = [
+        stream.feed(content[n:n + chunk_size])
+        for n in range(0, len(content), chunk_size)]
+    parts.append(stream.close())
+    return b''.join(parts)
+
+
+def main(args):
+    body = make_body(args.size)
+    extra = extra_literals(args.extra)
+    rewriter = make_rewriter(extra)
+    expected = replace_chain(body, extra)
+    results = [
+        ('replace', lambda: replace_chain(body, extra)),
+        ('single', lambda: rewriter.rewrite(body, PROXY_BASE)),
+        ('stream', lambda: rewrite_stream(rewriter, body, args.chunk)),
+    ]
+    print("body_bytes={0} rules={1} chunk_bytes={2} repeat={3}".format(
+        len(body), len(rewriter.rules), args.chunk, args.repeat))
+    for name, f in results:
+        if f() != expected:
+            print("{0:<8} output differs from the replace chain".format(name))
+            return 1
+        elapsed = min(timeit.repeat(f, number=1, repeat=args.repeat))
+        print("{0:<8} {1:8.1f} ms {2:8.1f} MB/s".format(
+            name, elapsed * 1000, len(body) / elapsed / 1e6))
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=(
+            "Compare a chain of str.replace() calls with the rewrite "
+            "plugin's single pass over a large script."))
+    parser.add_argument(
+        "-s", "--size", type=int, default=4 * 1024 * 1024, help="Response body bytes.")
+    parser.add_argument(
+        "-c", "--chunk", type=int, default=65536, help="Chunk bytes for streaming.")
+    parser.add_argument(
+        "-e", "--extra", type=int, default=0, help="Extra literal rules.")
+    parser.add_argument(
+        "-r", "--repeat", type=int, default=5, help="Timing runs per method.")
+    args = parser.parse_args()
+    sys.exit(main(args))
@@ -0,0 +1,92 @@
+#! /usr/bin/env python
+
+# Standard library
+import argparse
+import json
+import os.path
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# External modules
+from lxml import etree
+
+# Application modules
+from txcasproxy.cas_response import CAS_NS, parse_json_response, parse_xml_response
+
+
+def make_attributes(groups):
+    attributes = {
+        'mail': ['someone@example.org'],
+        'displayName': ['Some One'],
+        'memberOf': [
+            "cn=group{0},ou=groups,dc=example,dc=org".format(n) for n in range(groups)],
+    }
+    return attributes
+
+def make_xml_payload(attributes):
+    parts = [
+        '<cas:serviceResponse xmlns:cas="{0}">'.format(CAS_NS),
+        '<cas:authenticationSuccess>',
+        '<cas:user>someone</cas:user>',
+        '<cas:attributes>']
+    for name, values in attributes.items():
+        for value in values:
+            parts.append('<cas:{0}>{1}</cas:{0}>'.format(name, value))
+    parts.extend([
+        '</cas:attributes>',
+        '</cas:authenticationSuccess>',
+        '</cas:serviceResponse>'])
+    return ''.join(parts).encode('utf-8')
+
+def make_json_payload(attributes):
+    doc = {'serviceResponse': {'authenticationSuccess': {
+        'user': 'someone',
+        'attributes': attributes}}}
+    return json.dumps(doc).encode('utf-8')
+
+def parse_xml_findall(payload):
+    """
+    The tree walk used before XPath expressions were precompiled.
+    """
+    ns = "{%s}" % CAS_NS
+    root = etree.fromstring(payload)
+    success = root.findall("{0}authenticationSuccess".format(ns))[0]
+    username = success.findall("{0}user".format(ns))[0].text
+    attrib_map = {}
+    for attrib_container in success.findall("{0}attributes".format(ns)):
+        for elm in attrib_container.findall('./*'):
+            tag_name = elm.tag[len(ns):]
+            attrib_map.setdefault(tag_name, []).append(elm.text)
+    return (username, attrib_map)
+
+def main(args):
+    attributes = make_attributes(args.groups)
+    xml_payload = make_xml_payload(attributes)
+    json_payload = make_json_payload(attributes)
+    assert parse_xml_findall(xml_payload) == parse_xml_response(xml_payload)[:2]
+    assert parse_json_response(json_payload) == parse_xml_response(xml_payload)
+    cases = [
+        ('xml findall', parse_xml_findall, xml_payload),
+        ('xml xpath', parse_xml_response, xml_payload),
+        ('json', parse_json_response, json_payload),
+    ]
+    print("groups={0} xml_bytes={1} json_bytes={2}".format(
+        args.groups, len(xml_payload), len(json_payload)))
+    for label, parser, payload in cases:
+        timer = timeit.Timer(lambda: parser(payload))
+        best = min(timer.repeat(repeat=args.repeat, number=args.number))
+        print("{0:<12} {1:10.1f} usec/parse".format(label, best / args.number * 1e6))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark CAS ticket validation response parsing.")
+    parser.add_argument(
+        "-g", "--groups", type=int, default=500, help="Group memberships per user.")
+    parser.add_argument(
+        "-n", "--number", type=int, default=200, help="Parses per timing run.")
+    parser.add_argument(
+        "-r", "--repeat", type=int, default=5, help="Timing runs (best is reported).")
+    args = parser.parse_args()
+    main(args)
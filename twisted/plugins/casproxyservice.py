@@ -3,8 +3,12 @@
 from __future__ import print_function
 import sys
 # Application modules
+from txcasproxy.attribute_headers import parse_attribute_header
 from txcasproxy.interfaces import IRProxyPluginFactory
+from txcasproxy.ratelimit import parse_rate_limit_rule
+from txcasproxy.routing import load_routes
 from txcasproxy.service import ProxyService
+from txcasproxy.timeouts import parse_timeout_rule
 # External modules
 from twisted.application.service import IServiceMaker
 from twisted.plugin import getPlugins, IPlugin
@@ -36,12 +40,40 @@ def get_tag(plugin_str):
     parts = plugin_str.split(':', 1)
     return parts[0]
 
+def generate_plugins(factories, plugin_args):
+    """
+    Create plugins from `tag:args` strings.
+    """
+    plugin_opts = {}
+    for plugin_arg in plugin_args:
+        parts = plugin_arg.split(':', 1)
+        name = parts[0]
+        if len(parts) > 1:
+            args = parts[1]
+        else:
+            args = ''
+        plugin_opts.setdefault(name, []).append(args)
+    plugins = []
+    for factory in factories:
+        tag = factory.tag
+        if tag in plugin_opts:
+            arglst = plugin_opts[tag]
+            for argstr in arglst:
+                plugin = factory.generatePlugin(argstr)
+                plugins.append(plugin)
+    return plugins
+
+
 class Options(usage.Options):
     optFlags = [
             ["help-plugins", None, "Help about available plugins."],
             ["debug", 'd', "Errors served as HTML."],
             ["verbose", 'v', "Verbose logging."],
             ["logout-passthrough", None, "Pass the logout request through to backend service prior to intercepting and redirecting."],
+            ["upstream-affinity", None, "Keep each session on the same upstream."],
+            ["offload-templates", None, "Render error page templates in the offload thread pool."],
+            ["static-immutable", None, "Mark static files immutable, so browsers do not revalidate them."],
+            ["template-no-reload", None, "Do not check template files for changes."],
         ]
 
     optParameters = [
@@ -50,6 +82,7 @@ class Options(usage.Options):
                         ["cas-login", "c", None, "The CAS /login URL."],
                         ["cas-service-validate", "s", None, "The CAS /serviceValidate URL."],
                         ["cas-logout", "l", None, "The CAS /logout URL.  Requires `logout` option to be set."],
+                        ["cas-proxy", None, None, "The CAS /proxy URL."],
                         ["header", "H", "REMOTE_USER", "The name of the header in which to pass the authenticated user ID."],
                         ["fqdn", None, None, 
                             "Explicitly specify the FQDN that should be included in URL callbacks."],
@@ -59,9 +92,107 @@ class Options(usage.Options):
                         ["help-plugin", None, None, "Help or a specific plugin."],
                         ["template-dir", "t", None, "Folder containing templates."],
                         ["template-resource", "T", "/_templates", "Base resource for templates."],
+                        ["template-bytecode-dir", None, None, 
+                            "Folder in which to keep compiled templates between restarts."],
                         ["session-length", "S", 900, "Session length in seconds."],
                         ["proxy-client-endpoint", "P", None, "An endpoint connection string for the proxy web client."],
                         ["cas-client-endpoint", "C", None, "An endpoint connection string for the back channel CAS web client."],
+                        ["cas-validate-format", None, "XML", 
+                            "CAS ticket validation response format (XML or JSON).  "
+                            "JSON requires a CAS 3.0 /p3/serviceValidate URL."],
+                        ["cas-timeout", None, 10, "Seconds to wait for a CAS ticket validation response."],
+                        ["cas-max-concurrent", None, 20, "Maximum concurrent CAS ticket validation requests."],
+                        ["cas-max-queued", None, 100, "Maximum ticket validations waiting for a free slot."],
+                        ["cas-breaker-failures", None, 5, 
+                            "Consecutive CAS validation failures that open the circuit breaker."],
+                        ["cas-breaker-reset", None, 30, 
+                            "Seconds the circuit breaker stays open before retrying CAS."],
+                        ["cas-rejected-ticket-ttl", None, 300, 
+                            "Seconds to remember tickets that CAS rejected."],
+                        ["pgt-callback-resource", None, None, 
+                            "Resource on the main site that receives proxy-granting tickets from CAS.  "
+                            "Enables proxy-granting ticket requests."],
+                        ["proxy-ticket-resource", None, "/_proxyTicket", 
+                            "Resource on the main site that provides proxy tickets."],
+                        ["proxy-ticket-ttl", None, 5, "Seconds to reuse a proxy ticket for a target service."],
+                        ["slo-resource", None, None, 
+                            "Resource on the main site that receives CAS single logout requests."],
+                        ["slo-peer-port", None, None, 
+                            "UDP port on which to exchange single logout notices with peer instances."],
+                        ["slo-peer-interface", None, "", "Interface for the single logout peer port."],
+                        ["slo-peer-secret-file", None, None, 
+                            "File containing the secret shared by single logout peers."],
+                        ["ac-timeout", None, 10, 
+                            "Seconds to wait for an access control plugin's decision."],
+                        ["ac-threads", None, 10, 
+                            "Maximum threads for blocking access control plugins."],
+                        ["admin-endpoint", None, None, "Endpoint for the local administration service."],
+                        ["routes", None, None, 
+                            "YAML file that maps path prefixes to additional proxied applications."],
+                        ["upstream-balance", None, "least-outstanding", 
+                            "How to choose an upstream: least-outstanding or ewma."],
+                        ["upstream-eject-failures", None, 3, 
+                            "Consecutive connection errors that eject an upstream."],
+                        ["upstream-eject-time", None, 30, "Seconds an ejected upstream is not used."],
+                        ["upstream-health-interval", None, 10, 
+                            "Seconds between upstream health checks.  0 disables health checks."],
+                        ["upstream-health-path", None, "/", 
+                            "Path, relative to each upstream URL, requested by health checks."],
+                        ["upstream-retries", None, 0, 
+                            "Times to retry a GET or HEAD request on another upstream after a connection error."],
+                        ["upstream-hedge-delay", None, 0, 
+                            "Seconds before a slow GET or HEAD request is also sent to another upstream.  "
+                            "0 disables hedged requests."],
+                        ["upstream-retry-budget", None, 0.1, 
+                            "Retries and hedged requests allowed per upstream request."],
+                        ["upstream-connect-timeout", None, 10, 
+                            "Seconds to wait for a connection to an upstream.  0 disables the timeout."],
+                        ["upstream-ttfb-timeout", None, 60, 
+                            "Seconds to wait for an upstream's response headers.  0 disables the timeout."],
+                        ["upstream-total-timeout", None, 300, 
+                            "Seconds to wait for an upstream's complete response.  0 disables the timeout."],
+                        ["rate-limit", None, 0, 
+                            "Proxied requests per second allowed for each user (or client IP for "
+                            "unprotected resources).  0 disables rate limiting."],
+                        ["rate-limit-burst", None, 20, 
+                            "Proxied requests each user may make in a burst above the rate limit."],
+                        ["user-max-concurrent", None, 0, 
+                            "Proxied requests each user may have in progress.  0 disables the limit."],
+                        ["lag-interval", None, 0.1, 
+                            "Seconds between reactor lag measurements.  0 disables the lag monitor."],
+                        ["lag-threshold", None, 0, 
+                            "Reactor lag in seconds above which new unauthenticated and low priority "
+                            "requests are refused.  0 disables load shedding."],
+                        ["offload-threads", None, 4, 
+                            "Threads for content modifiers and template rendering.  0 disables."],
+                        ["offload-processes", None, 0, 
+                            "Processes for content modifiers that request a process pool.  0 disables."],
+                        ["offload-queue", None, 100, 
+                            "Tasks that may wait for an offload thread or process."],
+                        ["offload-threshold", None, 262144, 
+                            "Response body size in bytes above which content modifiers run in the "
+                            "thread pool.  0 disables."],
+                        ["transform-cache-size", None, 67108864, 
+                            "Bytes of modified response content to cache.  0 disables the cache."],
+                        ["static-memory", None, 33554432, 
+                            "Bytes of small static files (and their compressed variants) to hold "
+                            "in memory for each static directory."],
+                        ["static-max-age", None, 300, 
+                            "Seconds browsers may cache static files.  0 makes them revalidate."],
+                        ["pool-connections", None, 2, 
+                            "Persistent connections to open to the proxied site and to CAS at startup."],
+                        ["pool-probe-interval", None, 30, 
+                            "Seconds between probes of persistent upstream connections.  0 disables probes."],
+                        ["pool-idle-timeout", None, 240, 
+                            "Seconds before an idle persistent upstream connection is closed."],
+                        ["tls-session-timeout", None, 300, 
+                            "Seconds a TLS session may be resumed (`ssl:` endpoints only)."],
+                        ["tls-ticket-rotation", None, 3600, 
+                            "Seconds between TLS session ticket key rotations.  0 disables rotation."],
+                        ["tls-curves", None, None, 
+                            "Colon-separated ECDHE curves in order of preference (e.g. X25519:P-256)."],
+                        ["tls-ciphers", None, None, 
+                            "OpenSSL cipher list (TLS 1.2 and earlier) in order of preference."],
                     ]
 
     def __init__(self):
@@ -72,6 +203,12 @@ class Options(usage.Options):
         self.valid_plugins = set([])
         self['excluded-resources'] = set([])
         self['excluded-branches'] = set([])
+        self['slo-peers'] = []
+        self['attribute-headers'] = []
+        self['upstreams'] = []
+        self['timeout-rules'] = []
+        self['rate-limit-rules'] = []
+        self['shed-patterns'] = []
         for factory in getPlugins(IRProxyPluginFactory):
             if hasattr(factory, 'tag'):
                 self.valid_plugins.add(factory.tag)
@@ -108,6 +245,56 @@ class Options(usage.Options):
         """
         self['excluded-branches'].add(branch)
 
+    def opt_sloPeer(self, peer):
+        """
+        Add a peer instance (host:port) that receives single logout notices.
+        """
+        self['slo-peers'].append(peer)
+
+    def opt_attributeHeader(self, spec):
+        """
+        Pass a CAS attribute to the proxied service as a request header.
+        Colon-separated key=value list: attribute, header, separator 
+        (default ','), encoding (url, base64, or raw; default url).
+        """
+        try:
+            self['attribute-headers'].append(parse_attribute_header(spec))
+        except ValueError as ex:
+            raise usage.UsageError(str(ex))
+
+    def opt_upstream(self, url):
+        """
+        Add an upstream base URL equivalent to the proxied URL.
+        """
+        self['upstreams'].append(url)
+
+    def opt_timeoutRule(self, spec):
+        """
+        Override the upstream timeouts for matching requests.
+        Colon-separated key=value list: pattern (required), ttfb, total.
+        """
+        try:
+            self['timeout-rules'].append(parse_timeout_rule(spec))
+        except ValueError as ex:
+            raise usage.UsageError(str(ex))
+
+    def opt_rateLimitRule(self, spec):
+        """
+        Override the per-user limits for matching requests.
+        Colon-separated key=value list: pattern (required), rate, burst, 
+        concurrent.
+        """
+        try:
+            self['rate-limit-rules'].append(parse_rate_limit_rule(spec))
+        except ValueError as ex:
+            raise usage.UsageError(str(ex))
+
+    def opt_shed(self, pattern):
+        """
+        Add a low priority resource pattern, refused while the reactor lags.
+        """
+        self['shed-patterns'].append(pattern)
+
     def postOptions(self):
         if self['help-plugins'] or self['help-plugin'] is not None:
             return
@@ -125,8 +312,14 @@ class Options(usage.Options):
             self['cas-service-validate'] = serviceValidate
             del parts
             del login
+        if self['cas-validate-format'].upper() not in ('XML', 'JSON'):
+            raise usage.UsageError("CAS validation format must be XML or JSON.")
         bad_tags = [get_tag(plugin_str) for plugin_str in self['plugins'] 
                         if get_tag(plugin_str) not in self.valid_plugins]
+        if self['slo-peer-port'] is not None and self['slo-peer-secret-file'] is None:
+            raise usage.UsageError("Option `slo-peer-port` requires `slo-peer-secret-file`.")
+        if self['upstream-balance'] not in ('least-outstanding', 'ewma'):
+            raise usage.UsageError("Upstream balance must be least-outstanding or ewma.")
         if len(bad_tags) > 0:
             bad_tags.sort()
             msg = "The following plugins are not valid: {0}.".format(
@@ -158,26 +351,66 @@ class MyServiceMaker(object):
         cas_info = dict(
             login_url=options['cas-login'],
             service_validate_url=options['cas-service-validate'],
-            logout_url=options['cas-logout'])
+            logout_url=options['cas-logout'],
+            proxy_url=options['cas-proxy'],
+            proxy_ticket_ttl=options['proxy-ticket-ttl'],
+            validate_format=options['cas-validate-format'],
+            validate_timeout=options['cas-timeout'],
+            max_concurrent=options['cas-max-concurrent'],
+            max_queued=options['cas-max-queued'],
+            breaker_failures=options['cas-breaker-failures'],
+            breaker_reset=options['cas-breaker-reset'],
+            rejected_ticket_ttl=options['cas-rejected-ticket-ttl'])
+        upstream_info = dict(
+            urls=options['upstreams'],
+            balance=options['upstream-balance'],
+            affinity=options['upstream-affinity'],
+            eject_failures=options['upstream-eject-failures'],
+            eject_time=options['upstream-eject-time'],
+            health_interval=options['upstream-health-interval'],
+            health_path=options['upstream-health-path'],
+            retries=options['upstream-retries'],
+            hedge_delay=options['upstream-hedge-delay'],
+            retry_budget=options['upstream-retry-budget'],
+            connect_timeout=options['upstream-connect-timeout'],
+            ttfb_timeout=options['upstream-ttfb-timeout'],
+            total_timeout=options['upstream-total-timeout'],
+            timeout_rules=options['timeout-rules'])
+        rate_limit_info = dict(
+            rate=options['rate-limit'],
+            burst=options['rate-limit-burst'],
+            concurrent=options['user-max-concurrent'],
+            rules=options['rate-limit-rules'])
+        offload_info = dict(
+            threads=options['offload-threads'],
+            processes=options['offload-processes'],
+            max_queued=options['offload-queue'],
+            threshold=options['offload-threshold'],
+            templates=options['offload-templates'],
+            transform_cache_size=options['transform-cache-size'])
+        static_info = dict(
+            memory=options['static-memory'],
+            max_age=options['static-max-age'],
+            immutable=options['static-immutable'])
         fqdn = options.get('fqdn', None)
         # Load plugins.
-        plugin_opts = {}
-        for plugin_arg in options['plugins']:
-            parts = plugin_arg.split(':', 1)
-            name = parts[0]
-            if len(parts) > 1:
-                args = parts[1]
-            else:
-                args = ''
-            plugin_opts.setdefault(name, []).append(args)
-        plugins = []
-        for factory in factories:
-            tag = factory.tag
-            if tag in plugin_opts:
-                arglst = plugin_opts[tag]
-                for argstr in arglst:
-                    plugin = factory.generatePlugin(argstr)
-                    plugins.append(plugin)
+        plugins = generate_plugins(factories, options['plugins'])
+        routes = []
+        if options['routes'] is not None:
+            try:
+                routes = load_routes(options['routes'])
+            except ValueError as ex:
+                print(str(ex), file=sys.stderr)
+                sys.exit(1)
+            valid_tags = set(factory.tag for factory in factories)
+            for route in routes:
+                bad_tags = [get_tag(plugin_str) for plugin_str in route['plugins']
+                                if get_tag(plugin_str) not in valid_tags]
+                if len(bad_tags) > 0:
+                    print("Route '{0}' has invalid plugins: {1}.".format(
+                        route['prefix'], ', '.join(sorted(bad_tags))), file=sys.stderr)
+                    sys.exit(1)
+                route['plugins'] = generate_plugins(factories, route['plugins'])
         auth_info_endpoint_s = options['auth-info-endpoint']
         auth_info_resource = options['auth-info-resource'] 
         excluded_resources = options['excluded-resources']
@@ -187,16 +420,41 @@ class MyServiceMaker(object):
         if cas_logout is not None and len(logouts) == 0:
             print("Option `logout` required for option `cas-logout`.", file=sys.stderr)
             sys.exit(1)
+        slo_peer_secret = None
+        if options['slo-peer-secret-file'] is not None:
+            with open(options['slo-peer-secret-file'], "rb") as f:
+                slo_peer_secret = f.read().strip()
         # Create the service.
         return ProxyService(
             endpoint_s=options['endpoint'], 
             proxied_url=options['proxied-url'],
             cas_info=cas_info,
+            upstream_info=upstream_info,
+            routes=routes,
+            rate_limit_info=rate_limit_info,
+            lag_interval=options['lag-interval'],
+            lag_threshold=options['lag-threshold'],
+            shed_patterns=options['shed-patterns'],
+            offload_info=offload_info,
+            static_info=static_info,
             fqdn=fqdn,
             authorities=options['authorities'],
             plugins=plugins,
             auth_info_endpoint_s=auth_info_endpoint_s,
             auth_info_resource=auth_info_resource,
+            pgt_callback_resource=options['pgt-callback-resource'],
+            proxy_ticket_resource=options['proxy-ticket-resource'],
+            slo_resource=options['slo-resource'],
+            slo_peers=options['slo-peers'],
+            slo_peer_port=options['slo-peer-port'],
+            slo_peer_interface=options['slo-peer-interface'],
+            slo_peer_secret=slo_peer_secret,
+            access_control_timeout=options['ac-timeout'],
+            access_control_threads=options['ac-threads'],
+            attribute_headers=options['attribute-headers'],
+            pool_connections=options['pool-connections'],
+            pool_probe_interval=options['pool-probe-interval'],
+            pool_idle_timeout=options['pool-idle-timeout'],
             excluded_resources=excluded_resources,
             excluded_branches=excluded_branches,
             remote_user_header=options['header'],
@@ -204,11 +462,18 @@ class MyServiceMaker(object):
             logout_passthrough=options['logout-passthrough'],
             template_dir=options['template-dir'],
             template_resource=options['template-resource'],
+            template_auto_reload=not options['template-no-reload'],
+            template_bytecode_dir=options['template-bytecode-dir'],
             debug=options['debug'],
             verbose=options['verbose'],
             session_length=options['session-length'],
             proxy_client_endpoint_s=options['proxy-client-endpoint'],
-            cas_client_endpoint_s=options['cas-client-endpoint'])
+            cas_client_endpoint_s=options['cas-client-endpoint'],
+            admin_endpoint_s=options['admin-endpoint'],
+            tls_session_timeout=options['tls-session-timeout'],
+            tls_ticket_rotation=options['tls-ticket-rotation'],
+            tls_curves=options['tls-curves'],
+            tls_ciphers=options['tls-ciphers'])
 
 
 # Now construct an object which *provides* the relevant interfaces
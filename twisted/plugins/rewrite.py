@@ -0,0 +1,4 @@
+
+from contrib.rewrite.rewrite_plugin import RewritePluginFactory
+
+factory = RewritePluginFactory()
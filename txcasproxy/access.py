@@ -0,0 +1,122 @@
+
+#----------------------------------------------------------------------
+# Concurrent evaluation of IAccessControl plugins.
+#----------------------------------------------------------------------
+
+from .cache import TTLCache
+from twisted.internet import defer
+from twisted.internet.threads import deferToThreadPool
+from twisted.python import log
+from twisted.python.threadpool import ThreadPool
+
+
+class ThreadedAccessControl(object):
+    """
+    Adapt a blocking IAccessControl plugin so that `isAllowed()` runs in
+    a thread pool and returns a deferred.
+    """
+
+    def __init__(self, original, reactor, threadpool):
+        self.original = original
+        self.reactor = reactor
+        self.threadpool = threadpool
+
+    def __getattr__(self, name):
+        return getattr(self.original, name)
+
+    def isAllowed(self, username, attrib_map):
+        return deferToThreadPool(
+            self.reactor, self.threadpool, self.original.isAllowed, username, attrib_map)
+
+
+class AccessControlEvaluator(object):
+    """
+    Evaluate access control plugins concurrently.
+
+    Each plugin's `isAllowed()` may return (is_allowed, reason) or a
+    deferred that fires with it.  Plugins may define:
+
+    * `ac_timeout`: Seconds to wait for a decision (overrides `timeout`).
+    * `ac_cache_ttl`: Seconds to reuse a decision for the same username.
+    * `ac_blocking`: If True, `isAllowed()` is run in a thread pool.
+
+    A plugin that fails or times out denies access.  When several plugins
+    deny access, the reason from the plugin with the lowest `ac_sequence`
+    is reported.
+    """
+    failure_reason = "Access could not be determined."
+
+    def __init__(self, reactor, plugins, timeout=10, max_threads=10, stats=None):
+        self.reactor = reactor
+        self.timeout = timeout
+        self.stats = stats
+        self._threadpool = None
+        wrapped = []
+        for plugin in plugins:
+            if getattr(plugin, 'ac_blocking', False):
+                plugin = ThreadedAccessControl(
+                    plugin, reactor, self._getThreadPool(max_threads))
+            wrapped.append(plugin)
+        self.plugins = wrapped
+        self._caches = {}
+        for plugin in wrapped:
+            ttl = getattr(plugin, 'ac_cache_ttl', 0)
+            if ttl > 0:
+                self._caches[plugin.tagname] = TTLCache(reactor, ttl)
+
+    def _getThreadPool(self, max_threads):
+        if self._threadpool is None:
+            threadpool = ThreadPool(maxthreads=max_threads, name='access-control')
+            self.reactor.callWhenRunning(threadpool.start)
+            self.reactor.addSystemEventTrigger('during', 'shutdown', threadpool.stop)
+            self._threadpool = threadpool
+        return self._threadpool
+
+    def _check(self, plugin, username, attrib_map):
+        cache = self._caches.get(plugin.tagname, None)
+        if cache is not None:
+            decision = cache.get(username, None)
+            if decision is not None:
+                return defer.succeed(decision)
+        started = self.reactor.seconds()
+        d = defer.maybeDeferred(plugin.isAllowed, username, attrib_map)
+        d.addTimeout(getattr(plugin, 'ac_timeout', self.timeout), self.reactor)
+
+        def _decided(decision):
+            if self.stats is not None:
+                self.stats.record_timing(
+                    'access_control.{0}.latency'.format(plugin.tagname),
+                    self.reactor.seconds() - started)
+            if cache is not None:
+                cache.set(username, decision)
+            return decision
+
+        def _failed(err):
+            if self.stats is not None:
+                self.stats.incr('access_control.{0}.errors'.format(plugin.tagname))
+            log.msg("[INFO] Access control plugin '{0}' failed for user '{1}': {2}".format(
+                plugin.tagname, username, err.getErrorMessage()))
+            return (False, self.failure_reason)
+
+        d.addCallbacks(_decided, _failed)
+        return d
+
+    def evaluate(self, username, attrib_map):
+        """
+        Returns a deferred that fires with (is_allowed, reason, plugin).
+        `plugin` is the plugin that denied access, or None.
+        """
+        plugins = self.plugins
+        if len(plugins) == 0:
+            return defer.succeed((True, None, None))
+        checks = [self._check(plugin, username, attrib_map) for plugin in plugins]
+        d = defer.gatherResults(checks)
+
+        def _combine(decisions):
+            for plugin, (is_allowed, reason) in zip(plugins, decisions):
+                if not is_allowed:
+                    return (False, reason, plugin)
+            return (True, None, None)
+
+        d.addCallback(_combine)
+        return d
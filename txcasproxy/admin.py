@@ -0,0 +1,41 @@
+
+from klein import Klein
+import json
+
+
+class AdminApp():
+    """
+    Local administrative site.  Access should be restricted to operators
+    (e.g. bind it to a loopback interface or UNIX socket).
+    """
+    app = Klein()
+
+    def __init__(self, proxy_app):
+        self.proxy_app = proxy_app
+
+    @app.route("/stats")
+    def stats(self, request):
+        if request.method != b'GET':
+            request.setResponseCode(405)
+            return "Method Not Allowed - 405"
+        snapshot = self.proxy_app.stats.snapshot()
+        request.responseHeaders.setRawHeaders('Content-Type', ['application/json'])
+        return json.dumps(snapshot, sort_keys=True)
+
+    @app.route("/users/<string:username>/sessions")
+    def user_sessions(self, request, username):
+        if request.method != b'GET':
+            request.setResponseCode(405)
+            return "Method Not Allowed - 405"
+        count = len(self.proxy_app.sessions_for_user(username))
+        request.responseHeaders.setRawHeaders('Content-Type', ['application/json'])
+        return json.dumps({'username': username, 'sessions': count})
+
+    @app.route("/users/<string:username>/revoke")
+    def revoke_user(self, request, username):
+        if request.method != b'POST':
+            request.setResponseCode(405)
+            return "Method Not Allowed - 405"
+        count = self.proxy_app.revoke_user(username)
+        request.responseHeaders.setRawHeaders('Content-Type', ['application/json'])
+        return json.dumps({'username': username, 'revoked': count})
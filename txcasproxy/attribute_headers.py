@@ -0,0 +1,104 @@
+
+#----------------------------------------------------------------------
+# Pass CAS attributes to the proxied service as request headers.
+#----------------------------------------------------------------------
+
+import base64
+import shlex
+import string
+from urllib.parse import quote
+
+
+def _encode_raw(value):
+    return value.replace('\r', ' ').replace('\n', ' ')
+
+def _encode_url(value):
+    return quote(value, safe='')
+
+def _encode_base64(value):
+    return base64.b64encode(value.encode('utf-8')).decode('ascii')
+
+def normalize_header_name(name):
+    """
+    Many backends (e.g. CGI and WSGI `HTTP_*` variables) treat '-' and '_'
+    in header names as the same, and ignore case.
+    """
+    if isinstance(name, bytes):
+        name = name.decode('latin-1')
+    return name.lower().replace('_', '-')
+
+encoders = {
+    'raw': _encode_raw,
+    'url': _encode_url,
+    'base64': _encode_base64,
+}
+
+
+class AttributeHeader(object):
+    """
+    Maps a CAS attribute to a request header.  Multiple values are
+    encoded individually and then joined with `separator`.
+    """
+
+    def __init__(self, attribute, header, separator=',', encoding='url'):
+        if encoding not in encoders:
+            raise ValueError("Unknown attribute header encoding '{0}'.".format(encoding))
+        self.attribute = attribute
+        self.header = header
+        self.separator = separator
+        self.encoding = encoding
+        self._encode = encoders[encoding]
+
+    def format(self, values):
+        encode = self._encode
+        return self.separator.join(encode(value) for value in values if value is not None)
+
+
+def parse_attribute_header(spec):
+    """
+    Parse a colon-separated key=value list, e.g.
+    'attribute=memberOf:header=X-Groups:separator=;:encoding=url'.
+    """
+    parser = shlex.shlex(spec, posix=True)
+    parser.wordchars = string.printable
+    parser.whitespace = ':'
+    parser.commenters = ''
+    parser.quotes = ''
+    parser.escapedquotes = ''
+    settings = dict(tuple(token.split('=', 1)) for token in parser)
+    if 'attribute' not in settings or 'header' not in settings:
+        raise ValueError(
+            "Attribute header '{0}' must specify `attribute` and `header`.".format(spec))
+    return AttributeHeader(
+        settings['attribute'],
+        settings['header'],
+        separator=settings.get('separator', ','),
+        encoding=settings.get('encoding', 'url'))
+
+
+class AttributeHeaderMap(object):
+    """
+    Builds the block of identity headers sent upstream for a session.
+    """
+
+    def __init__(self, remote_user_header, attribute_headers=None):
+        if attribute_headers is None:
+            attribute_headers = []
+        self.remote_user_header = remote_user_header
+        self.attribute_headers = attribute_headers
+        names = [remote_user_header] + [h.header for h in attribute_headers]
+        # Client-supplied copies of these headers (by any name that
+        # normalizes the same way) are never passed upstream.
+        self.protected_names = frozenset(normalize_header_name(name) for name in names)
+
+    def is_protected(self, name):
+        return normalize_header_name(name) in self.protected_names
+
+    def build(self, username, attrib_map):
+        headers = {self.remote_user_header: [username]}
+        for attribute_header in self.attribute_headers:
+            values = attrib_map.get(attribute_header.attribute, None)
+            if values is None:
+                continue
+            headers[attribute_header.header] = [attribute_header.format(values)]
+        return headers
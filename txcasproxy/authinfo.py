@@ -1,34 +1,88 @@
 
 from klein import Klein
+from twisted.web import http
 from twisted.web.server import Site
+import hashlib
 import json
 
+
+def serialize(doc):
+    """
+    Serialize `doc` to JSON once.  Returns (body, etag).
+    """
+    body = json.dumps(doc, sort_keys=True).encode('utf-8')
+    etag = '"{0}"'.format(hashlib.sha1(body).hexdigest()).encode('ascii')
+    return (body, etag)
+
+def deliver_json(request, body, etag):
+    """
+    Respond with pre-serialized JSON, or with 304 if the client already
+    has the representation.
+    """
+    request.responseHeaders.setRawHeaders('Content-Type', ['application/json'])
+    request.responseHeaders.setRawHeaders('Cache-Control', ['no-cache'])
+    if request.setETag(etag) == http.CACHED:
+        return b""
+    return body
+
+
 class AuthInfoApp():
     app = Klein()
 
     def __init__(self):
         self.authinfo = {}
+        self._serialized = {}
+
+    @app.route("/")
+    def batch(self, request):
+        """
+        Return the info for several users in one response.  Users are
+        named by repeated `user` query parameters (GET) or a JSON array
+        (POST).  Unknown users are omitted.
+        """
+        if request.method == b'GET':
+            usernames = [value.decode('utf-8') for value in request.args.get(b'user', [])]
+        elif request.method == b'POST':
+            try:
+                usernames = json.loads(request.content.read().decode('utf-8'))
+            except ValueError:
+                usernames = None
+            if not isinstance(usernames, list):
+                request.setResponseCode(400)
+                return "Bad Request - 400"
+        else:
+            request.setResponseCode(404)
+            return "Not Found - 404"
+        serialized = self._serialized
+        parts = []
+        for username in usernames:
+            entry = serialized.get(username, None)
+            if entry is not None:
+                parts.append(json.dumps(username).encode('utf-8') + b':' + entry[0])
+        request.responseHeaders.setRawHeaders('Content-Type', ['application/json'])
+        return b'{' + b','.join(parts) + b'}'
 
     @app.route("/<string:username>")
     def authinfo(self, request, username):
-        if request.method != 'GET':
+        if request.method != b'GET':
             request.setResponseCode(404)
             return "Not Found - 404"
-        info = self.authinfo.get(username, None)
-        if info is None:
+        entry = self._serialized.get(username, None)
+        if entry is None:
             request.setResponseCode(404)
             return "Not Found - 404"
-        serialized = json.dumps(info)
-        request.responseHeaders.setRawHeaders('Content-Type', ['application/json'])
-        return serialized
+        body, etag = entry
+        return deliver_json(request, body, etag)
 
     def setAuthInfo(self, username, info):
         authinfo = self.authinfo
         if info is None:
             if username in authinfo:
                 del authinfo[username]
+                del self._serialized[username]
         else:
             authinfo[username] = info
+            self._serialized[username] = serialize(info)
 
 def makeAuthInfoSite():
     app = AuthInfoApp()
@@ -0,0 +1,136 @@
+
+from twisted.internet import defer
+
+
+class QueueFullError(Exception):
+    """
+    Raised when a concurrency limiter's wait queue is full.
+    """
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised when a circuit breaker refuses a call.
+    """
+
+
+class ConcurrencyLimiter(object):
+    """
+    Run at most `max_concurrent` calls at a time.  Up to `max_queued`
+    further calls wait their turn; beyond that calls fail immediately
+    with `QueueFullError`.
+    """
+
+    def __init__(self, clock, max_concurrent=20, max_queued=100,
+            stats=None, name='limiter'):
+        self.clock = clock
+        self.max_queued = max_queued
+        self.stats = stats
+        self.name = name
+        self._sem = defer.DeferredSemaphore(max_concurrent)
+        if stats is not None:
+            stats.set_gauge('{0}.queued'.format(name), self.queued)
+            stats.set_gauge('{0}.active'.format(name), self.active)
+
+    def queued(self):
+        return len(self._sem.waiting)
+
+    def active(self):
+        sem = self._sem
+        return sem.limit - sem.tokens
+
+    def run(self, f, *args, **kwds):
+        stats = self.stats
+        if len(self._sem.waiting) >= self.max_queued:
+            if stats is not None:
+                stats.incr('{0}.rejected'.format(self.name))
+            return defer.fail(QueueFullError(
+                "More than {0} calls waiting.".format(self.max_queued)))
+        queued_at = self.clock.seconds()
+        d = self._sem.acquire()
+
+        def _acquired(sem):
+            if stats is not None:
+                stats.record_timing(
+                    '{0}.wait'.format(self.name),
+                    self.clock.seconds() - queued_at)
+            d2 = defer.maybeDeferred(f, *args, **kwds)
+            d2.addBoth(_release)
+            return d2
+
+        def _release(result):
+            self._sem.release()
+            return result
+
+        d.addCallback(_acquired)
+        return d
+
+
+class CircuitBreaker(object):
+    """
+    Fail fast after `failure_threshold` consecutive failures.  After
+    `reset_timeout` seconds, a single trial call is let through; its
+    outcome closes or re-opens the circuit.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, clock, failure_threshold=5, reset_timeout=30,
+            stats=None, name='breaker'):
+        self.clock = clock
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.stats = stats
+        self.name = name
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = None
+        self._trial_pending = False
+        if stats is not None:
+            stats.set_gauge('{0}.state'.format(name), lambda: self.state)
+
+    def allow(self):
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN:
+            if self.clock.seconds() - self._opened_at < self.reset_timeout:
+                return False
+            self.state = self.HALF_OPEN
+        if self._trial_pending:
+            return False
+        self._trial_pending = True
+        return True
+
+    def record_success(self):
+        self._failures = 0
+        self._trial_pending = False
+        self.state = self.CLOSED
+
+    def record_failure(self):
+        self._failures += 1
+        self._trial_pending = False
+        if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+            if self.state != self.OPEN and self.stats is not None:
+                self.stats.incr('{0}.opened'.format(self.name))
+            self.state = self.OPEN
+            self._opened_at = self.clock.seconds()
+
+    def call(self, f, *args, **kwds):
+        if not self.allow():
+            if self.stats is not None:
+                self.stats.incr('{0}.short_circuited'.format(self.name))
+            return defer.fail(CircuitOpenError(
+                "Circuit '{0}' is open.".format(self.name)))
+        d = defer.maybeDeferred(f, *args, **kwds)
+
+        def _success(result):
+            self.record_success()
+            return result
+
+        def _failure(err):
+            self.record_failure()
+            return err
+
+        d.addCallbacks(_success, _failure)
+        return d
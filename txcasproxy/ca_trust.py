@@ -5,41 +5,159 @@
 # Use this as the `contextFactory` for `twisted.web.client.Agent`.
 #----------------------------------------------------------------------
 
+import collections
 from OpenSSL import crypto
-from twisted.internet import ssl, defer 
-from twisted.internet.endpoints import clientFromString
+from twisted.internet import ssl
 from twisted.internet.interfaces import IOpenSSLClientConnectionCreator
-from twisted.python.components import proxyForInterface
+from twisted.python import log
 from twisted.web.iweb import IPolicyForHTTPS
 from zope.interface import implementer
 
 
-class AddExtraTrustRoots(proxyForInterface(IOpenSSLClientConnectionCreator)):
-    def __init__(self, extraTrustRoots, original):
-        self._extraTrustRoots = extraTrustRoots
-        super(AddExtraTrustRoots, self).__init__(original)
+def _private_tls_apis():
+    """
+    Returns pyOpenSSL's binding of the OpenSSL library and Twisted's
+    `IOpenSSLTrustRoot`, or (None, None) if an upgrade has moved these
+    private APIs.
+    """
+    try:
+        from OpenSSL._util import lib
+        from twisted.internet._sslverify import IOpenSSLTrustRoot
+        lib.SSL_session_reused
+        ssl.platformTrust()._addCACertsToContext
+    except (ImportError, AttributeError) as ex:
+        log.msg((
+            "[WARN] Private pyOpenSSL or Twisted TLS APIs are unavailable ({0}).  "
+            "Extra CA certificates are added as connections are made, and TLS "
+            "session reuse is not counted.").format(ex))
+        return (None, None)
+    return (lib, IOpenSSLTrustRoot)
 
+_lib, _IOpenSSLTrustRoot = _private_tls_apis()
 
-    def clientConnectionForTLS(self, tlsProtocol):
-        connection = (super(AddExtraTrustRoots, self).clientConnectionForTLS(tlsProtocol))
-        cert_store = connection.get_context().get_cert_store()
+
+def session_reused(connection):
+    """
+    True if the handshake on `connection` resumed an earlier session.
+    pyOpenSSL does not wrap SSL_session_reused(), so call it directly.
+    False if the private API is unavailable.
+    """
+    ssl_ptr = getattr(connection, '_ssl', None)
+    if _lib is None or ssl_ptr is None:
+        return False
+    return bool(_lib.SSL_session_reused(ssl_ptr))
+
+
+class PlatformTrustWithExtraRoots(object):
+    """
+    Trust the platform CA bundle plus `extraTrustRoots`.  The roots are
+    added to a context's cert store once, when the context is created.
+    """
+    def __init__(self, extraTrustRoots):
+        self._extraTrustRoots = extraTrustRoots
+
+    def _addCACertsToContext(self, context):
+        ssl.platformTrust()._addCACertsToContext(context)
+        cert_store = context.get_cert_store()
         for cert in self._extraTrustRoots:
             cert_store.add_cert(cert)
+
+if _IOpenSSLTrustRoot is not None:
+    PlatformTrustWithExtraRoots = implementer(_IOpenSSLTrustRoot)(PlatformTrustWithExtraRoots)
+
+
+@implementer(IOpenSSLClientConnectionCreator)
+class ResumingConnectionCreator(object):
+    """
+    Creates client TLS connections to a single (hostname, port) from one
+    shared, fully configured context, and offers the most recently
+    negotiated session to each new connection so the server may resume it.
+
+    Sessions are collected from earlier connections once their handshakes
+    have finished, so handshake statistics for a connection are recorded
+    when the next connection to the same netloc is created.
+
+    If `extraTrustRoots` is given, they are added to the shared context's
+    cert store when the first connection is created.
+    """
+    max_pending = 8
+
+    def __init__(self, options, stats=None, extraTrustRoots=None):
+        self._options = options
+        self.stats = stats
+        self._extraTrustRoots = extraTrustRoots
+        self._session = None
+        self._pending = collections.deque(maxlen=self.max_pending)
+
+    def _incr(self, name):
+        if self.stats is not None:
+            self.stats.incr(name)
+
+    def _collectSessions(self):
+        pending = self._pending
+        unfinished = []
+        while len(pending) > 0:
+            connection = pending.popleft()
+            # `get_finished()` is None until our Finished message is sent.
+            if connection.get_finished() is None:
+                unfinished.append(connection)
+                continue
+            self._incr('tls.client.handshakes')
+            if session_reused(connection):
+                self._incr('tls.client.resumed')
+            session = connection.get_session()
+            if session is not None:
+                self._session = session
+        pending.extend(unfinished)
+
+    def clientConnectionForTLS(self, tlsProtocol):
+        self._collectSessions()
+        connection = self._options.clientConnectionForTLS(tlsProtocol)
+        extraTrustRoots = self._extraTrustRoots
+        if extraTrustRoots is not None:
+            cert_store = connection.get_context().get_cert_store()
+            for cert in extraTrustRoots:
+                try:
+                    cert_store.add_cert(cert)
+                except crypto.Error:
+                    # Already in the store.
+                    pass
+            self._extraTrustRoots = None
+        if self._session is not None:
+            connection.set_session(self._session)
+        self._pending.append(connection)
         return connection
- 
+
 
 @implementer(IPolicyForHTTPS)
 class CustomPolicyForHTTPS(object):
     """
-    SSL connection creator for web clients.
+    SSL connection creator for web clients.  One connection creator is
+    kept per (hostname, port).
     """
-    def __init__(self, extraTrustRoots=None):
-        if extraTrustRoots is None:
-            extraTrustRoots = []
-        self._extraTrustRoots = extraTrustRoots
+    def __init__(self, extraTrustRoots=None, stats=None):
+        trustRoot = None
+        connectionTrustRoots = None
+        if extraTrustRoots is not None and len(extraTrustRoots) > 0:
+            if _IOpenSSLTrustRoot is not None:
+                trustRoot = PlatformTrustWithExtraRoots(extraTrustRoots)
+            else:
+                connectionTrustRoots = extraTrustRoots
+        self._trustRoot = trustRoot
+        self._connectionTrustRoots = connectionTrustRoots
+        self.stats = stats
+        self._creators = {}
 
     def creatorForNetloc(self, hostname, port):
-        return AddExtraTrustRoots(
-            self._extraTrustRoots, 
-            ssl.optionsForClientTLS(hostname.decode("ascii")))
+        key = (hostname, port)
+        creator = self._creators.get(key, None)
+        if creator is None:
+            options = ssl.optionsForClientTLS(
+                hostname.decode("ascii"),
+                trustRoot=self._trustRoot,
+                extraCertificateOptions={'enableSessionTickets': True})
+            creator = ResumingConnectionCreator(
+                options, stats=self.stats, extraTrustRoots=self._connectionTrustRoots)
+            self._creators[key] = creator
+        return creator
 
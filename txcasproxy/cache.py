@@ -0,0 +1,113 @@
+
+import collections
+
+_missing = object()
+
+
+class TTLCache(object):
+    """
+    A size-bounded mapping whose entries expire `ttl` seconds after they
+    were set.  Every entry shares the same TTL, so insertion order is also
+    expiry order and purging only ever inspects the oldest entries.
+    """
+
+    def __init__(self, clock, ttl, max_size=10000):
+        self.clock = clock
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return self.get(key, _missing) is not _missing
+
+    def get(self, key, default=None):
+        entry = self._entries.get(key, None)
+        if entry is None:
+            return default
+        expires, value = entry
+        if expires <= self.clock.seconds():
+            del self._entries[key]
+            return default
+        return value
+
+    def set(self, key, value):
+        entries = self._entries
+        if key in entries:
+            del entries[key]
+        entries[key] = (self.clock.seconds() + self.ttl, value)
+        self.purge()
+        while len(entries) > self.max_size:
+            entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return default
+        return entry[1]
+
+    def purge(self):
+        entries = self._entries
+        now = self.clock.seconds()
+        while len(entries) > 0:
+            key, (expires, value) = next(iter(entries.items()))
+            if expires > now:
+                break
+            del entries[key]
+
+
+class LRUCache(object):
+    """
+    A mapping that evicts its least recently used entries once the total
+    weight of its entries exceeds `max_weight`.  By default every entry
+    weighs 1; supply `weigh` to bound the cache by e.g. bytes instead.
+    """
+
+    def __init__(self, max_weight, weigh=None):
+        self.max_weight = max_weight
+        if weigh is None:
+            weigh = lambda value: 1
+        self.weigh = weigh
+        self.weight = 0
+        self._entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        entries = self._entries
+        entry = entries.get(key, None)
+        if entry is None:
+            return default
+        entries.move_to_end(key)
+        return entry[1]
+
+    def set(self, key, value):
+        weight = self.weigh(value)
+        if weight > self.max_weight:
+            self.pop(key)
+            return
+        entries = self._entries
+        if key in entries:
+            self.weight -= entries.pop(key)[0]
+        entries[key] = (weight, value)
+        self.weight += weight
+        while self.weight > self.max_weight:
+            old_key, (old_weight, old_value) = entries.popitem(last=False)
+            self.weight -= old_weight
+
+    def pop(self, key, default=None):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return default
+        self.weight -= entry[0]
+        return entry[1]
+
+    def clear(self):
+        self._entries.clear()
+        self.weight = 0
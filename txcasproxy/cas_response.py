@@ -0,0 +1,140 @@
+
+#----------------------------------------------------------------------
+# Parsers for CAS /serviceValidate and /p3/serviceValidate responses.
+# Each parser returns (username, attrib_map, pgt_iou) where `attrib_map`
+# maps attribute names to lists of values and `pgt_iou` is the proxy-
+# granting ticket IOU (or None).
+#----------------------------------------------------------------------
+
+import json
+from lxml import etree
+
+CAS_NS = "http://www.yale.edu/tp/cas"
+
+_namespaces = {'cas': CAS_NS}
+_success_xpath = etree.XPath(
+    "/cas:serviceResponse/cas:authenticationSuccess", namespaces=_namespaces)
+_user_xpath = etree.XPath("cas:user", namespaces=_namespaces)
+_attributes_xpath = etree.XPath("cas:attributes", namespaces=_namespaces)
+_pgt_iou_xpath = etree.XPath("cas:proxyGrantingTicket/text()", namespaces=_namespaces)
+_proxy_ticket_xpath = etree.XPath(
+    "/cas:serviceResponse/cas:proxySuccess/cas:proxyTicket/text()", namespaces=_namespaces)
+_proxy_failure_xpath = etree.XPath(
+    "/cas:serviceResponse/cas:proxyFailure", namespaces=_namespaces)
+_failure_xpath = etree.XPath(
+    "/cas:serviceResponse/cas:authenticationFailure", namespaces=_namespaces)
+_service_response_tag = "{%s}serviceResponse" % CAS_NS
+
+
+class CASBackchannelError(Exception):
+    """
+    The CAS service could not answer a backchannel request.
+    """
+
+
+class TicketRejectedError(Exception):
+    """
+    CAS did not vouch for a service ticket.
+    """
+
+
+def parse_xml_response(payload):
+    try:
+        root = etree.fromstring(payload)
+    except (etree.XMLSyntaxError,) as ex:
+        raise CASBackchannelError("Error parsing XML payload: {0}".format(ex))
+    if root.tag != _service_response_tag:
+        raise TicketRejectedError("Error parsing XML payload.  No `serviceResponse`.")
+    results = _success_xpath(root)
+    if len(results) != 1:
+        failures = _failure_xpath(root)
+        if len(failures) == 1:
+            failure = failures[0]
+            raise TicketRejectedError("CAS authentication failure: code='{0}' {1}".format(
+                failure.get('code'), (failure.text or '').strip()))
+        raise TicketRejectedError("Error parsing XML payload.  No `authenticationSuccess`.")
+    success = results[0]
+    results = _user_xpath(success)
+    if len(results) != 1:
+        raise TicketRejectedError("Error parsing XML payload.  Not exactly 1 `user`.")
+    username = results[0].text
+    attrib_map = {}
+    ns_size = len(CAS_NS) + 2
+    for attrib_container in _attributes_xpath(success):
+        for elm in attrib_container.iterchildren(tag=etree.Element):
+            tag = elm.tag
+            values = attrib_map.get(tag, None)
+            if values is None:
+                values = []
+                attrib_map[tag] = values
+            values.append(elm.text)
+    # Strip the namespace once per attribute name rather than once per value.
+    attrib_map = dict((tag[ns_size:], values) for tag, values in attrib_map.items())
+    pgt_ious = _pgt_iou_xpath(success)
+    pgt_iou = str(pgt_ious[0]).strip() if len(pgt_ious) == 1 else None
+    return (username, attrib_map, pgt_iou)
+
+
+def parse_json_response(payload):
+    if isinstance(payload, bytes):
+        payload = payload.decode('utf-8')
+    try:
+        doc = json.loads(payload)
+    except ValueError as ex:
+        raise CASBackchannelError("Error parsing JSON payload: {0}".format(ex))
+    if not isinstance(doc, dict) or not isinstance(doc.get('serviceResponse', None), dict):
+        raise TicketRejectedError("Error parsing JSON payload.  No `serviceResponse`.")
+    response = doc['serviceResponse']
+    success = response.get('authenticationSuccess', None)
+    if not isinstance(success, dict):
+        failure = response.get('authenticationFailure', None)
+        if isinstance(failure, dict):
+            raise TicketRejectedError("CAS authentication failure: code='{0}' {1}".format(
+                failure.get('code'), failure.get('description', '')))
+        raise TicketRejectedError("Error parsing JSON payload.  No `authenticationSuccess`.")
+    username = success.get('user', None)
+    if not isinstance(username, str):
+        raise TicketRejectedError("Error parsing JSON payload.  Not exactly 1 `user`.")
+    attrib_map = {}
+    attributes = success.get('attributes', None)
+    if isinstance(attributes, dict):
+        for name, value in attributes.items():
+            if isinstance(value, list):
+                attrib_map[name] = [_json_value(v) for v in value]
+            else:
+                attrib_map[name] = [_json_value(value)]
+    pgt_iou = success.get('proxyGrantingTicket', None)
+    return (username, attrib_map, pgt_iou)
+
+
+def parse_xml_proxy_response(payload):
+    """
+    Parse a CAS /proxy response and return the proxy ticket.
+    """
+    try:
+        root = etree.fromstring(payload)
+    except (etree.XMLSyntaxError,) as ex:
+        raise CASBackchannelError("Error parsing XML payload: {0}".format(ex))
+    results = _proxy_ticket_xpath(root)
+    if len(results) != 1:
+        failures = _proxy_failure_xpath(root)
+        if len(failures) == 1:
+            failure = failures[0]
+            raise TicketRejectedError("CAS proxy failure: code='{0}' {1}".format(
+                failure.get('code'), (failure.text or '').strip()))
+        raise TicketRejectedError("Error parsing XML payload.  No `proxyTicket`.")
+    return str(results[0]).strip()
+
+
+def _json_value(value):
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return str(value)
+
+
+parsers = {
+    'XML': parse_xml_response,
+    'JSON': parse_json_response,
+}
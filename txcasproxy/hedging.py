@@ -0,0 +1,157 @@
+
+#----------------------------------------------------------------------
+# Retried and hedged upstream requests for idempotent methods.
+#----------------------------------------------------------------------
+
+from .upstreams import connection_errors, is_cancelled
+from twisted.internet import defer
+from twisted.internet.protocol import Protocol
+
+
+class RetryBudget(object):
+    """
+    Limits retries and hedged requests to a fraction of all requests.
+    Each request deposits `ratio` tokens (up to `burst`), and each retry
+    or hedge withdraws one.  When backends are failing, retries stop at
+    roughly `ratio` times the request rate instead of multiplying load.
+    """
+
+    def __init__(self, ratio=0.1, burst=10):
+        self.ratio = ratio
+        self.burst = burst
+        self.balance = float(burst)
+
+    def deposit(self):
+        self.balance = min(self.burst, self.balance + self.ratio)
+
+    def withdraw(self):
+        if self.balance < 1:
+            return False
+        self.balance -= 1
+        return True
+
+
+class HedgingPolicy(object):
+    """
+    Sends an idempotent request to an upstream and:
+
+    * Retries it (up to `max_retries` times) on another upstream if the
+      upstream could not be reached.
+    * If `hedge_delay` > 0 and no response has arrived after that many
+      seconds, sends one more copy to another upstream.  The first
+      response wins and the other request is cancelled.
+
+    Both are paid for from `budget`.  Neither is sent when the only
+    upstream available is one already tried, since that would just add
+    load to a slow or failing backend.
+    """
+    methods = frozenset([b'GET', b'HEAD'])
+
+    def __init__(self, clock, max_retries=1, hedge_delay=0, budget=None, stats=None):
+        self.clock = clock
+        self.max_retries = max_retries
+        self.hedge_delay = hedge_delay
+        if budget is None:
+            budget = RetryBudget()
+        self.budget = budget
+        self.stats = stats
+
+    def _incr(self, name):
+        if self.stats is not None:
+            self.stats.incr(name)
+
+    def _withdraw(self):
+        if self.budget.withdraw():
+            return True
+        self._incr('proxy.retry_budget_exhausted')
+        return False
+
+    def request(self, first, select, send):
+        """
+        Send the request to upstream `first`.  `select(exclude)` chooses
+        another upstream, avoiding those in `exclude` where possible.
+        `send(upstream)` sends the request and returns a deferred response.
+        Returns a deferred that fires with the winning response.
+        """
+        self.budget.deposit()
+        tried = []
+        attempts = []
+        hedges = []
+        state = {'done': False, 'retries': 0, 'timer': None}
+
+        def _cancel_all(result_d):
+            state['done'] = True
+            _stop_timer()
+            for d in list(attempts):
+                d.cancel()
+
+        result = defer.Deferred(_cancel_all)
+
+        def _stop_timer():
+            timer = state['timer']
+            if timer is not None and timer.active():
+                timer.cancel()
+            state['timer'] = None
+
+        def _launch(upstream, hedge=False):
+            tried.append(upstream)
+            d = send(upstream)
+            attempts.append(d)
+            if hedge:
+                hedges.append(d)
+            d.addCallbacks(_won, _lost, callbackArgs=(d,), errbackArgs=(d,))
+
+        def _won(response, d):
+            attempts.remove(d)
+            if state['done']:
+                # Lost a race with the winning response; discard the body.
+                response.deliverBody(Protocol())
+                return None
+            state['done'] = True
+            _stop_timer()
+            if d in hedges:
+                self._incr('proxy.hedges_won')
+            for other in list(attempts):
+                other.cancel()
+            result.callback(response)
+            return None
+
+        def _untried():
+            upstream = select(tried)
+            if upstream in tried:
+                return None
+            return upstream
+
+        def _lost(err, d):
+            attempts.remove(d)
+            if state['done'] or is_cancelled(err):
+                return None
+            if err.check(*connection_errors) and state['retries'] < self.max_retries:
+                upstream = _untried()
+                if upstream is not None and self._withdraw():
+                    state['retries'] += 1
+                    self._incr('proxy.retries')
+                    _launch(upstream)
+                    return None
+            if len(attempts) > 0:
+                # Another attempt is still in flight.
+                return None
+            state['done'] = True
+            _stop_timer()
+            result.errback(err)
+            return None
+
+        def _hedge():
+            state['timer'] = None
+            if state['done']:
+                return
+            upstream = _untried()
+            if upstream is None or not self._withdraw():
+                return
+            self._incr('proxy.hedges')
+            _launch(upstream, hedge=True)
+
+        _launch(first)
+        if self.hedge_delay > 0 and not state['done']:
+            state['timer'] = self.clock.callLater(self.hedge_delay, _hedge)
+        return result
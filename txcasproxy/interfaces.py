@@ -17,6 +17,7 @@ class IRProxyInfoAcceptor(Interface):
     proxied_scheme = Attribute("Proxied scheme.")
     proxied_netloc = Attribute("Proxied netloc.")
     proxied_path = Attribute("Proxied path.")
+    proxied_upstreams = Attribute("(netloc, path) of each upstream for the proxied site.")
     expire_session = Attribute("Expire a session.")
     
     def handle_rproxy_info_set():
@@ -30,7 +31,15 @@ class IResponseContentModifier(Interface):
     
     def transform_content(content, request):
         """
-        Transform `content`
+        Transform `content`.  Returns the result or a deferred that fires
+        with it.
+
+        A plugin may set `mod_offload` to 'reactor', 'thread', or 'process'
+        to choose where this runs (see `offload.ContentOffloader`), or set
+        `mod_thread_safe` to let large bodies be transformed in a thread.
+        With 'process', the plugin must also define `transform_task(content,
+        request)`.  A plugin whose output depends only on the URL and
+        `content` may set `mod_cacheable` (see `transform_cache`).
         """
 
 class IResourceInterceptor(Interface):
@@ -68,7 +77,12 @@ class IAccessControl(Interface):
 
     def isAllowed(username, attrib_map):
         """
-        Returns (is_allowed, reason)
+        Returns (is_allowed, reason) or a deferred that fires with it.
         If `is_allowed` is True, `reason` should be None.
         `reason` should be suitable for display to an end user
+
+        Plugins are evaluated concurrently.  A plugin may also define
+        `ac_timeout` (seconds), `ac_cache_ttl` (seconds to reuse a decision
+        for a username), and `ac_blocking` (run `isAllowed()` in a thread
+        pool).
         """
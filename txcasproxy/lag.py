@@ -0,0 +1,64 @@
+
+#----------------------------------------------------------------------
+# Measure how far the reactor is falling behind.
+#----------------------------------------------------------------------
+
+
+class LagMonitor(object):
+    """
+    Schedules a call every `interval` seconds and measures how late it
+    runs.  The lag jumps to each new peak and then decays by `decay` per
+    call, so one stall keeps the reactor marked as lagging for a few
+    intervals.  A call that is overdue right now counts in full, so a
+    stalled reactor is noticed by the first request it serves.
+
+    The reactor is lagging when the lag exceeds `threshold` seconds
+    (0 disables the threshold).
+    """
+    decay = 0.3
+
+    def __init__(self, clock, interval=0.1, threshold=0, stats=None):
+        self.clock = clock
+        self.interval = interval
+        self.threshold = threshold
+        self.stats = stats
+        self.lag = 0.0
+        self._expected = None
+        self._call = None
+        if stats is not None:
+            stats.set_gauge('reactor.lag', self.current_lag)
+
+    def start(self):
+        if self.interval <= 0 or self._call is not None:
+            return
+        self._schedule(self.clock.seconds())
+
+    def stop(self):
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        self._call = None
+        self._expected = None
+
+    def _schedule(self, now):
+        self._expected = now + self.interval
+        self._call = self.clock.callLater(self.interval, self._tick)
+
+    def _tick(self):
+        now = self.clock.seconds()
+        lag = max(0.0, now - self._expected)
+        self.lag = max(lag, (1 - self.decay) * self.lag)
+        if self.stats is not None:
+            self.stats.record_timing('reactor.lag', lag)
+        self._schedule(now)
+
+    def current_lag(self):
+        lag = self.lag
+        expected = self._expected
+        if expected is not None:
+            overdue = self.clock.seconds() - expected
+            if overdue > lag:
+                return overdue
+        return lag
+
+    def is_lagging(self):
+        return self.threshold > 0 and self.current_lag() > self.threshold
@@ -0,0 +1,180 @@
+
+#----------------------------------------------------------------------
+# Run content modifiers and template rendering off the reactor thread.
+#----------------------------------------------------------------------
+
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+from .backpressure import ConcurrencyLimiter, QueueFullError
+from twisted.internet import defer
+from twisted.internet.threads import deferToThreadPool
+from twisted.python.failure import Failure
+from twisted.python.threadpool import ThreadPool
+
+REACTOR = 'reactor'
+THREAD = 'thread'
+PROCESS = 'process'
+
+
+def _call_in_process(reactor, executor, f, *args):
+    """
+    Run `f(*args)` in `executor` and return a deferred that fires (in the
+    reactor thread) with the result.
+    """
+    d = defer.Deferred()
+
+    def _done(future):
+        try:
+            result = future.result()
+        except Exception:
+            reactor.callFromThread(d.errback, Failure())
+        else:
+            reactor.callFromThread(d.callback, result)
+
+    executor.submit(f, *args).add_done_callback(_done)
+    return d
+
+
+def _boxed(f, *args, **kwds):
+    """
+    Call `f` in a worker thread.  `deferToThreadPool` cannot fire its
+    deferred with a deferred, so the result is returned in a list and
+    unwrapped in the reactor thread.
+    """
+    return [f(*args, **kwds)]
+
+
+def _unbox(result):
+    return result[0]
+
+
+def _render(template, kwargs):
+    return template.render(**kwargs).encode('utf-8')
+
+
+class ContentOffloader(object):
+    """
+    Chooses where each response content modifier runs.  A modifier may
+    set `mod_offload` to:
+
+    * 'reactor': Always call `transform_content()` in the reactor thread.
+    * 'thread': Call `transform_content()` in the thread pool.
+    * 'process': Call `transform_task(content, request)` in the reactor
+      thread.  It returns `(f, args)`, where `f` is a picklable module
+      level function, and `f(content, *args)` is run in the process pool.
+
+    Modifiers that do not set `mod_offload` run in the reactor thread,
+    unless they set `mod_thread_safe = True` and the body is at least
+    `threshold` bytes (0 disables this), in which case they run in the
+    thread pool.  A modifier run in a thread may return a deferred that has
+    already fired.
+
+    At most `threads` (or `processes`) tasks run at once and `max_queued`
+    more may wait.  When a queue is full, the task runs in the reactor
+    thread.  Process work falls back to the thread pool when there are no
+    processes, and thread work to the reactor when there are no threads.
+    """
+
+    def __init__(self, reactor, threads=4, processes=0, max_queued=100,
+                    threshold=262144, templates=False, stats=None):
+        self.reactor = reactor
+        self.threads = threads
+        self.processes = processes
+        self.threshold = threshold
+        self.templates = templates
+        self.stats = stats
+        self._threadpool = None
+        self._executor = None
+        self.thread_limiter = ConcurrencyLimiter(
+            reactor, max(threads, 1), max_queued, stats=stats, name='offload.thread')
+        self.process_limiter = ConcurrencyLimiter(
+            reactor, max(processes, 1), max_queued, stats=stats, name='offload.process')
+
+    def _getThreadPool(self):
+        if self._threadpool is None:
+            threadpool = ThreadPool(
+                minthreads=min(self.threads, 1), maxthreads=self.threads, name='content-offload')
+            threadpool.start()
+            self.reactor.addSystemEventTrigger('during', 'shutdown', threadpool.stop)
+            self._threadpool = threadpool
+        return self._threadpool
+
+    def _getExecutor(self):
+        if self._executor is None:
+            # Forking a process that runs threads is unsafe, so workers are
+            # started fresh.
+            executor = ProcessPoolExecutor(
+                max_workers=self.processes,
+                mp_context=multiprocessing.get_context('spawn'))
+            self.reactor.addSystemEventTrigger('during', 'shutdown', executor.shutdown, False)
+            self._executor = executor
+        return self._executor
+
+    def mode_for(self, modifier, content):
+        mode = getattr(modifier, 'mod_offload', None)
+        if mode is None:
+            threshold = self.threshold
+            if (threshold > 0 and getattr(modifier, 'mod_thread_safe', False) and
+                    content is not None and len(content) >= threshold):
+                mode = THREAD
+            else:
+                mode = REACTOR
+        if mode == PROCESS and self.processes <= 0:
+            mode = THREAD
+        if mode == THREAD and self.threads <= 0:
+            mode = REACTOR
+        return mode
+
+    def _incr(self, name):
+        if self.stats is not None:
+            self.stats.incr(name)
+
+    def _run(self, limiter, name, offloaded, inline):
+        """
+        Run `offloaded()` under `limiter`, or `inline()` if the queue is full.
+        """
+        self._incr('{0}.tasks'.format(name))
+        d = limiter.run(offloaded)
+
+        def _queue_full(err):
+            err.trap(QueueFullError)
+            return inline()
+
+        d.addErrback(_queue_full)
+        return d
+
+    def in_thread(self, f, *args, **kwds):
+        return self._run(
+            self.thread_limiter,
+            'offload.thread',
+            lambda: deferToThreadPool(
+                self.reactor, self._getThreadPool(), _boxed, f, *args, **kwds).addCallback(_unbox),
+            lambda: f(*args, **kwds))
+
+    def in_process(self, f, *args):
+        return self._run(
+            self.process_limiter,
+            'offload.process',
+            lambda: _call_in_process(self.reactor, self._getExecutor(), f, *args),
+            lambda: f(*args))
+
+    def transform(self, content, modifier, request):
+        """
+        Apply `modifier` to `content`.  Returns the result or a deferred.
+        """
+        mode = self.mode_for(modifier, content)
+        if mode == THREAD:
+            return self.in_thread(modifier.transform_content, content, request)
+        if mode == PROCESS:
+            f, args = modifier.transform_task(content, request)
+            return self.in_process(f, content, *args)
+        return modifier.transform_content(content, request)
+
+    def render(self, template, **kwargs):
+        """
+        Render `template` to UTF-8.  Returns bytes, or a deferred if
+        templates are rendered in the thread pool.
+        """
+        if self.templates and self.threads > 0:
+            return self.in_thread(_render, template, kwargs)
+        return _render(template, kwargs)
@@ -0,0 +1,99 @@
+
+from urllib.parse import urlencode
+from urllib import parse as urlparse
+from .cache import TTLCache
+from .cas_response import parse_xml_proxy_response
+from twisted.internet import defer
+
+
+class ProxyTicketBroker(object):
+    """
+    Keeps the proxy-granting tickets (PGTs) issued to proxy sessions and
+    obtains proxy tickets (PTs) for target services on their behalf.
+
+    CAS delivers each PGT to the pgtUrl callback keyed by an IOU before it
+    answers the validation request, so IOUs only need to live briefly.
+    Proxy tickets are cached per (session, target service) for `pt_ttl`
+    seconds, and concurrent requests for the same pair share one CAS
+    request.
+    """
+    iou_ttl = 120
+
+    def __init__(self, clock, proxy_url, fetch, pt_ttl=5, stats=None):
+        """
+        `fetch` is a callable that takes a URL and returns a deferred that
+        fires with the response body.
+        """
+        self.clock = clock
+        self.proxy_url = proxy_url
+        self.fetch = fetch
+        self.stats = stats
+        self._ious = TTLCache(clock, self.iou_ttl)
+        self._pgts = {}
+        self._pts = TTLCache(clock, pt_ttl)
+        self._inflight = {}
+
+    def receive_pgt(self, pgt_iou, pgt):
+        """
+        Handle a pgtUrl callback from CAS.
+        """
+        self._ious.set(pgt_iou, pgt)
+
+    def claim_pgt(self, pgt_iou):
+        """
+        Exchange a PGT IOU from a validation response for the PGT.
+        """
+        return self._ious.pop(pgt_iou, None)
+
+    def set_pgt(self, sess_uid, pgt):
+        self._pgts[sess_uid] = pgt
+
+    def has_pgt(self, sess_uid):
+        return sess_uid in self._pgts
+
+    def forget(self, sess_uid):
+        self._pgts.pop(sess_uid, None)
+
+    def get_proxy_ticket(self, sess_uid, target_service):
+        """
+        Return a deferred that fires with a proxy ticket for
+        `target_service`.
+        """
+        stats = self.stats
+        pgt = self._pgts.get(sess_uid, None)
+        if pgt is None:
+            return defer.succeed(None)
+        key = (sess_uid, target_service)
+        pt = self._pts.get(key, None)
+        if pt is not None:
+            if stats is not None:
+                stats.incr('cas.proxy.cache_hits')
+            return defer.succeed(pt)
+        waiters = self._inflight.get(key, None)
+        if waiters is not None:
+            d = defer.Deferred()
+            waiters.append(d)
+            return d
+        waiters = []
+        self._inflight[key] = waiters
+        if stats is not None:
+            stats.incr('cas.proxy.requests')
+        params = urlencode({'pgt': pgt, 'targetService': target_service})
+        p = urlparse.urlparse(self.proxy_url)
+        p = urlparse.ParseResult(*tuple(p[:4] + (params,) + p[5:]))
+        d = self.fetch(urlparse.urlunparse(p))
+        d.addCallback(parse_xml_proxy_response)
+
+        def _fan_out(result):
+            del self._inflight[key]
+            if isinstance(result, str):
+                self._pts.set(key, result)
+            for waiter in waiters:
+                if isinstance(result, str):
+                    waiter.callback(result)
+                else:
+                    waiter.errback(result)
+            return result
+
+        d.addBoth(_fan_out)
+        return d
@@ -0,0 +1,187 @@
+
+#----------------------------------------------------------------------
+# Per-user request rate limits and concurrency caps.
+#----------------------------------------------------------------------
+
+import shlex
+from .urls import does_url_match_pattern, parse_url_pattern
+
+
+class RateLimitRule(object):
+    """
+    Limits for requests whose URI matches `pattern` (see `urls.py`).
+    `rate` is requests per second, `burst` the bucket size, and
+    `concurrent` the maximum requests in flight per user.  A limit of None
+    uses the default and 0 disables it.
+    """
+
+    def __init__(self, pattern, rate=None, burst=None, concurrent=None):
+        self.pattern_s = pattern
+        self.pattern = parse_url_pattern(pattern)
+        self.rate = rate
+        self.burst = burst
+        self.concurrent = concurrent
+
+
+def parse_rate_limit_rule(spec):
+    """
+    Parse a colon-separated key=value list, e.g.
+    'pattern=/export/*:rate=0.2:burst=2:concurrent=1'.
+    """
+    parser = shlex.shlex(spec, posix=True)
+    parser.whitespace = ':'
+    parser.whitespace_split = True
+    parser.commenters = ''
+    settings = dict(tuple(token.split('=', 1)) for token in parser)
+    if 'pattern' not in settings:
+        raise ValueError("Rate limit rule '{0}' must specify `pattern`.".format(spec))
+    limits = {}
+    for name, convert in (('rate', float), ('burst', float), ('concurrent', int)):
+        if name in settings:
+            try:
+                limits[name] = convert(settings[name])
+            except ValueError:
+                raise ValueError("Rate limit rule '{0}' has an invalid `{1}`.".format(spec, name))
+    return RateLimitRule(settings['pattern'], **limits)
+
+
+class _Limits(object):
+    __slots__ = ('rate', 'burst', 'concurrent')
+
+    def __init__(self, rate, burst, concurrent):
+        self.rate = rate
+        self.burst = burst
+        self.concurrent = concurrent
+
+
+class Bucket(object):
+    """
+    Limiter state for one user under one set of limits.
+    """
+    __slots__ = ('tokens', 'updated', 'active')
+
+    def __init__(self, tokens, updated):
+        self.tokens = tokens
+        self.updated = updated
+        self.active = 0
+
+
+class RateLimiter(object):
+    """
+    Token bucket rate limits and concurrency caps, per key (a username or
+    client IP).  The first rule whose pattern matches the request URI
+    applies; requests matching no rule get the default limits.  Each rule
+    keeps its own buckets.
+
+    Buckets that are full and idle are discarded every `sweep_interval`
+    seconds, so state is kept only for recently active keys.
+    """
+    rule_cache_size = 1024
+
+    def __init__(self, clock, rate=0, burst=20, concurrent=0, rules=None,
+                    sweep_interval=60, stats=None):
+        self.clock = clock
+        self.default = _Limits(rate, burst, concurrent)
+        if rules is None:
+            rules = []
+        self.rules = rules
+        self.limits = []
+        for rule in rules:
+            self.limits.append(_Limits(
+                rate if rule.rate is None else rule.rate,
+                burst if rule.burst is None else rule.burst,
+                concurrent if rule.concurrent is None else rule.concurrent))
+        self.sweep_interval = sweep_interval
+        self.stats = stats
+        self.buckets = {}
+        self._rule_cache = {}
+        self._next_sweep = clock.seconds() + sweep_interval
+        if stats is not None:
+            stats.set_gauge('ratelimit.keys', lambda: len(self.buckets))
+
+    def is_enabled(self):
+        return any(
+            limits.rate > 0 or limits.concurrent > 0
+            for limits in [self.default] + self.limits)
+
+    def _limits_for(self, uri):
+        cache = self._rule_cache
+        index = cache.get(uri, None)
+        if index is None:
+            index = -1
+            for n, rule in enumerate(self.rules):
+                if does_url_match_pattern(uri, rule.pattern):
+                    index = n
+                    break
+            if len(cache) >= self.rule_cache_size:
+                cache.clear()
+            cache[uri] = index
+        if index < 0:
+            return (index, self.default)
+        return (index, self.limits[index])
+
+    def acquire(self, key, uri):
+        """
+        Admit a request by `key` for `uri`.  Returns (bucket, retry_after).
+        If `retry_after` is None the request is admitted, and `release(bucket)`
+        must be called when it completes; otherwise it should be retried
+        after `retry_after` seconds.
+        """
+        now = self.clock.seconds()
+        if now >= self._next_sweep:
+            self.sweep(now)
+        index, limits = self._limits_for(uri)
+        rate = limits.rate
+        concurrent = limits.concurrent
+        if rate <= 0 and concurrent <= 0:
+            return (None, None)
+        bucket_key = (index, key)
+        bucket = self.buckets.get(bucket_key, None)
+        if bucket is None:
+            bucket = Bucket(limits.burst, now)
+            self.buckets[bucket_key] = bucket
+        if concurrent > 0 and bucket.active >= concurrent:
+            self._limited()
+            return (None, 1)
+        if rate > 0:
+            tokens = min(limits.burst, bucket.tokens + (now - bucket.updated) * rate)
+            bucket.updated = now
+            if tokens < 1:
+                bucket.tokens = tokens
+                self._limited()
+                return (None, (1 - tokens) / rate)
+            bucket.tokens = tokens - 1
+        bucket.active += 1
+        return (bucket, None)
+
+    def release(self, bucket):
+        if bucket is not None:
+            bucket.active -= 1
+
+    def _limited(self):
+        if self.stats is not None:
+            self.stats.incr('proxy.rate_limited')
+
+    def sweep(self, now=None):
+        """
+        Discard buckets with no requests in flight that have refilled.
+        """
+        if now is None:
+            now = self.clock.seconds()
+        self._next_sweep = now + self.sweep_interval
+        limits = self.limits
+        default = self.default
+        idle = []
+        for bucket_key, bucket in self.buckets.items():
+            if bucket.active > 0:
+                continue
+            index = bucket_key[0]
+            if index < 0:
+                rule_limits = default
+            else:
+                rule_limits = limits[index]
+            if rule_limits.rate <= 0 or (
+                    bucket.tokens + (now - bucket.updated) * rule_limits.rate >= rule_limits.burst):
+                idle.append(bucket_key)
+        for bucket_key in idle:
+            del self.buckets[bucket_key]
@@ -0,0 +1,174 @@
+
+#----------------------------------------------------------------------
+# Route requests to different proxied applications by path prefix and
+# (optionally) Host header.
+#----------------------------------------------------------------------
+
+from .interfaces import (
+    IResourceInterceptor,
+    IResponseContentModifier,
+    IRProxyInfoAcceptor)
+from . import proxyutils
+from yaml import safe_load
+
+
+class Route(object):
+    """
+    A proxied application mounted at `prefix`, optionally only for
+    requests whose Host header names `host`.  Request paths are passed to
+    the upstreams unchanged.
+
+    Of the route's plugins, only content modifiers, resource interceptors,
+    and proxy info acceptors are used.
+    """
+
+    def __init__(self, prefix, upstreams, agent, host=None,
+                    excluded_resources=None, excluded_branches=None, plugins=None):
+        self.prefix = normalize_prefix(prefix)
+        self.upstreams = upstreams
+        self.agent = agent
+        if host is not None:
+            host = host.lower()
+        self.host = host
+        if excluded_resources is None:
+            excluded_resources = set([])
+        if excluded_branches is None:
+            excluded_branches = set([])
+        self.excluded_resources = excluded_resources
+        self.excluded_branches = excluded_branches
+        if plugins is None:
+            plugins = []
+        self.plugins = plugins
+        content_modifiers = [p for p in plugins if IResponseContentModifier.providedBy(p)]
+        content_modifiers.sort(key=lambda x: x.mod_sequence)
+        self.content_modifiers = content_modifiers
+        interceptors = [p for p in plugins if IResourceInterceptor.providedBy(p)]
+        interceptors.sort(key=lambda x: x.interceptor_sequence)
+        self.interceptors = interceptors
+        self.info_acceptors = [p for p in plugins if IRProxyInfoAcceptor.providedBy(p)]
+
+    def is_excluded(self, path):
+        if path in self.excluded_resources:
+            return True
+        for excluded in self.excluded_branches:
+            if proxyutils.is_resource_or_child(excluded, path):
+                return True
+        return False
+
+
+def normalize_prefix(prefix):
+    if not prefix.startswith('/'):
+        prefix = '/' + prefix
+    if len(prefix) > 1 and prefix.endswith('/'):
+        prefix = prefix[:-1]
+    return prefix
+
+
+def _segments(path):
+    return [segment for segment in path.split('/') if segment != '']
+
+
+class RouteTrie(object):
+    """
+    Maps path prefixes to values.  Prefixes match whole path segments, and
+    the longest matching prefix wins.
+    """
+
+    def __init__(self):
+        self._root = [None, {}]
+
+    def insert(self, prefix, value):
+        node = self._root
+        for segment in _segments(prefix):
+            node = node[1].setdefault(segment, [None, {}])
+        if node[0] is not None:
+            raise ValueError("Duplicate route for prefix '{0}'.".format(prefix))
+        node[0] = value
+
+    def match(self, path):
+        node = self._root
+        best = node[0]
+        for segment in _segments(path):
+            node = node[1].get(segment, None)
+            if node is None:
+                break
+            if node[0] is not None:
+                best = node[0]
+        return best
+
+
+class Router(object):
+    """
+    Selects the route for a request.  Routes for a specific host are
+    preferred over routes for any host.
+    """
+
+    def __init__(self, routes):
+        self.routes = list(routes)
+        self._tries = {}
+        for route in self.routes:
+            trie = self._tries.setdefault(route.host, RouteTrie())
+            trie.insert(route.prefix, route)
+        self._any_host = self._tries.get(None, RouteTrie())
+        self.hosts = frozenset(host for host in self._tries if host is not None)
+
+    def route_host(self, host):
+        """
+        Returns the host named by a Host header if a route is limited to
+        it, or None.
+        """
+        if host is None:
+            return None
+        host = host.split(':', 1)[0].lower()
+        if host in self.hosts:
+            return host
+        return None
+
+    def route_for(self, host, path):
+        if host is not None:
+            trie = self._tries.get(host.split(':', 1)[0].lower(), None)
+            if trie is not None:
+                route = trie.match(path)
+                if route is not None:
+                    return route
+        return self._any_host.match(path)
+
+
+route_keys = frozenset([
+    'prefix', 'host', 'upstreams', 'exclude', 'exclude_branches', 'plugins'])
+
+
+def load_routes(filename):
+    """
+    Load route definitions from a YAML file with a top level `routes`
+    list.  Each route is a mapping with keys:
+
+    * `prefix` (required): The path prefix, e.g. '/wiki'.
+    * `upstreams` (required): A list of equivalent upstream base URLs.
+    * `host`: Only route requests for this host.
+    * `exclude`, `exclude_branches`: Resources not protected by CAS.
+    * `plugins`: Plugin arguments, as for the `plugin` option.
+    """
+    with open(filename, "r") as f:
+        doc = safe_load(f)
+    if not isinstance(doc, dict) or not isinstance(doc.get('routes', None), list):
+        raise ValueError("Routes file '{0}' must contain a `routes` list.".format(filename))
+    routes = []
+    for n, entry in enumerate(doc['routes']):
+        if not isinstance(entry, dict):
+            raise ValueError("Route {0} in '{1}' must be a mapping.".format(n, filename))
+        unknown = set(entry.keys()) - route_keys
+        if len(unknown) > 0:
+            raise ValueError("Route {0} in '{1}' has unknown keys: {2}.".format(
+                n, filename, ', '.join(sorted(unknown))))
+        if 'prefix' not in entry or len(entry.get('upstreams', [])) == 0:
+            raise ValueError("Route {0} in '{1}' requires `prefix` and `upstreams`.".format(
+                n, filename))
+        routes.append(dict(
+            prefix=entry['prefix'],
+            host=entry.get('host', None),
+            urls=list(entry['upstreams']),
+            excluded_resources=set(entry.get('exclude', [])),
+            excluded_branches=set(entry.get('exclude_branches', [])),
+            plugins=list(entry.get('plugins', []))))
+    return routes
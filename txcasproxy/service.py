@@ -2,7 +2,10 @@
 
 import sys
 from .txcasproxy import ProxyApp
+from .admin import AdminApp
 from .authinfo import AuthInfoApp
+from .slo_peers import SLOPeerProtocol, parse_peer
+from .tls_server import configure_frontend_tls
 from twisted.application.service import Service
 from twisted.internet import reactor
 from twisted.internet.endpoints import serverFromString
@@ -10,18 +13,36 @@ from twisted.web.server import Session, Site
 
 
 class ProxyService(Service):
-    def __init__(self, endpoint_s, proxied_url, cas_info, 
+    def __init__(self, endpoint_s, proxied_url, cas_info, upstream_info=None, routes=None,
+                    rate_limit_info=None, lag_interval=0.1, lag_threshold=0,
+                    shed_patterns=None, offload_info=None, static_info=None,
                     fqdn=None, authorities=None, plugins=None,
                     auth_info_resource=None, auth_info_endpoint_s=None,
+                    pgt_callback_resource=None, proxy_ticket_resource=None,
+                    slo_resource=None, slo_peers=None, slo_peer_port=None,
+                    slo_peer_interface='', slo_peer_secret=None,
+                    access_control_timeout=10, access_control_threads=10,
+                    attribute_headers=None, pool_connections=2,
+                    pool_probe_interval=30, pool_idle_timeout=240,
                     excluded_resources=None, excluded_branches=None,
                     remote_user_header=None, logout_patterns=None, 
                     logout_passthrough=False,
                     template_dir=None, template_resource=None, 
+                    template_auto_reload=True, template_bytecode_dir=None,
                     session_length=900, debug=False, verbose=False,
-                    proxy_client_endpoint_s=None, cas_client_endpoint_s=None): 
+                    proxy_client_endpoint_s=None, cas_client_endpoint_s=None,
+                    admin_endpoint_s=None, tls_session_timeout=300,
+                    tls_ticket_rotation=3600, tls_curves=None, tls_ciphers=None): 
         session_length = int(session_length)
+        self.tls_settings = dict(
+            session_timeout=int(tls_session_timeout),
+            ticket_rotation=int(tls_ticket_rotation),
+            curves=tls_curves,
+            ciphers=tls_ciphers)
+        self.tlsOptions = None
         self.port_s = endpoint_s
         self.auth_info_endpoint_s = auth_info_endpoint_s
+        self.admin_endpoint_s = admin_endpoint_s
         if endpoint_s.startswith("ssl:") or endpoint_s.startswith('tls:'):
             is_https = True
         else:
@@ -42,10 +63,29 @@ class ProxyService(Service):
             logout_passthrough=logout_passthrough,
             template_dir=template_dir,
             template_resource=template_resource,
+            template_auto_reload=template_auto_reload,
+            template_bytecode_dir=template_bytecode_dir,
             proxy_client_endpoint_s=proxy_client_endpoint_s,
-            cas_client_endpoint_s=cas_client_endpoint_s)
+            cas_client_endpoint_s=cas_client_endpoint_s,
+            pgt_callback_resource=pgt_callback_resource,
+            slo_resource=slo_resource,
+            access_control_timeout=access_control_timeout,
+            access_control_threads=access_control_threads,
+            attribute_headers=attribute_headers,
+            pool_connections=pool_connections,
+            pool_probe_interval=pool_probe_interval,
+            pool_idle_timeout=pool_idle_timeout,
+            upstream_info=upstream_info,
+            routes=routes,
+            rate_limit_info=rate_limit_info,
+            lag_interval=lag_interval,
+            lag_threshold=lag_threshold,
+            shed_patterns=shed_patterns,
+            offload_info=offload_info,
+            static_info=static_info)
         app.verbose = verbose
         app.auth_info_resource = auth_info_resource
+        app.proxy_ticket_resource = proxy_ticket_resource
         root = app.app.resource()
         self.app = app
         self.site = Site(root)
@@ -56,12 +96,30 @@ class ProxyService(Service):
             return s
         
         self.site.sessionFactory = sessionFactory
+        self.slo_peer_port = slo_peer_port
+        self.slo_peer_interface = slo_peer_interface
+        self.sloPeerProtocol = None
+        if slo_peer_port is not None:
+            peers = [parse_peer(peer) for peer in (slo_peers or [])]
+            self.sloPeerProtocol = SLOPeerProtocol(
+                reactor, peers, slo_peer_secret, app._expire_ticket, stats=app.stats)
+            app.slo_peer_channel = self.sloPeerProtocol
         self.site.displayTracebacks = debug
         self.listeningPorts = []
 
     def startService(self):
+        self.app.start_pool_warmers()
+        # The lag is only used for shedding and reported by the admin service.
+        lag_monitor = self.app.lag_monitor
+        if lag_monitor.threshold > 0 or self.admin_endpoint_s is not None:
+            lag_monitor.start()
         if self.port_s is not None:
             endpoint = serverFromString(reactor, self.port_s)
+            if self.port_s.startswith("ssl:"):
+                self.tlsOptions = configure_frontend_tls(
+                    endpoint, reactor, stats=self.app.stats, **self.tls_settings)
+                if self.tlsOptions is not None:
+                    self.tlsOptions.start()
             d = endpoint.listen(self.site)
             d.addCallback(self.register_port, 'app')
         if self.auth_info_endpoint_s is not None:
@@ -72,6 +130,20 @@ class ProxyService(Service):
             endpoint = serverFromString(reactor, self.auth_info_endpoint_s)
             d2 = endpoint.listen(authInfoSite)
             d2.addCallback(self.register_port, 'authInfoSite')
+        if self.sloPeerProtocol is not None:
+            port = reactor.listenUDP(
+                int(self.slo_peer_port), 
+                self.sloPeerProtocol, 
+                interface=self.slo_peer_interface)
+            self.listeningPorts.append(port)
+        if self.admin_endpoint_s is not None:
+            adminApp = AdminApp(self.app)
+            self.adminApp = adminApp
+            adminSite = Site(adminApp.app.resource())
+            adminSite.displayTracebacks = self.site.displayTracebacks
+            endpoint = serverFromString(reactor, self.admin_endpoint_s)
+            d3 = endpoint.listen(adminSite)
+            d3.addCallback(self.register_port, 'adminSite')
             
     def register_port(self, listeningPort, serviceName):
         self.listeningPorts.append(listeningPort)
@@ -80,9 +152,13 @@ class ProxyService(Service):
             self.app.port = host.port
             self.app.handle_port_set()
         if serviceName == 'authInfoSite':
-            self.app.authInfoCallback = self.authInfoApp.setAuthInfo
+            self.app.auth_info_callback = self.authInfoApp.setAuthInfo
 
     def stopService(self):
+        self.app.stop_pool_warmers()
+        self.app.lag_monitor.stop()
+        if self.tlsOptions is not None:
+            self.tlsOptions.stop()
         for listeningPort in self.listeningPorts:
             listeningPort.stopListening()
 
@@ -0,0 +1,156 @@
+
+#----------------------------------------------------------------------
+# CAS single logout (SLO) processing.
+# CAS notifies services of a terminated SSO session by POSTing a SAML
+# `LogoutRequest` whose `SessionIndex` is the service ticket.
+#----------------------------------------------------------------------
+
+import calendar
+import re
+from lxml import etree
+from twisted.python import log
+
+SAMLP_NS = "urn:oasis:names:tc:SAML:2.0:protocol"
+
+_logout_request_tag = "{%s}LogoutRequest" % SAMLP_NS
+_session_index_tag = "{%s}SessionIndex" % SAMLP_NS
+# Matches the start of a document whose root element is `LogoutRequest`
+# (with any namespace prefix) without parsing it.
+_root_re = re.compile(
+    rb'\s*(?:<\?xml[^>]*\?>\s*)?(?:<!--.*?-->\s*)*<(?:[A-Za-z_][\w.-]*:)?LogoutRequest[\s/>]',
+    re.DOTALL)
+_instant_re = re.compile(
+    r'(\d{4})-(\d{2})-(\d{2})T(\d{2}):(\d{2}):(\d{2})(?:\.\d+)?(Z|[+-]\d{2}:?\d{2})?$')
+_parser = etree.XMLParser(resolve_entities=False, no_network=True)
+
+
+def parse_instant(value):
+    """
+    Parse an xsd:dateTime of the form 'YYYY-MM-DDTHH:MM:SS[.fff][Z|+HH:MM]'
+    into seconds since the epoch.  A missing offset is treated as UTC.
+    Raises ValueError if `value` is not in that form.
+    """
+    m = _instant_re.match(value)
+    if m is None:
+        raise ValueError("Invalid instant '{0}'.".format(value))
+    year, month, day, hour, minute, second = [int(x) for x in m.groups()[:6]]
+    seconds = calendar.timegm((year, month, day, hour, minute, second, 0, 0, 0))
+    offset = m.group(7)
+    if offset is not None and offset != 'Z':
+        offset = offset.replace(':', '')
+        delta = int(offset[1:3]) * 3600 + int(offset[3:5]) * 60
+        if offset[0] == '+':
+            seconds -= delta
+        else:
+            seconds += delta
+    return seconds
+
+
+class LogoutRequestProcessor(object):
+    """
+    Validate SAML logout requests and expire the matching sessions in
+    batches.
+
+    `expire_ticket` is called with a service ticket and should return True
+    if a session was expired.
+    """
+    max_body_size = 16384
+    batch_size = 100
+    batch_delay = 0.05
+
+    def __init__(self, clock, expire_ticket, skew=5, stats=None, log=None):
+        """
+        `log` is a callable with the signature of `ProxyApp.log()`.
+        """
+        self.clock = clock
+        self.expire_ticket = expire_ticket
+        self.skew = skew
+        self.stats = stats
+        if log is not None:
+            self.log = log
+        self._pending = []
+        self._flush_call = None
+
+    def log(self, msg, important=False):
+        if important:
+            log.msg("[INFO] {0}".format(msg))
+
+    def _incr(self, name):
+        if self.stats is not None:
+            self.stats.incr(name)
+
+    def looks_like_logout_request(self, data):
+        return _root_re.match(data, 0, 1024) is not None
+
+    def process(self, data):
+        """
+        Accept a logout request document.  Returns True if it was a valid
+        logout request; its session is expired in the next batch.
+        """
+        if len(data) > self.max_body_size:
+            self._incr('slo.rejected')
+            self.log("Logout request exceeds {0} bytes.".format(self.max_body_size), important=True)
+            return False
+        if not self.looks_like_logout_request(data):
+            self._incr('slo.rejected')
+            self.log("Not a logout request.", important=True)
+            return False
+        try:
+            root = etree.fromstring(data, _parser)
+        except etree.XMLSyntaxError:
+            self._incr('slo.rejected')
+            self.log("Could not parse XML.", important=True)
+            return False
+        if root.tag != _logout_request_tag:
+            self._incr('slo.rejected')
+            self.log("Not a logout request.", important=True)
+            return False
+        instant = root.get('IssueInstant')
+        if instant is None:
+            self._incr('slo.rejected')
+            self.log("'IssueInstant' attribute missing from root.", important=True)
+            return False
+        try:
+            instant = parse_instant(instant)
+        except ValueError:
+            self._incr('slo.rejected')
+            self.log("Invalid issue_instant supplied: '{0}'.".format(instant), important=True)
+            return False
+        if abs(self.clock.seconds() - instant) > self.skew:
+            self._incr('slo.rejected')
+            self.log(
+                ("Issue instant was not within"
+                " {0} seconds of actual time.").format(self.skew), important=True)
+            return False
+        results = root.findall(_session_index_tag)
+        if len(results) != 1 or not results[0].text:
+            self._incr('slo.rejected')
+            self.log("Logout request must have exactly 1 `SessionIndex`.", important=True)
+            return False
+        self.enqueue(results[0].text.strip())
+        return True
+
+    def enqueue(self, ticket):
+        pending = self._pending
+        pending.append(ticket)
+        if len(pending) >= self.batch_size:
+            self.flush()
+        elif self._flush_call is None:
+            self._flush_call = self.clock.callLater(self.batch_delay, self.flush)
+
+    def flush(self):
+        if self._flush_call is not None:
+            if self._flush_call.active():
+                self._flush_call.cancel()
+            self._flush_call = None
+        pending = self._pending
+        self._pending = []
+        expire_ticket = self.expire_ticket
+        for ticket in pending:
+            if expire_ticket(ticket):
+                self._incr('slo.processed')
+            else:
+                self._incr('slo.unmatched')
+                self.log(
+                    ("No matching session for logout request "
+                    "for ticket '{0}'.").format(ticket))
@@ -0,0 +1,117 @@
+
+#----------------------------------------------------------------------
+# Single logout fan-out between proxy instances.
+# The instance that receives a CAS logout request broadcasts the service
+# ticket to its peers over UDP.  Messages are batched, deduplicated, and
+# authenticated with an HMAC over a shared secret.
+#----------------------------------------------------------------------
+
+import hashlib
+import hmac
+import json
+from .cache import TTLCache
+from twisted.internet.protocol import DatagramProtocol
+from twisted.python import log
+
+
+def parse_peer(peer_s):
+    """
+    Parse a 'host:port' peer specification.
+    """
+    host, port = peer_s.rsplit(':', 1)
+    return (host, int(port))
+
+
+class SLOPeerProtocol(DatagramProtocol):
+    """
+    Exchange batches of logged out service tickets with peer instances.
+
+    `expire_ticket` is called with each ticket received from a peer.
+    """
+    digest_size = hashlib.sha256().digest_size
+    max_datagram_size = 8192
+    batch_delay = 0.05
+    seen_ttl = 60
+
+    def __init__(self, clock, peers, secret, expire_ticket, stats=None):
+        self.clock = clock
+        self.peers = peers
+        if isinstance(secret, str):
+            secret = secret.encode('utf-8')
+        self.secret = secret
+        self.expire_ticket = expire_ticket
+        self.stats = stats
+        self._seen = TTLCache(clock, self.seen_ttl)
+        self._pending = []
+        self._flush_call = None
+
+    def _incr(self, name, amount=1):
+        if self.stats is not None:
+            self.stats.incr(name, amount)
+
+    def _sign(self, payload):
+        return hmac.new(self.secret, payload, hashlib.sha256).digest()
+
+    def broadcast(self, ticket):
+        """
+        Queue `ticket` to be sent to every peer.
+        """
+        if ticket in self._seen:
+            return
+        self._seen.set(ticket, True)
+        self._pending.append(ticket)
+        if self._flush_call is None:
+            self._flush_call = self.clock.callLater(self.batch_delay, self.flush)
+
+    def flush(self):
+        self._flush_call = None
+        pending = self._pending
+        self._pending = []
+        if self.transport is None or len(pending) == 0:
+            return
+        for payload in self._pack(pending):
+            datagram = self._sign(payload) + payload
+            for peer in self.peers:
+                self.transport.write(datagram, peer)
+            self._incr('slo.peer.sent')
+
+    def _pack(self, tickets):
+        """
+        Split `tickets` into JSON payloads that fit in a datagram.
+        """
+        limit = self.max_datagram_size - self.digest_size
+        batch = []
+        size = 2
+        for ticket in tickets:
+            item_size = len(json.dumps(ticket)) + 1
+            if len(batch) > 0 and size + item_size > limit:
+                yield json.dumps(batch).encode('utf-8')
+                batch = []
+                size = 2
+            batch.append(ticket)
+            size += item_size
+        if len(batch) > 0:
+            yield json.dumps(batch).encode('utf-8')
+
+    def datagramReceived(self, datagram, addr):
+        digest = datagram[:self.digest_size]
+        payload = datagram[self.digest_size:]
+        if not hmac.compare_digest(digest, self._sign(payload)):
+            self._incr('slo.peer.rejected')
+            log.msg("[INFO] Rejected SLO peer message from {0}.".format(addr))
+            return
+        try:
+            tickets = json.loads(payload.decode('utf-8'))
+        except ValueError:
+            self._incr('slo.peer.rejected')
+            return
+        self._incr('slo.peer.received')
+        seen = self._seen
+        expire_ticket = self.expire_ticket
+        for ticket in tickets:
+            if not isinstance(ticket, str) or ticket in seen:
+                continue
+            # Remember the ticket so a peer's rebroadcast is ignored.
+            seen.set(ticket, True)
+            if expire_ticket(ticket):
+                self._incr('slo.peer.processed')
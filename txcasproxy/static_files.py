@@ -0,0 +1,229 @@
+
+#----------------------------------------------------------------------
+# Serve static directories from an index built at startup.
+#----------------------------------------------------------------------
+
+import gzip
+import hashlib
+import os
+from twisted.web import http, resource, static
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+def parse_accept_encoding(value):
+    """
+    Returns a mapping of content coding => q-value.
+    """
+    codings = {}
+    for part in value.split(b','):
+        params = part.split(b';')
+        coding = params[0].strip().lower()
+        if coding == b'':
+            continue
+        q = 1.0
+        for param in params[1:]:
+            name, sep, q_value = param.partition(b'=')
+            if name.strip().lower() == b'q':
+                try:
+                    q = float(q_value)
+                except ValueError:
+                    q = 0.0
+        codings[coding] = q
+    return codings
+
+
+def choose_encoding(accept_encoding, available):
+    """
+    Returns the first coding in `available` that the `Accept-Encoding`
+    header value allows, or None.
+    """
+    if accept_encoding is None:
+        return None
+    codings = parse_accept_encoding(accept_encoding)
+    default = codings.get(b'*', 0.0)
+    for coding in available:
+        if codings.get(coding, default) > 0:
+            return coding
+    return None
+
+
+def etag_matches(if_none_match, etag):
+    """
+    Weak comparison of `etag` with an `If-None-Match` header value.
+    """
+    if if_none_match is None:
+        return False
+    if if_none_match.strip() == b'*':
+        return True
+    for candidate in if_none_match.split(b','):
+        candidate = candidate.strip()
+        if candidate.startswith(b'W/'):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+
+class StaticEntry(object):
+    """
+    An indexed file.  `variants` maps a content coding (None for the
+    file as is) to the content held in memory, and is empty for files
+    served from disk.
+    """
+
+    def __init__(self, path, size, mtime, content_type, encoding):
+        self.path = path
+        self.size = size
+        self.mtime = mtime
+        self.content_type = content_type
+        self.encoding = encoding
+        self.last_modified = http.datetimeToString(int(mtime))
+        self.variants = {}
+        self.etags = {}
+
+
+class StaticDirectory(resource.Resource):
+    """
+    Serves the files under `path`, indexed when the resource is created.
+
+    Files of at most `max_file_size` bytes are held in memory, up to
+    `memory` bytes in all, along with gzip and (if the `brotli` module is
+    installed) brotli variants that are at least 1/8 smaller.  Larger files
+    are streamed from disk by `twisted.web.static.File`.
+
+    Responses have strong ETags and honor `If-None-Match` and
+    `If-Modified-Since`.  Browsers may cache files for `max_age` seconds
+    (0 means they must revalidate), and `immutable` tells them not to
+    revalidate within that time.
+
+    Hidden files and directory listings are not served, and files added
+    after startup are not found.
+    """
+    isLeaf = True
+    default_type = 'text/html'
+    preferred_encodings = (b'br', b'gzip')
+    compress_level = 9
+
+    def __init__(self, path, memory=33554432, max_file_size=262144,
+                    max_age=300, immutable=False):
+        resource.Resource.__init__(self)
+        self.path = path
+        self.memory = memory
+        self.max_file_size = max_file_size
+        if max_age > 0:
+            cache_control = 'max-age={0}'.format(int(max_age))
+            if immutable:
+                cache_control = '{0}, immutable'.format(cache_control)
+        else:
+            cache_control = 'no-cache'
+        self.cache_control = cache_control.encode('ascii')
+        self.memory_used = 0
+        self.entries = {}
+        self.index()
+
+    def index(self):
+        """
+        Index the files under `path`.
+        """
+        entries = {}
+        # Real path => entry, for files reached through symbolic links.
+        loaded = {}
+        self.memory_used = 0
+        for dirpath, dirnames, filenames in os.walk(self.path, followlinks=True):
+            realdir = os.path.realpath(dirpath)
+            dirnames[:] = sorted(
+                name for name in dirnames
+                if not name.startswith('.') and
+                not self._is_ancestor(os.path.join(dirpath, name), realdir))
+            for filename in sorted(filenames):
+                if filename.startswith('.'):
+                    continue
+                path = os.path.join(dirpath, filename)
+                realpath = os.path.realpath(path)
+                entry = loaded.get(realpath, None)
+                if entry is None:
+                    entry = self._load(path)
+                    loaded[realpath] = entry
+                relpath = os.path.relpath(path, self.path).replace(os.sep, '/')
+                entries[relpath] = entry
+        self.entries = entries
+
+    def _is_ancestor(self, path, realdir):
+        """
+        Returns True if the directory `path` links back to `realdir` or
+        one of its parents.
+        """
+        realpath = os.path.realpath(path)
+        return realdir == realpath or realdir.startswith(realpath.rstrip(os.sep) + os.sep)
+
+    def _load(self, path):
+        st = os.stat(path)
+        content_type, encoding = static.getTypeAndEncoding(
+            os.path.basename(path),
+            static.File.contentTypes,
+            static.File.contentEncodings,
+            self.default_type)
+        entry = StaticEntry(path, st.st_size, st.st_mtime, content_type, encoding)
+        if st.st_size > self.max_file_size or self.memory_used + st.st_size > self.memory:
+            entry.etags[None] = '"{0:x}-{1:x}"'.format(
+                st.st_size, st.st_mtime_ns).encode('ascii')
+            return entry
+        with open(path, "rb") as f:
+            content = f.read()
+        digest = hashlib.blake2b(content, digest_size=16).hexdigest()
+        variants = {None: content}
+        if encoding is None:
+            variants[b'gzip'] = gzip.compress(content, self.compress_level, mtime=0)
+            if brotli is not None:
+                variants[b'br'] = brotli.compress(content)
+        for coding, data in list(variants.items()):
+            if coding is None or len(data) <= len(content) * 7 // 8:
+                self.memory_used += len(data)
+                entry.variants[coding] = data
+                suffix = '' if coding is None else '-' + coding.decode('ascii')
+                entry.etags[coding] = '"{0}{1}"'.format(digest, suffix).encode('ascii')
+        return entry
+
+    def render_GET(self, request):
+        relpath = b'/'.join(request.postpath).decode('utf-8', 'replace')
+        entry = self.entries.get(relpath, None)
+        if entry is None:
+            return resource.NoResource("File not found.").render(request)
+        variants = entry.variants
+        coding = None
+        if len(variants) > 1:
+            request.setHeader(b'Vary', b'Accept-Encoding')
+            coding = choose_encoding(
+                request.getHeader(b'Accept-Encoding'),
+                [c for c in self.preferred_encodings if c in variants])
+        etag = entry.etags[coding]
+        request.setHeader(b'ETag', etag)
+        request.setHeader(b'Cache-Control', self.cache_control)
+        request.setHeader(b'Last-Modified', entry.last_modified)
+        if_none_match = request.getHeader(b'If-None-Match')
+        if if_none_match is not None:
+            not_modified = etag_matches(if_none_match, etag)
+        else:
+            not_modified = False
+            if_modified_since = request.getHeader(b'If-Modified-Since')
+            if if_modified_since is not None:
+                try:
+                    since = http.stringToDatetime(if_modified_since.split(b';', 1)[0])
+                except ValueError:
+                    since = None
+                not_modified = since is not None and since >= int(entry.mtime)
+        if not_modified:
+            request.setResponseCode(http.NOT_MODIFIED)
+            return b''
+        if len(variants) == 0:
+            return static.File(entry.path).render_GET(request)
+        request.setHeader(b'Content-Type', entry.content_type.encode('ascii'))
+        if coding is not None:
+            request.setHeader(b'Content-Encoding', coding)
+        elif entry.encoding is not None:
+            request.setHeader(b'Content-Encoding', entry.encoding.encode('ascii'))
+        return variants[coding]
@@ -0,0 +1,74 @@
+
+import collections
+
+
+class Stats(object):
+    """
+    In-process counters, gauges, and latency samples.
+    """
+    sample_size = 1024
+
+    def __init__(self, sample_size=None):
+        if sample_size is not None:
+            self.sample_size = sample_size
+        self._counters = {}
+        self._gauges = {}
+        self._timings = {}
+
+    def incr(self, name, amount=1):
+        counters = self._counters
+        counters[name] = counters.get(name, 0) + amount
+
+    def set_gauge(self, name, value):
+        """
+        Set a gauge to a value or to a callable that is evaluated when a
+        snapshot is taken.
+        """
+        self._gauges[name] = value
+
+    def record_timing(self, name, seconds):
+        timing = self._timings.get(name, None)
+        if timing is None:
+            timing = {
+                'count': 0,
+                'total': 0.0,
+                'max': 0.0,
+                'samples': collections.deque(maxlen=self.sample_size)}
+            self._timings[name] = timing
+        timing['count'] += 1
+        timing['total'] += seconds
+        if seconds > timing['max']:
+            timing['max'] = seconds
+        timing['samples'].append(seconds)
+
+    def get(self, name, default=0):
+        return self._counters.get(name, default)
+
+    def snapshot(self):
+        gauges = {}
+        for name, value in self._gauges.items():
+            if callable(value):
+                value = value()
+            gauges[name] = value
+        timings = {}
+        for name, timing in self._timings.items():
+            count = timing['count']
+            samples = sorted(timing['samples'])
+            timings[name] = {
+                'count': count,
+                'mean': timing['total'] / count if count else 0.0,
+                'max': timing['max'],
+                'p50': percentile(samples, 50),
+                'p90': percentile(samples, 90),
+                'p99': percentile(samples, 99)}
+        return {
+            'counters': dict(self._counters),
+            'gauges': gauges,
+            'timings': timings}
+
+
+def percentile(sorted_samples, pct):
+    if len(sorted_samples) == 0:
+        return 0.0
+    index = int(round((pct / 100.0) * (len(sorted_samples) - 1)))
+    return sorted_samples[index]
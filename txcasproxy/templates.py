@@ -0,0 +1,113 @@
+
+#----------------------------------------------------------------------
+# Load, cache, and pre-render Jinja2 templates.
+#----------------------------------------------------------------------
+
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader, meta
+from jinja2.exceptions import TemplateError
+
+
+class TemplateRenderer(object):
+    """
+    Renders the templates in `template_dir` with a cached environment, so
+    each template is compiled once.  If `auto_reload` is True, a template
+    is compiled again when its file changes.  If `bytecode_dir` is set,
+    compiled templates are also kept there for the next start.
+
+    `context` holds values that are the same for every render.  A template
+    is context free if it (and every template it extends, includes, or
+    imports) only refers to names in `context`.  The output of a context
+    free template is rendered once and reused until one of its files
+    changes.  Callers must not pass different values for the names in
+    `context`.
+    """
+
+    def __init__(self, template_dir, context=None, auto_reload=True, bytecode_dir=None):
+        bytecode_cache = None
+        if bytecode_dir is not None:
+            bytecode_cache = FileSystemBytecodeCache(bytecode_dir)
+        self.env = Environment(
+            loader=FileSystemLoader(template_dir),
+            auto_reload=auto_reload,
+            bytecode_cache=bytecode_cache)
+        if context is None:
+            context = {}
+        self.context = context
+        # Template name => (templates the output depends on, output or None).
+        self._prerendered = {}
+
+    def get_template(self, template_name):
+        """
+        Returns the compiled template.  Raises `TemplateNotFound`.
+        """
+        return self.env.get_template(template_name)
+
+    def _template_names(self, template_name):
+        """
+        Returns the names of `template_name` and the templates it refers
+        to, or None if it is not context free.
+        """
+        env = self.env
+        names = set(self.context)
+        names.update(env.globals)
+        found = []
+        pending = [template_name]
+        while len(pending) > 0:
+            name = pending.pop()
+            if name in found:
+                continue
+            found.append(name)
+            source, filename, uptodate = env.loader.get_source(env, name)
+            ast = env.parse(source, name, filename)
+            if not meta.find_undeclared_variables(ast).issubset(names):
+                return None
+            for referenced in meta.find_referenced_templates(ast):
+                if referenced is None:
+                    return None
+                pending.append(referenced)
+        return found
+
+    def prerendered(self, template_name):
+        """
+        Returns the UTF-8 output of a context free template, or None if the
+        template needs a per request context.  Raises `TemplateNotFound`.
+        """
+        entry = self._prerendered.get(template_name, None)
+        if entry is not None:
+            templates, output = entry
+            get_template = self.env.get_template
+            if all(get_template(name) is template for name, template in templates):
+                return output
+        templates = ()
+        output = None
+        names = self._template_names(template_name)
+        if names is not None:
+            templates = tuple((name, self.env.get_template(name)) for name in names)
+            output = templates[0][1].render(**self.context).encode('utf-8')
+        else:
+            templates = ((template_name, self.env.get_template(template_name)),)
+        self._prerendered[template_name] = (templates, output)
+        return output
+
+    def prerender(self, template_names):
+        """
+        Render the context free templates among `template_names` now.
+        Templates that are missing or fail to render are skipped, so their
+        errors are reported when they are used.
+        """
+        for template_name in template_names:
+            try:
+                self.prerendered(template_name)
+            except TemplateError:
+                pass
+
+    def render(self, template_name, **kwargs):
+        """
+        Render a template to UTF-8.  Raises `TemplateNotFound`.
+        """
+        output = self.prerendered(template_name)
+        if output is not None:
+            return output
+        context = dict(self.context)
+        context.update(kwargs)
+        return self.get_template(template_name).render(**context).encode('utf-8')
@@ -0,0 +1,129 @@
+
+from twisted.internet import defer, reactor
+from twisted.trial import unittest
+from twisted.web import resource, server
+from twisted.web.client import HTTPConnectionPool
+from txcasproxy.service import ProxyService
+import treq
+
+SUCCESS = b"""<cas:serviceResponse xmlns:cas="http://www.yale.edu/tp/cas">
+  <cas:authenticationSuccess>
+    <cas:user>alice</cas:user>
+    <cas:attributes>
+      <cas:mail>alice@example.org</cas:mail>
+    </cas:attributes>
+  </cas:authenticationSuccess>
+</cas:serviceResponse>"""
+
+
+class FakeCAS(resource.Resource):
+    isLeaf = True
+
+    def render_GET(self, request):
+        return SUCCESS
+
+
+class FakeBackend(resource.Resource):
+    isLeaf = True
+
+    def render_GET(self, request):
+        return b"backend"
+
+
+class AuthInfoServiceTest(unittest.TestCase):
+    """
+    Log in through the proxy and read the auth info listener.
+    """
+
+    def listen(self, root):
+        port = reactor.listenTCP(0, server.Site(root), interface='127.0.0.1')
+        self.addCleanup(port.stopListening)
+        return port.getHost().port
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        cas_port = self.listen(FakeCAS())
+        backend_port = self.listen(FakeBackend())
+        self.service = ProxyService(
+            "tcp:0:interface=127.0.0.1",
+            "http://127.0.0.1:{0}/".format(backend_port),
+            dict(
+                login_url="http://127.0.0.1:{0}/login".format(cas_port),
+                service_validate_url="http://127.0.0.1:{0}/serviceValidate".format(cas_port),
+                logout_url=None),
+            fqdn='127.0.0.1',
+            upstream_info=dict(health_interval=0),
+            auth_info_resource='/_auth',
+            auth_info_endpoint_s="tcp:0:interface=127.0.0.1",
+            logout_patterns=[],
+            pool_connections=0)
+        self.service.startService()
+        self.addCleanup(self.service.stopService)
+        self.addCleanup(self.service.app.connectionPool.closeCachedConnections)
+        self.addCleanup(self.expire_all)
+        self.pool = HTTPConnectionPool(reactor, persistent=False)
+        # Wait for the listeners to be registered.
+        while len(self.service.listeningPorts) < 2:
+            yield deferLater(0.01)
+        ports = dict(
+            (p.factory is self.service.site, p.getHost().port)
+            for p in self.service.listeningPorts)
+        self.proxy_base = "http://127.0.0.1:{0}".format(ports[True])
+        self.auth_info_base = "http://127.0.0.1:{0}".format(ports[False])
+
+    @defer.inlineCallbacks
+    def login(self, ticket):
+        """
+        Present a service ticket to the proxy.  Returns the session cookies.
+        """
+        response = yield treq.get(
+            "{0}/x?ticket={1}".format(self.proxy_base, ticket),
+            allow_redirects=False, pool=self.pool)
+        yield response.content()
+        self.assertEqual(response.code, 302)
+        cookies = dict((c.name, c.value) for c in response.cookies())
+        self.assertEqual(len(cookies), 1)
+        defer.returnValue(cookies)
+
+    @defer.inlineCallbacks
+    def get_auth_info(self, username):
+        response = yield treq.get(
+            "{0}/{1}".format(self.auth_info_base, username), pool=self.pool)
+        body = yield response.json() if response.code == 200 else response.content()
+        defer.returnValue((response.code, body))
+
+    def expire(self, cookies):
+        uid = list(cookies.values())[0].encode('ascii')
+        self.service.site.getSession(uid).expire()
+
+    def expire_all(self):
+        for session in list(self.service.site.sessions.values()):
+            session.expire()
+
+    @defer.inlineCallbacks
+    def test_login_publishes_auth_info(self):
+        cookies = yield self.login('ST-1')
+        response = yield treq.get(
+            "{0}/_auth".format(self.proxy_base), cookies=cookies, pool=self.pool)
+        info = yield response.json()
+        self.assertEqual(info['username'], 'alice')
+        code, body = yield self.get_auth_info('alice')
+        self.assertEqual(code, 200)
+        self.assertEqual(body, {'mail': ['alice@example.org']})
+
+    @defer.inlineCallbacks
+    def test_withdrawn_with_last_session(self):
+        first = yield self.login('ST-1')
+        second = yield self.login('ST-2')
+        self.expire(first)
+        code, body = yield self.get_auth_info('alice')
+        self.assertEqual(code, 200)
+        self.expire(second)
+        code, body = yield self.get_auth_info('alice')
+        self.assertEqual(code, 404)
+
+
+def deferLater(delay):
+    d = defer.Deferred()
+    reactor.callLater(delay, d.callback, None)
+    return d
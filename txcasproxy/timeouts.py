@@ -0,0 +1,141 @@
+
+#----------------------------------------------------------------------
+# Deadlines for proxied requests.
+#----------------------------------------------------------------------
+
+import shlex
+from .urls import does_url_match_pattern, parse_url_pattern
+from twisted.internet import defer
+from twisted.internet.protocol import Protocol
+from twisted.python.failure import Failure
+from twisted.web.client import ResponseDone
+from twisted.web.http import PotentialDataLoss
+
+
+class TimeoutRule(object):
+    """
+    Timeouts for requests whose URI matches `pattern` (see `urls.py`).
+    A timeout of None uses the default.
+    """
+
+    def __init__(self, pattern, ttfb=None, total=None):
+        self.pattern_s = pattern
+        self.pattern = parse_url_pattern(pattern)
+        self.ttfb = ttfb
+        self.total = total
+
+
+def parse_timeout_rule(spec):
+    """
+    Parse a colon-separated key=value list, e.g.
+    'pattern=/reports/*:ttfb=120:total=600'.  Quote a pattern that
+    contains a colon.
+    """
+    parser = shlex.shlex(spec, posix=True)
+    parser.whitespace = ':'
+    parser.whitespace_split = True
+    parser.commenters = ''
+    settings = dict(tuple(token.split('=', 1)) for token in parser)
+    if 'pattern' not in settings:
+        raise ValueError("Timeout rule '{0}' must specify `pattern`.".format(spec))
+    timeouts = {}
+    for name in ('ttfb', 'total'):
+        if name in settings:
+            try:
+                timeouts[name] = float(settings[name])
+            except ValueError:
+                raise ValueError("Timeout rule '{0}' has an invalid `{1}`.".format(spec, name))
+    return TimeoutRule(settings['pattern'], **timeouts)
+
+
+class UpstreamTimeouts(object):
+    """
+    Chooses the time-to-first-byte and total timeouts for a proxied
+    request.  The first rule whose pattern matches the request URI
+    applies.  A timeout of 0 means no timeout.
+    """
+
+    def __init__(self, ttfb=60, total=300, rules=None):
+        self.ttfb = ttfb
+        self.total = total
+        if rules is None:
+            rules = []
+        self.rules = rules
+
+    def for_uri(self, uri):
+        """
+        Returns (ttfb, total) for request URI `uri`.
+        """
+        for rule in self.rules:
+            if does_url_match_pattern(uri, rule.pattern):
+                ttfb = rule.ttfb
+                if ttfb is None:
+                    ttfb = self.ttfb
+                total = rule.total
+                if total is None:
+                    total = self.total
+                return (ttfb, total)
+        return (self.ttfb, self.total)
+
+
+def add_deadline(d, timeout, clock):
+    """
+    Cancel `d` if it has not fired after `timeout` seconds.  Unlike
+    `Deferred.addTimeout`, any failure after the deadline (the agent
+    reports a cancelled request as `ResponseNeverReceived`, not
+    `CancelledError`) becomes a `TimeoutError`.
+    """
+    state = {'expired': False}
+
+    def _expire():
+        state['expired'] = True
+        d.cancel()
+
+    delayed_call = clock.callLater(timeout, _expire)
+
+    def _finished(result):
+        if delayed_call.active():
+            delayed_call.cancel()
+        if state['expired'] and isinstance(result, Failure):
+            return Failure(defer.TimeoutError(
+                "No response within {0} seconds.".format(timeout)))
+        return result
+
+    d.addBoth(_finished)
+    return d
+
+
+class _BodyReader(Protocol):
+
+    def __init__(self, finished):
+        self.finished = finished
+        self.data = []
+
+    def dataReceived(self, data):
+        self.data.append(data)
+
+    def connectionLost(self, reason):
+        if self.finished.called:
+            return
+        if reason.check(ResponseDone, PotentialDataLoss):
+            self.finished.callback(b''.join(self.data))
+        else:
+            self.finished.errback(reason)
+
+
+def read_body(response):
+    """
+    Read the body of `response`.  Unlike `readBody`, cancelling closes the
+    upstream connection even when the response is a treq wrapper (which
+    hides the transport's `abortConnection`), so the pool discards it.
+    """
+
+    def _cancel(d):
+        transport = reader.transport
+        if transport is not None:
+            transport.loseConnection()
+
+    d = defer.Deferred(_cancel)
+    reader = _BodyReader(d)
+    response.deliverBody(reader)
+    return d
@@ -0,0 +1,154 @@
+
+#----------------------------------------------------------------------
+# Session resumption, ticket-key rotation, and handshake statistics for
+# the frontend TLS listener.
+#----------------------------------------------------------------------
+
+import time
+import weakref
+from .ca_trust import session_reused
+from OpenSSL import SSL
+from OpenSSL._util import lib as _lib
+from twisted.internet.interfaces import IOpenSSLServerConnectionCreator
+from twisted.internet.task import LoopingCall
+from twisted.python import log
+from zope.interface import implementer
+
+
+@implementer(IOpenSSLServerConnectionCreator)
+class FrontendTLSOptions(object):
+    """
+    Wraps the `CertificateOptions` created for an `ssl:` server endpoint.
+
+    * Session IDs are cached for `session_timeout` seconds.
+    * Session tickets are enabled.  Every `ticket_rotation` seconds the
+      context is rebuilt, which generates new ticket keys (and empties
+      the session cache).  A rotation of 0 keeps the keys for the life
+      of the process.
+    * `curves` is an OpenSSL groups list (e.g. 'X25519:P-256') and
+      `ciphers` an OpenSSL cipher list (TLS 1.2 and earlier), applied in
+      server preference order.
+    """
+
+    def __init__(self, options, clock, session_timeout=300, ticket_rotation=3600,
+                    curves=None, ciphers=None, stats=None):
+        self.options = options
+        self.clock = clock
+        self.session_timeout = session_timeout
+        self.ticket_rotation = ticket_rotation
+        self.curves = curves
+        self.ciphers = ciphers
+        self.stats = stats
+        self._context = None
+        self._handshakes = weakref.WeakKeyDictionary()
+        self._rotateLoop = None
+        # Twisted disables tickets and the session cache unless asked.
+        options.enableSessions = True
+        options.enableSessionTickets = True
+        options._options &= ~SSL.OP_NO_TICKET
+        if stats is not None:
+            stats.set_gauge('tls.server.resumption_rate', self.resumption_rate)
+
+    def start(self):
+        if self.ticket_rotation > 0:
+            self._rotateLoop = LoopingCall(self.rotate)
+            self._rotateLoop.clock = self.clock
+            self._rotateLoop.start(self.ticket_rotation, now=False)
+
+    def stop(self):
+        if self._rotateLoop is not None and self._rotateLoop.running:
+            self._rotateLoop.stop()
+        self._rotateLoop = None
+
+    def rotate(self):
+        """
+        Discard the current context.  The next connection builds a new one
+        with fresh session ticket keys.
+        """
+        self.options._context = None
+        self._context = None
+        if self.stats is not None:
+            self.stats.incr('tls.server.ticket_key_rotations')
+
+    def resumption_rate(self):
+        stats = self.stats
+        handshakes = stats.get('tls.server.handshakes')
+        if handshakes == 0:
+            return 0.0
+        return float(stats.get('tls.server.resumed')) / handshakes
+
+    def getContext(self):
+        ctx = self.options.getContext()
+        if ctx is not self._context:
+            self._configureContext(ctx)
+            self._context = ctx
+        return ctx
+
+    def serverConnectionForTLS(self, tlsProtocol):
+        self.getContext()
+        return self.options.serverConnectionForTLS(tlsProtocol)
+
+    def _configureContext(self, ctx):
+        ctx.set_timeout(self.session_timeout)
+        ctx.set_options(SSL.OP_CIPHER_SERVER_PREFERENCE)
+        if self.ciphers is not None:
+            ctx.set_cipher_list(self.ciphers.encode('ascii'))
+        if self.curves is not None:
+            # pyOpenSSL only wraps setting a single curve.
+            if not _lib.SSL_CTX_set1_curves_list(ctx._context, self.curves.encode('ascii')):
+                raise ValueError("Invalid TLS curves list '{0}'.".format(self.curves))
+        ctx.set_info_callback(self._infoCallback)
+
+    def _infoCallback(self, connection, where, ret):
+        """
+        Track handshake CPU time.  OpenSSL reports each state change
+        (`ACCEPT_LOOP`) and each return from the handshake function
+        (`ACCEPT_EXIT`), so the time between the first state change of a
+        call and its return is time spent in the handshake rather than
+        waiting on the network.
+        """
+        handshakes = self._handshakes
+        if where & _lib.SSL_CB_ACCEPT_LOOP:
+            now = time.process_time()
+            state = handshakes.get(connection, None)
+            if state is None:
+                handshakes[connection] = [now, 0.0]
+            elif state[0] is None:
+                state[0] = now
+            else:
+                state[1] += now - state[0]
+                state[0] = now
+        elif where & _lib.SSL_CB_ACCEPT_EXIT:
+            state = handshakes.get(connection, None)
+            if state is not None and state[0] is not None:
+                state[1] += time.process_time() - state[0]
+                state[0] = None
+        if where & _lib.SSL_CB_HANDSHAKE_DONE:
+            state = handshakes.pop(connection, None)
+            if state is None:
+                return
+            if state[0] is not None:
+                state[1] += time.process_time() - state[0]
+            stats = self.stats
+            if stats is None:
+                return
+            stats.incr('tls.server.handshakes')
+            if session_reused(connection):
+                stats.incr('tls.server.resumed')
+            stats.record_timing('tls.server.handshake_cpu', state[1])
+
+
+def configure_frontend_tls(endpoint, clock, **kwds):
+    """
+    Wrap the TLS options of an `ssl:` server endpoint in
+    `FrontendTLSOptions`.  Returns the wrapper, or None if `endpoint` is
+    not an SSL server endpoint.
+    """
+    options = getattr(endpoint, '_sslContextFactory', None)
+    if options is None or not hasattr(options, 'enableSessionTickets'):
+        log.msg("[WARN] Frontend TLS options only apply to `ssl:` endpoints.")
+        return None
+    tls_options = FrontendTLSOptions(options, clock, **kwds)
+    endpoint._sslContextFactory = tls_options
+    return tls_options
+
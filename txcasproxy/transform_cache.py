@@ -0,0 +1,76 @@
+
+#----------------------------------------------------------------------
+# Reuse the output of response content modifiers.
+#----------------------------------------------------------------------
+
+import hashlib
+from .cache import LRUCache
+
+
+def _weigh(value):
+    return len(value)
+
+
+class TransformCache(object):
+    """
+    Maps (proxy URL, upstream body digest, content modifier chain) to the
+    transformed body of a 200 response, in at most `max_bytes`.
+
+    The upstream's ETag is not used in place of the digest, since a backend
+    may send the same ETag for pages personalized for different users.
+    Only chains in which every content modifier sets
+    `mod_cacheable = True` (its output depends only on the URL and the
+    content) are cached.  A modifier may set `mod_cache_key` to a value
+    that changes with its configuration, so changing the configuration
+    stops old entries from being used.
+    """
+
+    def __init__(self, max_bytes=67108864, stats=None):
+        self.stats = stats
+        self.entries = LRUCache(max_bytes, weigh=_weigh)
+        if stats is not None:
+            stats.set_gauge('transform_cache.bytes', lambda: self.entries.weight)
+
+    def _incr(self, name):
+        if self.stats is not None:
+            self.stats.incr(name)
+
+    def chain_key(self, modifiers):
+        """
+        Returns a key for the ordered `modifiers`, or None if any of them
+        may not be cached.
+        """
+        parts = []
+        for modifier in modifiers:
+            if not getattr(modifier, 'mod_cacheable', False):
+                return None
+            cls = modifier.__class__
+            parts.append((
+                cls.__module__,
+                cls.__name__,
+                getattr(modifier, 'mod_cache_key', None)))
+        return tuple(parts)
+
+    def key_for(self, url, response, body, chain_key):
+        """
+        Returns the cache key for the body of `response` requested at
+        `url`, or None if it may not be cached.
+        """
+        if chain_key is None or response.code != 200:
+            return None
+        digest = hashlib.blake2b(body, digest_size=16).digest()
+        return (url, digest, chain_key)
+
+    def get(self, key):
+        value = self.entries.get(key, None)
+        if value is None:
+            self._incr('transform_cache.misses')
+        else:
+            self._incr('transform_cache.hits')
+        return value
+
+    def set(self, key, value):
+        self.entries.set(key, value)
+
+    def clear(self):
+        self.entries.clear()
@@ -2,40 +2,59 @@
 
 import http.cookies as Cookie
 import http.cookiejar
-import datetime
 import json
+import math
 import os.path
 import socket
 import sys
 from urllib.parse import urlencode
 from urllib import parse as urlparse
+from .access import AccessControlEvaluator
+from .attribute_headers import AttributeHeaderMap
+from .backpressure import CircuitBreaker, ConcurrencyLimiter
+from .cache import TTLCache
+from . import cas_response
+from .cas_response import CASBackchannelError, TicketRejectedError
 from .ca_trust import CustomPolicyForHTTPS
+from .hedging import HedgingPolicy, RetryBudget
+from .lag import LagMonitor
+from .offload import ContentOffloader
 from .interfaces import (
         IAccessControl,
         IRProxyInfoAcceptor, 
         IResponseContentModifier,
         ICASRedirectHandler, IResourceInterceptor,
         IStaticResourceProvider)
+from . import authinfo
 from . import proxyutils
+from .routing import Route, Router
+from .slo import LogoutRequestProcessor
+from .proxy_tickets import ProxyTicketBroker
+from .ratelimit import RateLimiter
+from .static_files import StaticDirectory
+from .stats import Stats
+from .templates import TemplateRenderer
+from .timeouts import add_deadline, read_body, UpstreamTimeouts
+from .transform_cache import TransformCache
+from .upstreams import UpstreamPool
+from .warmup import PoolWarmer
 from .urls import does_url_match_pattern, parse_url_pattern
 from .web_client import WebClientEndpointFactory
 from .websocket_proxy import makeWebsocketProxyResource
-from dateutil.parser import parse as parse_date
-from jinja2 import Environment, FileSystemLoader
 from jinja2.exceptions import TemplateNotFound
 from klein import Klein
 from OpenSSL import crypto
 import treq
 from treq.client import HTTPClient
-from twisted.internet import defer, reactor
+from twisted.internet import defer, error, reactor
 from twisted.internet.ssl import Certificate
 from twisted.python import log
+from twisted.python.failure import Failure
 import twisted.web.client as twclient
 from twisted.web.client import BrowserLikePolicyForHTTPS, Agent
 from twisted.web.client import HTTPConnectionPool
+from twisted.web.http_headers import Headers
 from twisted.web.resource import Resource
-from twisted.web.static import File
-from lxml import etree
 
 
 class ProxyApp(object):
@@ -49,6 +68,9 @@ class ProxyApp(object):
     pgturl_name = 'pgtUrl'
     reactor = reactor
     auth_info_resource = None
+    proxy_ticket_resource = None
+    pgt_broker = None
+    slo_peer_channel = None
     auth_info_callback = None
     remoteUserHeader = 'Remote-User'
     logout_patterns = None
@@ -56,6 +78,33 @@ class ProxyApp(object):
     verbose = False
     proxy_client_endpoint_s = None
     cas_client_endpoint_s = None
+    cas_validate_timeout = 10
+    cas_max_concurrent = 20
+    cas_max_queued = 100
+    cas_breaker_failures = 5
+    cas_breaker_reset = 30
+    rejected_ticket_ttl = 300
+    proxy_ticket_ttl = 5
+    validate_format = 'XML'
+    upstream_balance = 'least-outstanding'
+    upstream_eject_failures = 3
+    upstream_eject_time = 30
+    upstream_health_interval = 10
+    upstream_health_path = '/'
+    upstream_retry_budget = 0.1
+    upstream_connect_timeout = 10
+    upstream_ttfb_timeout = 60
+    upstream_total_timeout = 300
+    rate_limit = 0
+    rate_limit_burst = 20
+    user_max_concurrent = 0
+    templates = None
+    error_templates = (
+        'error/403.jinja2',
+        'error/429.jinja2',
+        'error/500.jinja2',
+        'error/503.jinja2',
+        'error/504.jinja2')
     
     def __init__(self, proxied_url, cas_info, 
             fqdn=None, authorities=None, plugins=None, is_https=True,
@@ -63,14 +112,22 @@ class ProxyApp(object):
             remote_user_header=None, logout_patterns=None,
             logout_passthrough=False,
             template_dir=None, template_resource='/_templates',
-            proxy_client_endpoint_s=None, cas_client_endpoint_s=None):
+            proxy_client_endpoint_s=None, cas_client_endpoint_s=None,
+            pgt_callback_resource=None, slo_resource=None,
+            access_control_timeout=10, access_control_threads=10,
+            attribute_headers=None, pool_connections=2, pool_probe_interval=30,
+            pool_idle_timeout=240, upstream_info=None, routes=None,
+            rate_limit_info=None, lag_interval=0.1, lag_threshold=0,
+            shed_patterns=None, offload_info=None, static_info=None,
+            template_auto_reload=True, template_bytecode_dir=None):
+        if static_info is None:
+            static_info = {}
+        self.static_info = static_info
         self.proxy_client_endpoint_s = proxy_client_endpoint_s
         self.cas_client_endpoint_s = cas_client_endpoint_s
         self.logout_passthrough = logout_passthrough
         self.template_dir = template_dir
         if template_dir is not None:
-            self.template_loader_ = FileSystemLoader(template_dir)
-            self.template_env_ = Environment()
             self.templateStaticResource_ = self.create_template_static_resource()
         if template_resource is not None:
             if not template_resource.endswith('/'):
@@ -80,6 +137,19 @@ class ProxyApp(object):
             self.static = self.app.route(static_base, branch=True)(self.__class__.static)
             self.static_base = static_base
         self.template_resource = template_resource
+        if template_dir is not None:
+            self.templates = TemplateRenderer(
+                template_dir,
+                context=dict(static_base=self.get_template_static_base()),
+                auto_reload=template_auto_reload,
+                bytecode_dir=template_bytecode_dir)
+            self.templates.prerender(self.error_templates)
+        self.pgt_callback_resource = pgt_callback_resource
+        if pgt_callback_resource is not None:
+            self.app.route(pgt_callback_resource)(self.__class__.pgt_callback)
+        self.slo_resource = slo_resource
+        if slo_resource is not None:
+            self.app.route(slo_resource)(self.__class__.slo)
         if logout_patterns is not None:
             self.logout_patterns = [parse_url_pattern(pattern) for pattern in logout_patterns]
         for pattern in self.logout_patterns:
@@ -87,6 +157,7 @@ class ProxyApp(object):
                 "Logout pattern '{0}' must be a relative URL.".format(pattern))
         if remote_user_header is not None:
             self.remoteUserHeader = remote_user_header
+        self.identity_headers = AttributeHeaderMap(self.remoteUserHeader, attribute_headers)
         self.excluded_resources = excluded_resources
         self.excluded_branches = excluded_branches
         self.is_https = is_https
@@ -101,6 +172,32 @@ class ProxyApp(object):
         self.proxied_host = netloc.split(':')[0]
         self.proxied_path = p.path
         self.cas_info = cas_info
+        self.stats = Stats()
+        self._make_upstreams(upstream_info)
+        self._make_rate_limiter(rate_limit_info)
+        self.lag_monitor = LagMonitor(
+            self.reactor,
+            interval=float(lag_interval),
+            threshold=float(lag_threshold),
+            stats=self.stats)
+        if offload_info is None:
+            offload_info = {}
+        self.offloader = ContentOffloader(
+            self.reactor,
+            threads=int(offload_info.get('threads', 4)),
+            processes=int(offload_info.get('processes', 0)),
+            max_queued=int(offload_info.get('max_queued', 100)),
+            threshold=int(offload_info.get('threshold', 262144)),
+            templates=offload_info.get('templates', False),
+            stats=self.stats)
+        transform_cache_size = int(offload_info.get('transform_cache_size', 67108864))
+        self.transform_cache = None
+        if transform_cache_size > 0:
+            self.transform_cache = TransformCache(transform_cache_size, stats=self.stats)
+        if shed_patterns is None:
+            shed_patterns = []
+        self.shed_patterns = [parse_url_pattern(pattern) for pattern in shed_patterns]
+        self._make_cas_backchannel(cas_info)
         cas_param_names = set([])
         cas_param_names.add(self.ticket_name.lower())
         cas_param_names.add(self.service_name.lower())
@@ -111,7 +208,18 @@ class ProxyApp(object):
             fqdn = socket.getfqdn()
         self.fqdn = fqdn
         self.valid_sessions = {}
+        self.user_sessions = {}
         self.logout_tickets = {}
+        self.slo_processor = LogoutRequestProcessor(
+            self.reactor,
+            self._expire_logout_ticket,
+            skew=self.logout_instant_skew,
+            stats=self.stats,
+            log=self.log)
+        self.pool_connections = int(pool_connections)
+        self.pool_probe_interval = int(pool_probe_interval)
+        self.pool_idle_timeout = int(pool_idle_timeout)
+        self.pool_warmers = []
         self._make_agents(authorities)
         # Sort/tag plugins
         if plugins is None:
@@ -141,6 +249,12 @@ class ProxyApp(object):
         self.interceptors = interceptors
         access_control.sort(key=lambda x: x.ac_sequence)
         self.access_control = access_control
+        self.access_evaluator = AccessControlEvaluator(
+            self.reactor,
+            access_control,
+            timeout=float(access_control_timeout),
+            max_threads=int(access_control_threads),
+            stats=self.stats)
         # Create static resources.
         static_resources = {}
         for plugin in plugins:
@@ -155,9 +269,12 @@ class ProxyApp(object):
                     static_resources[plugin.static_resource_base] = plugin.static_resource_dir
         self.static_handlers = []
         for n, (resource_base, resource_dir) in enumerate(static_resources.items()):
-            handler = lambda self, request: File(resource_dir)
-            handler = self.app.route(resource_base, branch=True)(handler)
+            static_resource = self.make_static_resource(resource_dir)
+            handler = lambda self, request, static_resource=static_resource: static_resource
+            handler = self.app.route(
+                resource_base, branch=True, endpoint='static_resource_{0}'.format(n))(handler)
             self.static_handlers.append(handler)
+        self._make_routes(routes, plugins)
 
     def log(self, msg, important=False):
         if important or self.verbose:
@@ -170,17 +287,30 @@ class ProxyApp(object):
     def handle_port_set(self):
         fqdn = self.fqdn
         port = self.port
-        proxied_scheme = self.proxied_scheme
-        proxied_netloc = self.proxied_netloc
-        proxied_path = self.proxied_path
-        for plugin in self.info_acceptors:
-            plugin.proxy_fqdn = fqdn
-            plugin.proxy_port = port
-            plugin.proxied_scheme = proxied_scheme
-            plugin.proxied_netloc = proxied_netloc
-            plugin.proxied_path = proxied_path
-            plugin.handle_rproxy_info_set()
-            plugin.expire_session = self._expired
+        info_acceptors = [
+            (fqdn, self.proxied_scheme, self.proxied_netloc, self.proxied_path,
+                self.upstreams, self.info_acceptors)]
+        for route in self.router.routes:
+            if route is not self.default_route:
+                primary = route.upstreams.upstreams[0]
+                info_acceptors.append(
+                    (route.host or fqdn, primary.scheme, primary.netloc, primary.path,
+                        route.upstreams, route.info_acceptors))
+        for proxy_fqdn, proxied_scheme, proxied_netloc, proxied_path, upstreams, plugins in info_acceptors:
+            proxied_upstreams = tuple(
+                (upstream.netloc, upstream.path) for upstream in upstreams.upstreams)
+            for plugin in plugins:
+                plugin.proxy_fqdn = proxy_fqdn
+                plugin.proxy_port = port
+                plugin.proxied_scheme = proxied_scheme
+                plugin.proxied_netloc = proxied_netloc
+                plugin.proxied_path = proxied_path
+                plugin.proxied_upstreams = proxied_upstreams
+                plugin.handle_rproxy_info_set()
+                plugin.expire_session = self._expired
+        # Content modifiers may behave differently now.
+        if self.transform_cache is not None:
+            self.transform_cache.clear()
 
     def _make_agents(self, auth_files):
         """
@@ -188,23 +318,26 @@ class ProxyApp(object):
         * perform backchannel CAS ticket validation
         * proxy the target site
         """
-        self.connectionPool = HTTPConnectionPool(self.reactor)
-        if auth_files is None or len(auth_files) == 0:
-            agent = Agent(self.reactor, pool=self.connectionPool)
-        else:
-            extra_ca_certs = []
+        self.connectionPool = self._make_pool()
+        extra_ca_certs = []
+        if auth_files is not None:
             for ca_cert in auth_files:
                 with open(ca_cert, "rb") as f:
                     data = f.read()
-                    print(f"ca cert data: {data}")
                 cert = crypto.load_certificate(crypto.FILETYPE_PEM, data)
-                print(f"cert object: {cert}")
                 del data
                 extra_ca_certs.append(cert)
-            policy = CustomPolicyForHTTPS(extra_ca_certs)
-            agent = Agent(self.reactor, contextFactory=policy, pool=self.connectionPool)
+        # TLS contexts are built once per (host, port) and sessions are
+        # resumed on later connections to the same host.
+        policy = CustomPolicyForHTTPS(extra_ca_certs, stats=self.stats)
+        self.tls_policy = policy
+        agent = Agent(
+            self.reactor,
+            contextFactory=policy,
+            connectTimeout=self.connect_timeout,
+            pool=self.connectionPool)
         if self.proxy_client_endpoint_s is not None:
-            self.proxyConnectionPool = HTTPConnectionPool(self.reactor)
+            self.proxyConnectionPool = self._make_pool()
             self.proxy_agent = Agent.usingEndpointFactory(
                 self.reactor,
                 WebClientEndpointFactory(self.reactor, self.proxy_client_endpoint_s),
@@ -212,7 +345,7 @@ class ProxyApp(object):
         else:
             self.proxy_agent = agent
         if self.cas_client_endpoint_s is not None:
-            self.casConnectionPool = HTTPConnectionPool(self.reactor)
+            self.casConnectionPool = self._make_pool()
             self.cas_agent = Agent.usingEndpointFactory(
                 self.reactor,
                 WebClientEndpointFactory(self.reactor, self.cas_client_endpoint_s),
@@ -220,29 +353,229 @@ class ProxyApp(object):
         else:
             self.cas_agent = agent
 
-    def is_excluded(self, request):
-        resource = request.path
-        if resource in self.excluded_resources:
-            return True
-        for excluded in self.excluded_branches:
-            if proxyutils.is_resource_or_child(excluded, resource):
-                return True
-        return False
+    def _make_upstreams(self, upstream_info):
+        """
+        Configure load balancing across `proxied_url` and any equivalent
+        upstream URLs.
+        """
+        if upstream_info is None:
+            upstream_info = {}
+        self.upstream_info = upstream_info
+        urls = [self.proxied_url] + list(upstream_info.get('urls', []))
+        self.upstreams = self._make_upstream_pool(urls)
+        retries = int(upstream_info.get('retries', 0))
+        hedge_delay = float(upstream_info.get('hedge_delay', 0))
+        self.upstream_policy = None
+        if retries > 0 or hedge_delay > 0:
+            self.upstream_policy = HedgingPolicy(
+                self.reactor,
+                max_retries=retries,
+                hedge_delay=hedge_delay,
+                budget=RetryBudget(
+                    ratio=float(upstream_info.get('retry_budget', self.upstream_retry_budget))),
+                stats=self.stats)
+        connect_timeout = float(
+            upstream_info.get('connect_timeout', self.upstream_connect_timeout))
+        if connect_timeout <= 0:
+            connect_timeout = None
+        self.connect_timeout = connect_timeout
+        self.upstream_timeouts = UpstreamTimeouts(
+            ttfb=float(upstream_info.get('ttfb_timeout', self.upstream_ttfb_timeout)),
+            total=float(upstream_info.get('total_timeout', self.upstream_total_timeout)),
+            rules=upstream_info.get('timeout_rules', None))
+
+    def _make_rate_limiter(self, rate_limit_info):
+        """
+        Configure per-user rate limits and concurrency caps for proxied
+        requests, if any are enabled.
+        """
+        if rate_limit_info is None:
+            rate_limit_info = {}
+        limiter = RateLimiter(
+            self.reactor,
+            rate=float(rate_limit_info.get('rate', self.rate_limit)),
+            burst=float(rate_limit_info.get('burst', self.rate_limit_burst)),
+            concurrent=int(rate_limit_info.get('concurrent', self.user_max_concurrent)),
+            rules=rate_limit_info.get('rules', None),
+            stats=self.stats)
+        if not limiter.is_enabled():
+            limiter = None
+        self.rate_limiter = limiter
+
+    def _make_upstream_pool(self, urls):
+        upstream_info = self.upstream_info
+        return UpstreamPool(
+            self.reactor,
+            urls,
+            balance=upstream_info.get('balance', self.upstream_balance),
+            affinity=upstream_info.get('affinity', False),
+            eject_failures=int(upstream_info.get('eject_failures', self.upstream_eject_failures)),
+            eject_time=float(upstream_info.get('eject_time', self.upstream_eject_time)),
+            health_interval=float(
+                upstream_info.get('health_interval', self.upstream_health_interval)),
+            health_path=upstream_info.get('health_path', self.upstream_health_path),
+            stats=self.stats)
+
+    def _make_routes(self, routes, plugins):
+        """
+        Build the router.  The default route serves `proxied_url` at '/'.
+        Each of `routes` mounts another application, with its own
+        upstreams and connection pool, at a path prefix.
+        """
+        default_route = Route(
+            '/',
+            self.upstreams,
+            self.proxy_agent,
+            excluded_resources=self.excluded_resources,
+            excluded_branches=self.excluded_branches,
+            plugins=plugins)
+        self.default_route = default_route
+        all_routes = [default_route]
+        if routes is None:
+            routes = []
+        for route_info in routes:
+            agent = Agent(
+                self.reactor,
+                contextFactory=self.tls_policy,
+                connectTimeout=self.connect_timeout,
+                pool=self._make_pool())
+            all_routes.append(Route(
+                route_info['prefix'],
+                self._make_upstream_pool(route_info['urls']),
+                agent,
+                host=route_info.get('host', None),
+                excluded_resources=route_info.get('excluded_resources', None),
+                excluded_branches=route_info.get('excluded_branches', None),
+                plugins=route_info.get('plugins', None)))
+        self.router = Router(all_routes)
+        # Upstream netloc => (path, host of its route or None), for
+        # rewriting URLs that refer to any upstream as URLs on the proxy.
+        upstream_paths = {}
+        for route in reversed(all_routes):
+            for upstream in route.upstreams.upstreams:
+                upstream_paths[upstream.netloc] = (upstream.path, route.host)
+        self.upstream_paths = upstream_paths
+
+    def _make_pool(self):
+        """
+        Create a persistent connection pool that can hold the pre-warmed
+        connections.  Idle connections are closed after `pool_idle_timeout`
+        seconds, which should be shorter than the servers' keep-alive
+        timeouts so a request is never sent on a connection the server is
+        closing.
+        """
+        pool = HTTPConnectionPool(self.reactor)
+        pool.maxPersistentPerHost = max(pool.maxPersistentPerHost, self.pool_connections)
+        pool.cachedConnectionTimeout = self.pool_idle_timeout
+        return pool
+
+    def start_pool_warmers(self):
+        """
+        Open persistent connections to the proxied site and to CAS, and
+        periodically probe them.
+        """
+        self.pool_warmers = [
+            PoolWarmer(
+                self.reactor, route.agent, upstream.url + '/',
+                connections=self.pool_connections,
+                interval=self.pool_probe_interval,
+                stats=self.stats,
+                name='pool.proxy')
+            for route in self.router.routes
+            for upstream in route.upstreams.upstreams]
+        self.pool_warmers.append(
+            PoolWarmer(
+                self.reactor, self.cas_agent, self.cas_info['service_validate_url'],
+                connections=self.pool_connections,
+                interval=self.pool_probe_interval,
+                stats=self.stats,
+                name='pool.cas'))
+        for warmer in self.pool_warmers:
+            warmer.start()
+        for route in self.router.routes:
+            route.upstreams.start(route.agent)
 
-    def mod_headers(self, h):
+    def stop_pool_warmers(self):
+        for warmer in self.pool_warmers:
+            warmer.stop()
+        self.pool_warmers = []
+        for route in self.router.routes:
+            route.upstreams.stop()
+
+    def _make_cas_backchannel(self, cas_info):
+        """
+        Configure the concurrency limiter and circuit breaker that guard
+        backchannel CAS ticket validation.
+        """
+        self.cas_validate_timeout = float(
+            cas_info.get('validate_timeout', self.cas_validate_timeout))
+        self.cas_limiter = ConcurrencyLimiter(
+            self.reactor,
+            max_concurrent=int(cas_info.get('max_concurrent', self.cas_max_concurrent)),
+            max_queued=int(cas_info.get('max_queued', self.cas_max_queued)),
+            stats=self.stats,
+            name='cas.validate')
+        self.cas_breaker = CircuitBreaker(
+            self.reactor,
+            failure_threshold=int(cas_info.get('breaker_failures', self.cas_breaker_failures)),
+            reset_timeout=float(cas_info.get('breaker_reset', self.cas_breaker_reset)),
+            stats=self.stats,
+            name='cas.breaker')
+        validate_format = cas_info.get('validate_format', None)
+        if validate_format is None:
+            validate_format = self.validate_format
+        validate_format = validate_format.upper()
+        if validate_format not in cas_response.parsers:
+            raise Exception("Unsupported CAS validation response format '{0}'.".format(
+                validate_format))
+        self.validate_format = validate_format
+        self.sv_parser = cas_response.parsers[validate_format]
+        self._inflight_validations = {}
+        if self.pgt_callback_resource is not None:
+            proxy_url = cas_info.get('proxy_url', None)
+            if proxy_url is None:
+                parts = cas_info['login_url'].split('/')
+                parts[-1] = "proxy"
+                proxy_url = '/'.join(parts)
+            self.pgt_broker = ProxyTicketBroker(
+                self.reactor,
+                proxy_url,
+                self._fetch_proxy_ticket,
+                pt_ttl=float(cas_info.get('proxy_ticket_ttl', self.proxy_ticket_ttl)),
+                stats=self.stats)
+        self.rejected_tickets = TTLCache(
+            self.reactor,
+            float(cas_info.get('rejected_ticket_ttl', self.rejected_ticket_ttl)))
+
+    def is_excluded(self, request, route=None):
+        if route is None:
+            route = self.default_route
+        return route.is_excluded(request.path.decode())
+
+    def mod_headers(self, h, upstream=None):
+        if upstream is None:
+            proxied_netloc = self.proxied_netloc
+        else:
+            proxied_netloc = upstream.netloc
         keymap = {}
-        for k,v in h.items():
+        is_protected = self.identity_headers.is_protected
+        for k,v in list(h.items()):
             key = k.lower()
+            if isinstance(key, bytes):
+                key = key.decode('latin-1')
+            if is_protected(key):
+                del h[k]
+                continue
             if key in keymap:
                 keymap[key].append(k)
             else:
                 keymap[key] = [k]
         if 'host' in keymap:
             for k in keymap['host']:
-                h[k] = [self.proxied_netloc]
+                h[k] = [proxied_netloc]
         if 'origin' in keymap:
             for k in keymap['origin']:
-                h[k] = [self.proxied_netloc]
+                h[k] = [proxied_netloc]
         if 'content-length' in keymap:
             for k in keymap['content-length']:
                 del h[k]
@@ -254,7 +587,7 @@ class ProxyApp(object):
                 values = h[k]
                 if len(values) == 1:
                     referer = values[0]
-                    new_referer = self.proxy_url_to_proxied_url(referer)
+                    new_referer = self.proxy_url_to_proxied_url(referer, upstream=upstream)
                     if new_referer is not None:
                         h[k] = [new_referer]
                         self.log("Re-wrote Referer header: '%s' => '%s'" % (referer, new_referer))
@@ -265,51 +598,48 @@ class ProxyApp(object):
         return h
 
     def _check_for_logout(self, request):
-        data = request.content.read()
-        samlp_ns = "{urn:oasis:names:tc:SAML:2.0:protocol}"
-        try:
-            root = etree.fromstring(data)
-        except Exception as ex:
-            root = None
-        if (root is not None) and (root.tag == "%sLogoutRequest" % samlp_ns):
-            instant = root.get('IssueInstant')
-            if instant is not None:
-                try:
-                    instant = parse_date(instant)
-                except ValueError:
-                    self.log("Invalid issue_instant supplied: '{0}'.".format(instant), important=True)
-                    instant = None
-                if instant is not None:
-                    utcnow = datetime.datetime.utcnow()
-                    seconds = abs((utcnow - instant.replace(tzinfo=None)).total_seconds())
-                    if seconds <= self.logout_instant_skew:
-                        results = root.findall("%sSessionIndex" % samlp_ns)
-                        if len(results) == 1:
-                            result = results[0]
-                            ticket = result.text
-                            sess_uid = self.logout_tickets.get(ticket, None)
-                            if sess_uid is not None:
-                                self._expired(sess_uid)
-                                return True
-                            else:
-                                self.log(
-                                    ("No matching session for logout request "
-                                    "for ticket '{0}'.").format(ticket))
-                    else:
-                        self.log(
-                            ("Issue instant was not within"
-                            " {0} seconds of actual time.").format(
-                                self.logout_instant_skew), important=True)
-                else:
-                    self.log("Could not parse issue instant.", important=True)
-            else:
-                self.log("'IssueInstant' attribute missing from root.", important=True)
-        elif root is None:
-            self.log("Could not parse XML.", important=True)
+        data = request.content.read(self.slo_processor.max_body_size + 1)
+        return self.slo_processor.process(data)
+
+    def slo(self, request):
+        """
+        Dedicated single logout resource for CAS logout requests.
+        """
+        if request.method != b'POST':
+            request.setResponseCode(405)
+            return "Method Not Allowed - 405"
+        processor = self.slo_processor
+        values = request.args.get(b'logoutRequest', None)
+        if values is not None and len(values) == 1:
+            data = values[0]
+        else:
+            data = request.content.read(processor.max_body_size + 1)
+        if not processor.process(data):
+            request.setResponseCode(400)
+        return ""
+
+    def _expire_ticket(self, ticket):
+        sess_uid = self.logout_tickets.get(ticket, None)
+        if sess_uid is None:
+            return False
+        self._expired(sess_uid)
+        return True
+
+    def _expire_logout_ticket(self, ticket):
+        """
+        Expire the session for a logout request.  If this instance has no
+        matching session, a peer instance may; pass the ticket on.
+        """
+        if self._expire_ticket(ticket):
+            return True
+        channel = self.slo_peer_channel
+        if channel is not None:
+            channel.broadcast(ticket)
         return False
 
     @app.route("/", branch=True)
     def proxy(self, request):
+        route = self.router.route_for(request.getHeader('host'), request.path.decode())
         for pattern in self.logout_patterns:
             if does_url_match_pattern(request.uri, pattern):
                 sess = request.getSession()
@@ -318,12 +648,17 @@ class ProxyApp(object):
                 cas_logout = self.cas_info.get('logout_url', None)
                 if cas_logout is not None:
                     if self.logout_passthrough:
-                        d = self.reverse_proxy(request, protected=False)
+                        d = self.reverse_proxy(request, protected=False, route=route)
                     return request.redirect(cas_logout)
                 else:
-                    return self.reverse_proxy(request, protected=False)
-        if self.is_excluded(request):
-            return self.reverse_proxy(request, protected=False)
+                    return self.reverse_proxy(request, protected=False, route=route)
+        # While the reactor lags, new unauthenticated and low priority
+        # requests are refused so requests in progress can finish.
+        shedding = self.lag_monitor.is_lagging()
+        if self.is_excluded(request, route):
+            if shedding:
+                return self.shed(request)
+            return self.reverse_proxy(request, protected=False, route=route)
         valid_sessions = self.valid_sessions
         sess = request.getSession()
         sess_uid = sess.uid
@@ -331,13 +666,13 @@ class ProxyApp(object):
             self.log(
                 ("Session {0} not in valid sessions.  "
                 "Will authenticate with CAS.").format(sess_uid))
-            if request.method == 'POST':
+            if request.method == b'POST':
                 headers = request.requestHeaders
-                if headers.hasHeader("Content-Type"):
-                    ct_list =  headers.getRawHeaders("Content-Type") 
+                if headers.hasHeader(b"Content-Type"):
+                    ct_list =  headers.getRawHeaders(b"Content-Type") 
                     #log.msg("[DEBUG] ct_list: %s" % str(ct_list))
                     for ct in ct_list:
-                        if ct.find('text/xml') != -1 or ct.find('application/xml') != -1:
+                        if ct.find(b'text/xml') != -1 or ct.find(b'application/xml') != -1:
                             if self._check_for_logout(request):
                                 return ""
                             else:
@@ -354,43 +689,113 @@ class ProxyApp(object):
                     d = self.validate_ticket(ticket, request)
                     return d
             # If no ticket is present, redirect to CAS.
+            if shedding:
+                return self.shed(request)
             d = self.redirect_to_cas_login(request)
             return d
-        elif request.path == self.auth_info_resource:
+        elif request.path.decode() == self.auth_info_resource:
             self.log("Providing authentication info.")
             return self.deliver_auth_info(request)
+        elif self.pgt_broker is not None and request.path.decode() == self.proxy_ticket_resource:
+            self.log("Providing proxy ticket.")
+            return self.deliver_proxy_ticket(request)
         else:
-            d = self.reverse_proxy(request)
+            if shedding and self.is_low_priority(request):
+                return self.shed(request)
+            d = self.reverse_proxy(request, route=route)
             return d
 
+    def is_low_priority(self, request):
+        uri = request.uri.decode()
+        for pattern in self.shed_patterns:
+            if does_url_match_pattern(uri, pattern):
+                return True
+        return False
+
+    def shed(self, request):
+        """
+        Refuse a request because the reactor is lagging.
+        """
+        self.stats.incr('proxy.shed')
+        self.log("Shed request for URL {0}.".format(request.uri.decode()))
+        return self.render_template_503(request)
+
     def deliver_auth_info(self, request):
         valid_sessions = self.valid_sessions
         sess = request.getSession()    
         sess_uid = sess.uid
         session_info = valid_sessions[sess_uid]
-        username = session_info['username']
-        attributes = session_info['attributes']
-        doc = {'username': username, 'attributes': attributes}
-        serialized = json.dumps(doc)
-        request.responseHeaders.setRawHeaders('Content-Type', ['application/json'])
-        return serialized 
+        body, etag = session_info['auth_info']
+        return authinfo.deliver_json(request, body, etag)
         
-    def get_url(self, request):
+    def deliver_proxy_ticket(self, request):
+        sess = request.getSession()
+        sess_uid = sess.uid
+        values = request.args.get(b'targetService', [])
+        if len(values) != 1:
+            request.setResponseCode(400)
+            return "Bad Request - 400"
+        target_service = values[0].decode('utf-8')
+        d = self.pgt_broker.get_proxy_ticket(sess_uid, target_service)
+
+        def _deliver(proxy_ticket):
+            if proxy_ticket is None:
+                request.setResponseCode(404)
+                return "Not Found - 404"
+            request.responseHeaders.setRawHeaders('Content-Type', ['application/json'])
+            return json.dumps({'proxyTicket': proxy_ticket})
+
+        def _failed(err):
+            self.log((
+                    "error='Could not obtain proxy ticket.' "
+                    "targetService='{0}'/n{1}"
+                    ).format(target_service, err.getErrorMessage()), important=True)
+            request.setResponseCode(502)
+            return "Bad Gateway - 502"
+
+        d.addCallbacks(_deliver, _failed)
+        return d
+
+    def pgt_callback(self, request):
+        """
+        Receive a proxy-granting ticket from CAS.
+        """
+        args = request.args
+        pgt_ious = args.get(b'pgtIou', [])
+        pgt_ids = args.get(b'pgtId', [])
+        if len(pgt_ious) == 1 and len(pgt_ids) == 1:
+            self.pgt_broker.receive_pgt(pgt_ious[0].decode('utf-8'), pgt_ids[0].decode('utf-8'))
+        return ""
+
+    def proxy_host(self, request):
+        """
+        The host name of the proxy as seen by `request`: the Host header if
+        a route is limited to that host, and otherwise the proxy's fqdn.
+        """
+        host = self.router.route_host(request.getHeader('host'))
+        if host is None:
+            host = self.fqdn
+        return host
+
+    def get_base_url(self, host=None):
         if self.is_https:
             scheme = 'https'
             default_port = 443
         else:
             scheme = 'http'
             default_port = 80
-        fqdn = self.fqdn
+        fqdn = host or self.fqdn
         port = self.port
         if port is None:
             port = default_port
         if port == default_port:
-            return urlparse.urljoin(f"{scheme}://{fqdn}", request.uri.decode())
+            return f"{scheme}://{fqdn}"
         else:
-            return urlparse.urljoin(f"{scheme}://{fqdn}:{port}",
-                    request.uri.decode())
+            return f"{scheme}://{fqdn}:{port}"
+
+    def get_url(self, request):
+        return urlparse.urljoin(
+            self.get_base_url(self.proxy_host(request)), request.uri.decode())
         
     def redirect_to_cas_login(self, request):
         """
@@ -433,6 +838,8 @@ class ProxyApp(object):
     def validate_ticket(self, ticket, request):
         service_name = self.service_name
         ticket_name = self.ticket_name
+        if isinstance(ticket, bytes):
+            ticket = ticket.decode('utf-8')
         this_url = self.get_url(request)
         p = urlparse.urlparse(this_url)
         qs_map = urlparse.parse_qs(p.query)
@@ -441,78 +848,155 @@ class ProxyApp(object):
         param_str = urlencode(qs_map, doseq=True)
         p = urlparse.ParseResult(*tuple(p[:4] + (param_str,) + p[5:]))
         service_url = urlparse.urlunparse(p)
+        if ticket in self.rejected_tickets:
+            self.stats.incr('cas.validate.negative_cache_hits')
+            self.log((
+                    "error='Ticket was already rejected by CAS.' "
+                    "service='{0}' ticket='{1}'"
+                    ).format(service_url, ticket), important=True)
+            return self.render_template_403(request)
         params = {
                 service_name: service_url,
                 ticket_name: ticket,}
+        if self.validate_format == 'JSON':
+            params['format'] = 'JSON'
+        if self.pgt_broker is not None:
+            params[self.pgturl_name] = urlparse.urljoin(
+                self.get_base_url(), self.pgt_callback_resource)
         param_str = urlencode(params, doseq=True)
         p = urlparse.urlparse(self.cas_info['service_validate_url'])
         p = urlparse.ParseResult(*tuple(p[:4] + (param_str,) + p[5:]))
         service_validate_url = urlparse.urlunparse(p)
+        d = self._shared_validation(service_validate_url, service_url, ticket)
+        d.addCallbacks(
+            self.complete_validation, self._validation_failed,
+            callbackArgs=(service_url, ticket, request),
+            errbackArgs=(service_url, ticket, request))
+        return d
+
+    def _shared_validation(self, service_validate_url, service_url, ticket):
+        """
+        Validate a (ticket, service) pair with CAS.  Concurrent requests
+        for the same pair share a single backchannel request and parsed
+        outcome.
+        """
+        key = (ticket, service_url)
+        inflight = self._inflight_validations
+        waiters = inflight.get(key, None)
+        if waiters is not None:
+            self.stats.incr('cas.validate.coalesced')
+            d = defer.Deferred()
+            waiters.append(d)
+            return d
+        waiters = []
+        inflight[key] = waiters
         self.log(
             "Requesting service-validate URL => '{0}' ...".format(
                 service_validate_url))
+        d = self.cas_limiter.run(
+            self.cas_breaker.call, self._fetch_cas, service_validate_url,
+            'cas.validate.latency')
+        d.addCallback(self.parse_sv_results, service_url, ticket)
+
+        def _fan_out(result):
+            del inflight[key]
+            if isinstance(result, Failure) and result.check(TicketRejectedError):
+                self.rejected_tickets.set(ticket, True)
+            for waiter in waiters:
+                if isinstance(result, Failure):
+                    waiter.errback(result)
+                else:
+                    waiter.callback(result)
+            return result
+
+        d.addBoth(_fan_out)
+        return d
+
+    def _fetch_proxy_ticket(self, url):
+        return self.cas_limiter.run(
+            self.cas_breaker.call, self._fetch_cas, url, 'cas.proxy.latency')
+
+    def _fetch_cas(self, url, timing_name):
+        """
+        Perform a backchannel request.  Timeouts, transport errors, and
+        CAS server errors fail the returned deferred.
+        """
+        stats = self.stats
+        started = self.reactor.seconds()
         http_client = HTTPClient(self.cas_agent) 
-        d = http_client.get(service_validate_url)
-        d.addCallback(treq.content)
-        d.addCallback(self.parse_sv_results, service_url, ticket, request)
+        d = http_client.get(url)
+
+        def _check_response(response):
+            if response.code >= 500:
+                raise CASBackchannelError(
+                    "CAS responded with status {0}.".format(response.code))
+            return treq.content(response)
+
+        def _record(result):
+            stats.record_timing(timing_name, self.reactor.seconds() - started)
+            return result
+
+        d.addCallback(_check_response)
+        d.addTimeout(self.cas_validate_timeout, self.reactor)
+        d.addBoth(_record)
         return d
-        
-    def parse_sv_results(self, payload, service_url, ticket, request):
-        self.log("Parsing /serviceValidate results  ...")
-        ns = self.ns
-        try:
-            root = etree.fromstring(payload)
-        except (etree.XMLSyntaxError,) as ex:
-            self.log((
-                    "error='Error parsing XML payload.' "
-                    "service='{0}' ticket={1}'/n{2}"
-                    ).format(service_url, ticket, ex), important=True)
-            return self.render_template_500(request)
-        if root.tag != ('%sserviceResponse' % ns):
-            self.log((
-                    "error='Error parsing XML payload.  No `serviceResponse`.' "
-                    "service='{0}' ticket={1}'"
-                    ).format(service_url, ticket), important=True)
-            return self.render_template_403(request)
-        results = root.findall("{0}authenticationSuccess".format(ns))
-        if len(results) != 1:
+
+    def _validation_failed(self, err, service_url, ticket, request):
+        if err.check(TicketRejectedError):
             self.log((
-                    "error='Error parsing XML payload.  No `authenticationSuccess`.' "
-                    "service='{0}' ticket={1}'"
-                    ).format(service_url, ticket), important=True)
+                    "error='{0}' service='{1}' ticket='{2}'"
+                    ).format(err.getErrorMessage(), service_url, ticket), important=True)
             return self.render_template_403(request)
-        success = results[0]
-        results = success.findall("{0}user".format(ns))
-        if len(results) != 1:
-            self.log((
-                    "error='Error parsing XML payload.  Not exactly 1 `user`.' "
-                    "service='{0}' ticket={1}'"
-                    ).format(service_url, ticket), important=True)
-            return self.render_template_403(request)
-        user = results[0]
-        username = user.text
-        attributes = success.findall("{0}attributes".format(ns))
-        attrib_map = {}
-        for attrib_container in attributes:
-            for elm in attrib_container.findall('./*'):
-                tag_name = elm.tag[len(ns):]
-                value = elm.text
-                attrib_map.setdefault(tag_name, []).append(value)
-        # Access control plugins
-        access_control = self.access_control
-        for ac_plugin in access_control:
-            is_allowed, reason = ac_plugin.isAllowed(username, attrib_map)
-            if not is_allowed:
+        self.stats.incr('cas.validate.errors')
+        self.log((
+                "error='Ticket validation request failed.' "
+                "service='{0}' ticket='{1}'/n{2}"
+                ).format(service_url, ticket, err.getErrorMessage()), important=True)
+        return self.render_template_500(request)
+        
+    def parse_sv_results(self, payload, service_url, ticket):
+        """
+        Parse a /serviceValidate response.
+        Returns (username, attrib_map, pgt) or raises `TicketRejectedError`
+        if CAS did not vouch for the ticket.
+        """
+        self.log("Parsing /serviceValidate results  ...")
+        username, attrib_map, pgt_iou = self.sv_parser(payload)
+        pgt = None
+        if pgt_iou is not None and self.pgt_broker is not None:
+            pgt = self.pgt_broker.claim_pgt(pgt_iou)
+            if pgt is None:
                 self.log((
-                        "Access denied:  user='{username}' ac_plugin='{ac_plugin}' "
-                        "reason={reason}, service='{service}' ticket='{ticket}'"
-                        ).format(
-                            username=username, 
-                            ac_plugin=ac_plugin.tagname, 
-                            service=service_url, 
-                            ticket=ticket,
-                            reason=reason), important=True)
-                return self.render_template_403(request, username=username, reason=reason)
+                        "error='No proxy-granting ticket received for IOU.' "
+                        "service='{0}' ticket='{1}'"
+                        ).format(service_url, ticket), important=True)
+        return (username, attrib_map, pgt)
+
+    def complete_validation(self, result, service_url, ticket, request):
+        """
+        Apply access control to a validated ticket and establish the
+        session for `request`.
+        """
+        username, attrib_map, pgt = result
+        # Access control plugins
+        d = self.access_evaluator.evaluate(username, attrib_map)
+        d.addCallback(
+            self._access_decided, username, attrib_map, pgt, service_url, ticket, request)
+        return d
+
+    def _access_decided(self, decision, username, attrib_map, pgt, service_url, ticket, request):
+        is_allowed, reason, ac_plugin = decision
+        if not is_allowed:
+            self.log((
+                    "Access denied:  user='{username}' ac_plugin='{ac_plugin}' "
+                    "reason={reason}, service='{service}' ticket='{ticket}'"
+                    ).format(
+                        username=username, 
+                        ac_plugin=ac_plugin.tagname, 
+                        service=service_url, 
+                        ticket=ticket,
+                        reason=reason), important=True)
+            return self.render_template_403(request, username=username, reason=reason)
         # Update session session
         valid_sessions = self.valid_sessions
         logout_tickets = self.logout_tickets
@@ -520,12 +1004,19 @@ class ProxyApp(object):
         sess_uid = sess.uid
         if sess_uid not in valid_sessions:
             valid_sessions[sess_uid] = {}
+        else:
+            self._unindex_session(sess_uid, valid_sessions[sess_uid]['username'])
         valid_sessions[sess_uid].update({
             'username': username,
             'ticket': ticket,
-            'attributes': attrib_map})
+            'attributes': attrib_map,
+            'auth_info': authinfo.serialize({'username': username, 'attributes': attrib_map}),
+            'headers': self.identity_headers.build(username, attrib_map)})
+        self.user_sessions.setdefault(username, set()).add(sess_uid)
         if not ticket in logout_tickets:
             logout_tickets[ticket] = sess_uid
+        if pgt is not None:
+            self.pgt_broker.set_pgt(sess_uid, pgt)
         auth_info_callback = self.auth_info_callback
         if auth_info_callback is not None: 
             auth_info_callback(username, attrib_map)
@@ -540,47 +1031,146 @@ class ProxyApp(object):
             username = session_info['username']
             ticket = session_info['ticket']
             del valid_sessions[uid]
-            auth_info_callback = self.auth_info_callback
-            if auth_info_callback is not None:
-                auth_info_callback(username, None)
+            self._unindex_session(uid, username)
             logout_tickets = self.logout_tickets
             if ticket in logout_tickets:
                 del logout_tickets[ticket]
+            if self.pgt_broker is not None:
+                self.pgt_broker.forget(uid)
             self.log(
                 ("label='Expired session.' session_id='{0}' "
                 "username='{1}'").format(uid, username))
         
-    def reverse_proxy(self, request, protected=True):
+    def _unindex_session(self, uid, username):
+        """
+        Remove a session from the username index.  Authentication info for
+        the user is withdrawn when their last session goes away.
+        """
+        user_sessions = self.user_sessions
+        uids = user_sessions.get(username, None)
+        if uids is None:
+            return
+        uids.discard(uid)
+        if len(uids) == 0:
+            del user_sessions[username]
+            auth_info_callback = self.auth_info_callback
+            if auth_info_callback is not None:
+                auth_info_callback(username, None)
+
+    def sessions_for_user(self, username):
+        return frozenset(self.user_sessions.get(username, ()))
+
+    def revoke_user(self, username):
+        """
+        Expire every session belonging to `username`.
+        Returns the number of sessions expired.
+        """
+        uids = self.sessions_for_user(username)
+        for uid in uids:
+            self._expired(uid)
+        if len(uids) > 0:
+            self.log(
+                ("label='Revoked sessions.' username='{0}' count={1}").format(
+                    username, len(uids)), important=True)
+        return len(uids)
+
+    def reverse_proxy(self, request, protected=True, route=None):
+        """
+        Proxy a request, subject to the rate limits for its user (or
+        client IP, if the resource is not protected).
+        """
+        limiter = self.rate_limiter
+        if limiter is None:
+            return self._reverse_proxy(request, protected, route)
+        if protected:
+            limit_key = self.valid_sessions[request.getSession().uid]['username']
+        else:
+            # UNIX socket clients have no address; they share one bucket.
+            limit_key = getattr(request.getClientAddress(), 'host', None)
+            if limit_key is None:
+                limit_key = 'local'
+        bucket, retry_after = limiter.acquire(limit_key, request.uri.decode())
+        if retry_after is not None:
+            self.log("Rate limited '{0}' for URL {1}.".format(limit_key, request.uri.decode()))
+            return self.render_template_429(request, retry_after)
+        try:
+            result = self._reverse_proxy(request, protected, route)
+        except Exception:
+            limiter.release(bucket)
+            raise
+        if not isinstance(result, defer.Deferred):
+            limiter.release(bucket)
+            return result
+
+        def _release(result):
+            limiter.release(bucket)
+            return result
+
+        return result.addBoth(_release)
+
+    def _reverse_proxy(self, request, protected=True, route=None):
+        if route is None:
+            route = self.default_route
+        sess_uid = None
         if protected:
             sess = request.getSession()
             valid_sessions = self.valid_sessions
             sess_uid = sess.uid
-            username = valid_sessions[sess_uid]['username']
+            identity_headers = valid_sessions[sess_uid]['headers']
+        upstream = route.upstreams.select(sess_uid)
+        raw_headers = dict(request.requestHeaders.getAllRawHeaders())
+
+        def make_headers(upstream):
+            req_headers = self.mod_headers(dict(raw_headers), upstream=upstream)
+            if protected:
+                req_headers.update(identity_headers)
+            return req_headers
+
         # Normal reverse proxying.
         kwds = {}
         cookiejar = {}
         kwds['allow_redirects'] = False
         kwds['cookies'] = cookiejar
-        req_headers = self.mod_headers(dict(request.requestHeaders.getAllRawHeaders()))
+        req_headers = make_headers(upstream)
         kwds['headers'] = req_headers
-        if protected:
-            kwds['headers'][self.remoteUserHeader] = [username]
-        if request.method in ('PUT', 'POST'):
+        if request.method in (b'PUT', b'POST'):
             kwds['data'] = request.content.read()
-        url = self.proxied_url + request.uri.decode()
+        uri = request.uri.decode()
+        url = upstream.url + uri
         # Determine if a plugin wants to intercept this URL.
-        interceptors = self.interceptors
+        interceptors = route.interceptors
         for interceptor in interceptors:
             if interceptor.should_resource_be_intercepted(url, request.method, req_headers, request):
                 return interceptor.handle_resource(url, request.method, req_headers, request)
         # Check if this is a request for a websocket.
-        d = self.checkForWebsocketUpgrade(request)
+        d = self.checkForWebsocketUpgrade(request, upstream=upstream)
         if d is not None:
             return d
         # Typical reverse proxying.    
         self.log("Proxying URL => {0}".format(url))
-        http_client = HTTPClient(self.proxy_agent) 
-        d = http_client.request(request.method.decode(), url, **kwds)
+        http_client = HTTPClient(route.agent) 
+        method = request.method.decode()
+
+        def send(selected):
+            selected_kwds = kwds
+            if selected is not upstream:
+                selected_kwds = dict(kwds, headers=make_headers(selected))
+            d = http_client.request(method, selected.url + uri, **selected_kwds)
+            return route.upstreams.track(selected, d)
+
+        policy = self.upstream_policy
+        if policy is not None and request.method in policy.methods and 'data' not in kwds:
+            d = policy.request(
+                upstream,
+                lambda exclude: route.upstreams.select(sess_uid, exclude=exclude),
+                send)
+        else:
+            d = send(upstream)
+        # Cancelling `d` on a timeout also cancels the upstream request, and
+        # the pool discards its connection.
+        ttfb_timeout, total_timeout = self.upstream_timeouts.for_uri(uri)
+        if ttfb_timeout > 0:
+            add_deadline(d, ttfb_timeout, self.reactor)
         print(f"request method: {request.method.decode()}")
         print(f"request url: {url}")
 
@@ -591,17 +1181,20 @@ class ProxyApp(object):
             resp_headers = response.headers
             resp_header_map = dict(resp_headers.getAllRawHeaders())
             # Rewrite Location headers for redirects as required.
-            if resp_code in (301, 302, 303, 307, 308) and "Location" in resp_header_map:
-                values = resp_header_map["Location"]
+            if resp_code in (301, 302, 303, 307, 308) and resp_headers.hasHeader("Location"):
+                values = resp_headers.getRawHeaders("Location")
                 if len(values) == 1:
                     location = values[0]
+                    if isinstance(location, bytes):
+                        location = location.decode('latin-1')
                     if request.isSecure():
                         proxy_scheme = 'https'
                     else:
                         proxy_scheme = 'http'
-                    new_location = self.proxied_url_to_proxy_url(proxy_scheme, location)
+                    new_location = self.proxied_url_to_proxy_url(
+                        proxy_scheme, location, self.proxy_host(request))
                     if new_location is not None:
-                        resp_header_map['Location'] = [new_location]
+                        resp_header_map[b'Location'] = [new_location.encode('latin-1')]
             request.setResponseCode(response.code, message=response.phrase)
             for k,v in resp_header_map.items():
                 if k == 'Set-Cookie':
@@ -609,28 +1202,83 @@ class ProxyApp(object):
                 req_resp_headers.setRawHeaders(k, v)
             return response
             
-        def mod_content(body, request):
+        def read_response(response):
+            d = read_body(response)
+            d.addCallback(lambda body: (response, body))
+            return d
+
+        def mod_content(result, request):
             """
             Modify response content before returning it to the user agent.
             """
+            response, body = result
+            content_modifiers = route.content_modifiers
+            if len(content_modifiers) == 0:
+                return body
+            cache = self.transform_cache
+            cache_key = None
+            if cache is not None:
+                cache_key = cache.key_for(
+                    self.request_url(request),
+                    response,
+                    body,
+                    cache.chain_key(content_modifiers))
+                if cache_key is not None:
+                    cached = cache.get(cache_key)
+                    if cached is not None:
+                        return cached
+            offloader = self.offloader
             d = None
-            for content_modifier in self.content_modifiers:
+            for content_modifier in content_modifiers:
                 if d is None:
-                    d = content_modifier.transform_content(body, request)
+                    d = defer.maybeDeferred(
+                        offloader.transform, body, content_modifier, request)
                 else:
-                    d.addCallback(content_modifier.transform_content, request)
-            if d is None:
-                return body
-            else:
-                return d
+                    d.addCallback(offloader.transform, content_modifier, request)
+            if cache_key is not None:
+
+                def _cache_content(content):
+                    cache.set(cache_key, content)
+                    return content
+
+                d.addCallback(_cache_content)
+            return d
             
         d.addCallback(process_response, request)
-        d.addCallback(treq.content)
+        d.addCallback(read_response)
         d.addCallback(mod_content, request)
+        if total_timeout > 0:
+            add_deadline(d, total_timeout, self.reactor)
+        d.addErrback(self._upstream_timed_out, request, url)
         print("GOT HERE")
         return d
 
-    def checkForWebsocketUpgrade(self, request):
+    def request_url(self, request):
+        """
+        The URL `request` was made for, as seen by the user agent.
+        """
+        if request.isSecure():
+            scheme = 'https'
+        else:
+            scheme = 'http'
+        host = request.getHeader('host')
+        if host is None:
+            host = "{0}:{1}".format(self.fqdn, self.port)
+        return "{0}://{1}{2}".format(scheme, host, request.uri.decode())
+
+    def _upstream_timed_out(self, err, request, url):
+        """
+        Render a 504 page for a request the upstream did not answer in time.
+        """
+        err.trap(defer.TimeoutError, error.TimeoutError)
+        self.stats.incr('proxy.timeouts')
+        self.log(
+            "Timed out proxying URL '{0}': {1}".format(url, err.getErrorMessage()),
+            important=True)
+        request.responseHeaders = Headers()
+        return self.render_template_504(request)
+
+    def checkForWebsocketUpgrade(self, request, upstream=None):
         
         def _extract(name):
             raw_value = request.getHeader(name)
@@ -648,6 +1296,9 @@ class ProxyApp(object):
             proxied_scheme = self.proxied_scheme
             proxied_netloc = self.proxied_netloc
             proxied_path = self.proxied_path
+            if upstream is not None:
+                proxied_scheme = upstream.scheme
+                proxied_netloc = upstream.netloc
             if self.is_https:
                 scheme = 'wss'
             else:
@@ -717,22 +1368,44 @@ class ProxyApp(object):
     def is_proxy_path_or_child(self, path):
         return proxyutils.is_proxy_path_or_child(self.proxied_path, path)
     
-    def proxied_url_to_proxy_url(self, proxy_scheme, target_url):
+    def proxied_url_to_proxy_url(self, proxy_scheme, target_url, proxy_host=None):
+        # Any upstream's URLs are rewritten as URLs on the proxy, on the
+        # host of the upstream's route if it is limited to one host, and
+        # otherwise on `proxy_host`.
+        if proxy_host is None:
+            proxy_host = self.fqdn
+        proxied_netloc = urlparse.urlparse(target_url).netloc
+        entry = self.upstream_paths.get(proxied_netloc, None)
+        if entry is None:
+            proxied_netloc = self.proxied_netloc
+            proxied_path = self.proxied_path
+        else:
+            proxied_path, route_host = entry
+            if route_host is not None:
+                proxy_host = route_host
         return proxyutils.proxied_url_to_proxy_url(
             proxy_scheme,
-            self.fqdn, 
+            proxy_host, 
             self.port, 
-            self.proxied_netloc, 
-            self.proxied_path, 
+            proxied_netloc, 
+            proxied_path, 
             target_url)
         
-    def proxy_url_to_proxied_url(self, target_url):
+    def proxy_url_to_proxied_url(self, target_url, upstream=None):
+        if upstream is None:
+            return proxyutils.proxy_url_to_proxied_url(
+                self.proxied_scheme,
+                self.fqdn, 
+                self.port, 
+                self.proxied_netloc,
+                self.proxied_path,
+                target_url)
         return proxyutils.proxy_url_to_proxied_url(
-            self.proxied_scheme,
+            upstream.scheme,
             self.fqdn, 
             self.port, 
-            self.proxied_netloc,
-            self.proxied_path,
+            upstream.netloc,
+            upstream.path,
             target_url)
 
     def get_template_static_base(self):
@@ -757,18 +1430,59 @@ class ProxyApp(object):
         else:
             return self.render_template('error/500.jinja2', request=request, **kwargs)
 
+    def render_template_429(self, request, retry_after, **kwargs):
+        request.setResponseCode(429)
+        request.setHeader('Retry-After', str(int(math.ceil(retry_after))))
+        return self.render_optional_template(
+            request, 'error/429.jinja2', retry_after=retry_after, **kwargs)
+
+    def render_template_503(self, request, **kwargs):
+        request.setResponseCode(503)
+        request.setHeader('Retry-After', '1')
+        return self.render_optional_template(request, 'error/503.jinja2', **kwargs)
+
+    def render_template_504(self, request, **kwargs):
+        request.setResponseCode(504)
+        return self.render_optional_template(request, 'error/504.jinja2', **kwargs)
+
+    def render_optional_template(self, request, template_name, **kwargs):
+        """
+        Render an error page that template folders made for older versions
+        of the proxy may not have.  Without the template, the response has
+        an empty body (its status is already set).
+        """
+        if self.template_dir is None:
+            return ""
+        try:
+            self.templates.get_template(template_name)
+        except TemplateNotFound:
+            return ""
+        return self.render_template(template_name, request=request, **kwargs)
+
     def render_template(self, template_name, **kwargs):
-        template_dir = self.template_dir
+        templates = self.templates
         try:
-            template = self.template_loader_.load(self.template_env_, template_name)
+            output = templates.prerendered(template_name)
+            if output is not None:
+                return output
+            template = templates.get_template(template_name)
         except TemplateNotFound:
             raise Exception("The template '{0}' was not found.".format(template_name))
-        return template.render(static_base=self.static_base, **kwargs).encode('utf-8')
+        context = dict(templates.context)
+        context.update(kwargs)
+        return self.offloader.render(template, **context)
     
     def create_template_static_resource(self):
         static_path = os.path.join(self.template_dir, 'static')
-        static = File(static_path)
-        return static
+        return self.make_static_resource(static_path)
+
+    def make_static_resource(self, static_path):
+        static_info = self.static_info
+        return StaticDirectory(
+            static_path,
+            memory=int(static_info.get('memory', 33554432)),
+            max_age=int(static_info.get('max_age', 300)),
+            immutable=static_info.get('immutable', False))
 
     def static(self, request):
         return self.templateStaticResource_
@@ -0,0 +1,245 @@
+
+#----------------------------------------------------------------------
+# Load balancing across equivalent upstream (proxied) sites.
+#----------------------------------------------------------------------
+
+import hashlib
+from twisted.internet import defer
+from twisted.internet.error import ConnectError, TimeoutError
+from twisted.internet.task import LoopingCall
+from twisted.python import log
+from twisted.web.client import (
+    readBody,
+    RequestTransmissionFailed,
+    ResponseNeverReceived)
+from urllib import parse as urlparse
+
+# Errors that show an upstream could not be reached, as opposed to an
+# upstream that answered with an error.
+connection_errors = (
+    ConnectError,
+    TimeoutError,
+    RequestTransmissionFailed,
+    ResponseNeverReceived,
+)
+
+
+def is_cancelled(err):
+    """
+    True if the request that failed with `err` was cancelled by us.
+    """
+    if err.check(defer.CancelledError):
+        return True
+    if err.check(RequestTransmissionFailed, ResponseNeverReceived):
+        return any(reason.check(defer.CancelledError) for reason in err.value.reasons)
+    return False
+
+
+class Upstream(object):
+    """
+    One upstream base URL and its load and health state.
+    """
+
+    def __init__(self, url):
+        if url.endswith('/'):
+            url = url[:-1]
+        self.url = url
+        p = urlparse.urlparse(url)
+        self.scheme = p.scheme
+        self.netloc = p.netloc
+        self.path = p.path
+        self.outstanding = 0
+        self.latency = None
+        self.failures = 0
+        self.ejected_until = None
+
+    def is_available(self, now):
+        return self.ejected_until is None or self.ejected_until <= now
+
+
+class UpstreamPool(object):
+    """
+    Selects an upstream for each proxied request.
+
+    * `balance` is 'least-outstanding' (fewest requests in flight) or
+      'ewma' (lowest moving average latency, weighted by requests in
+      flight).
+    * After `eject_failures` consecutive connection errors an upstream is
+      ejected for `eject_time` seconds.
+    * Every `health_interval` seconds each upstream is sent a HEAD request
+      for `health_path`; failures eject it and success restores it.
+    * With `affinity`, a key (the proxy session uid) is mapped to an
+      upstream by rendezvous hashing, so a session stays on one upstream
+      unless that upstream becomes unavailable.
+
+    When every upstream is ejected, all of them are considered available.
+    """
+    balance_strategies = ('least-outstanding', 'ewma')
+    ewma_decay = 0.3
+
+    def __init__(self, clock, urls, balance='least-outstanding', affinity=False,
+                    eject_failures=3, eject_time=30, health_interval=10,
+                    health_path='/', stats=None):
+        if balance not in self.balance_strategies:
+            raise ValueError("Unknown upstream balance strategy '{0}'.".format(balance))
+        self.clock = clock
+        self.upstreams = [Upstream(url) for url in urls]
+        paths = set(upstream.path for upstream in self.upstreams)
+        if len(paths) != 1:
+            raise ValueError("Upstream URLs must all have the same path.")
+        self.netlocs = frozenset(upstream.netloc for upstream in self.upstreams)
+        self.balance = balance
+        self.affinity = affinity
+        self.eject_failures = eject_failures
+        self.eject_time = eject_time
+        self.health_interval = health_interval
+        self.health_path = health_path
+        self.stats = stats
+        self.agent = None
+        self._turn = 0
+        self._healthLoop = None
+        if stats is not None:
+            stats.set_gauge('upstream.available', self.count_available)
+
+    def _incr(self, upstream, name):
+        if self.stats is not None:
+            self.stats.incr('upstream.{0}.{1}'.format(upstream.netloc, name))
+
+    def count_available(self):
+        now = self.clock.seconds()
+        return sum(1 for upstream in self.upstreams if upstream.is_available(now))
+
+    def _candidates(self, exclude):
+        upstreams = self.upstreams
+        if len(upstreams) == 1:
+            return upstreams
+        now = self.clock.seconds()
+        available = [upstream for upstream in upstreams if upstream.is_available(now)]
+        if len(available) == 0:
+            available = upstreams
+        if len(exclude) > 0:
+            remaining = [upstream for upstream in available if upstream not in exclude]
+            if len(remaining) > 0:
+                return remaining
+        return available
+
+    def select(self, affinity_key=None, exclude=()):
+        """
+        Choose an upstream, avoiding those in `exclude` unless no others
+        are available.
+        """
+        candidates = self._candidates(exclude)
+        if len(candidates) == 1:
+            return candidates[0]
+        if self.affinity and affinity_key is not None:
+            return max(candidates, key=lambda upstream: self._weight(upstream, affinity_key))
+        # Rotate the candidates so ties are broken round-robin.
+        self._turn = (self._turn + 1) % len(candidates)
+        candidates = candidates[self._turn:] + candidates[:self._turn]
+        if self.balance == 'ewma':
+            return min(candidates, key=self._ewma_cost)
+        return min(candidates, key=lambda upstream: upstream.outstanding)
+
+    def _weight(self, upstream, key):
+        return hashlib.md5("{0}|{1}".format(upstream.netloc, key).encode('utf-8')).digest()
+
+    def _ewma_cost(self, upstream):
+        latency = upstream.latency
+        if latency is None:
+            # Untried upstreams are preferred so they get a latency sample.
+            return 0.0
+        return latency * (upstream.outstanding + 1)
+
+    def track(self, upstream, d):
+        """
+        Account for the request whose response is `d`.  Latency is measured
+        to the arrival of the response headers.
+        """
+        started = self.clock.seconds()
+        upstream.outstanding += 1
+        self._incr(upstream, 'requests')
+
+        def _succeeded(result):
+            upstream.outstanding -= 1
+            self._observe_latency(upstream, self.clock.seconds() - started)
+            upstream.failures = 0
+            return result
+
+        def _failed(err):
+            upstream.outstanding -= 1
+            if is_cancelled(err):
+                # Abandoned (e.g. a hedged request lost); the upstream took
+                # at least this long.
+                self._observe_latency(upstream, self.clock.seconds() - started)
+            elif err.check(*connection_errors):
+                self._record_failure(upstream, err)
+            return err
+
+        d.addCallbacks(_succeeded, _failed)
+        return d
+
+    def _observe_latency(self, upstream, elapsed):
+        if upstream.latency is None:
+            upstream.latency = elapsed
+        else:
+            decay = self.ewma_decay
+            upstream.latency = decay * elapsed + (1 - decay) * upstream.latency
+
+    def _record_failure(self, upstream, err):
+        self._incr(upstream, 'failures')
+        upstream.failures += 1
+        if upstream.failures >= self.eject_failures:
+            if upstream.is_available(self.clock.seconds()):
+                self.eject(upstream, err.getErrorMessage())
+
+    def eject(self, upstream, reason):
+        upstream.ejected_until = self.clock.seconds() + self.eject_time
+        self._incr(upstream, 'ejections')
+        log.msg("[WARN] Ejected upstream '{0}' for {1} seconds: {2}".format(
+            upstream.url, self.eject_time, reason))
+
+    def restore(self, upstream):
+        if upstream.ejected_until is not None:
+            log.msg("[INFO] Restored upstream '{0}'.".format(upstream.url))
+        upstream.ejected_until = None
+        upstream.failures = 0
+
+    def start(self, agent):
+        """
+        Start active health checks, made through `agent`.
+        """
+        self.agent = agent
+        if self.health_interval > 0 and len(self.upstreams) > 1:
+            self._healthLoop = LoopingCall(self.check_health)
+            self._healthLoop.clock = self.clock
+            self._healthLoop.start(self.health_interval, now=False)
+
+    def stop(self):
+        if self._healthLoop is not None and self._healthLoop.running:
+            self._healthLoop.stop()
+        self._healthLoop = None
+
+    def check_health(self):
+        checks = [self._check(upstream) for upstream in self.upstreams]
+        return defer.DeferredList(checks, consumeErrors=True)
+
+    def _check(self, upstream):
+        url = "{0}{1}".format(upstream.url, self.health_path).encode('utf-8')
+        d = self.agent.request(b'HEAD', url)
+
+        def _checked(response):
+            d2 = readBody(response)
+            if response.code >= 500:
+                self.eject(upstream, "Health check returned {0}.".format(response.code))
+            else:
+                self.restore(upstream)
+            return d2
+
+        def _failed(err):
+            if upstream.is_available(self.clock.seconds()):
+                self.eject(upstream, err.getErrorMessage())
+            else:
+                upstream.ejected_until = self.clock.seconds() + self.eject_time
+
+        d.addCallbacks(_checked, _failed)
+        return d
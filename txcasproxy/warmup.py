@@ -0,0 +1,72 @@
+
+#----------------------------------------------------------------------
+# Keep persistent upstream connections open and healthy.
+#----------------------------------------------------------------------
+
+from twisted.internet import defer
+from twisted.internet.task import LoopingCall
+from twisted.python import log
+from twisted.web.client import readBody
+
+
+class PoolWarmer(object):
+    """
+    Opens `connections` persistent connections to `url` through `agent`
+    by issuing that many concurrent HEAD requests.  Repeating this every
+    `interval` seconds reuses (and so tests) every cached connection; a
+    connection the server has closed fails its probe and is discarded by
+    the pool rather than by a user's request.
+    """
+
+    def __init__(self, clock, agent, url, connections=2, interval=30,
+                    stats=None, name='pool'):
+        self.clock = clock
+        self.agent = agent
+        if isinstance(url, str):
+            url = url.encode('utf-8')
+        self.url = url
+        self.connections = connections
+        self.interval = interval
+        self.stats = stats
+        self.name = name
+        self._loop = None
+
+    def _incr(self, name):
+        if self.stats is not None:
+            self.stats.incr('{0}.{1}'.format(self.name, name))
+
+    def start(self):
+        """
+        Warm the pool now and, if `interval` > 0, periodically after.
+        """
+        if self.connections <= 0:
+            return
+        if self.interval > 0:
+            self._loop = LoopingCall(self.warm)
+            self._loop.clock = self.clock
+            self._loop.start(self.interval, now=True)
+        else:
+            self.warm()
+
+    def stop(self):
+        if self._loop is not None and self._loop.running:
+            self._loop.stop()
+        self._loop = None
+
+    def warm(self):
+        probes = [self._probe() for n in range(self.connections)]
+        return defer.DeferredList(probes, consumeErrors=True)
+
+    def _probe(self):
+        d = self.agent.request(b'HEAD', self.url)
+        d.addCallback(readBody)
+        d.addCallbacks(self._probeSucceeded, self._probeFailed)
+        return d
+
+    def _probeSucceeded(self, body):
+        self._incr('probes')
+
+    def _probeFailed(self, err):
+        self._incr('probe_failures')
+        log.msg("[INFO] Connection probe to '{0}' failed: {1}".format(
+            self.url.decode('utf-8'), err.getErrorMessage()))